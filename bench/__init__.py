@@ -0,0 +1,7 @@
+"""Offline benchmark of the bot, see `bench.harness`."""
+
+import os
+
+# As in the Dockerfile, checking the types of every XDR object built or
+# parsed makes stellar-sdk several times slower.
+os.environ.setdefault("STELLAR_SDK_RUNTIME_TYPE_CHECKING", "0")
@@ -0,0 +1,133 @@
+"""A Horizon serving the ledgers of a fixture, as if they were closing.
+
+The first `backlog` ledgers are closed when the bot first asks for the
+latest ledger, so that it catches up on them. The others close one every
+`close_interval` seconds once `start_live` is called.
+
+Only what the bot reads is served: the root, the transactions of a ledger,
+and the transaction stream.
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+from bench.fixtures import Fixture
+
+PAGE_LIMIT = 200
+
+
+class FakeHorizon:
+    def __init__(self, fixture: Fixture, backlog: int, close_interval: float) -> None:
+        self.fixture = fixture
+        self.backlog = backlog
+        self.close_interval = close_interval
+        self.records = {
+            ledger.sequence: [r for r in ledger.records if r.get("successful", True)]
+            for ledger in fixture.ledgers
+        }
+        # Monotonic times the backlog and the live ledgers started closing.
+        self.started_at: Optional[float] = None
+        self.live_started_at: Optional[float] = None
+        self.requests: Counter[str] = Counter()
+
+    @property
+    def backlog_end(self) -> int:
+        return self.fixture.first_ledger + self.backlog - 1
+
+    def start_live(self) -> None:
+        self.live_started_at = time.monotonic()
+
+    def closed_at(self, sequence: int) -> float:
+        assert self.started_at is not None
+        if sequence <= self.backlog_end:
+            return self.started_at
+        assert self.live_started_at is not None
+        return (
+            self.live_started_at
+            + (sequence - self.backlog_end - 1) * self.close_interval
+        )
+
+    def latest_ledger(self) -> int:
+        if self.started_at is None:
+            return self.fixture.first_ledger - 1
+        if self.live_started_at is None:
+            return self.backlog_end
+        if self.close_interval == 0:
+            return self.fixture.last_ledger
+        closed = int((time.monotonic() - self.live_started_at) / self.close_interval)
+        return min(self.fixture.last_ledger, self.backlog_end + 1 + closed)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.root)
+        app.router.add_get("/ledgers/{sequence}/transactions", self.transactions)
+        app.router.add_get("/transactions", self.stream)
+        return app
+
+    async def root(self, request: web.Request) -> web.Response:
+        self.requests["root"] += 1
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        latest_ledger = self.latest_ledger()
+        return web.json_response(
+            {
+                "horizon_version": "bench",
+                "history_latest_ledger": latest_ledger,
+                "history_elder_ledger": self.fixture.first_ledger,
+                "core_latest_ledger": latest_ledger,
+                "network_passphrase": self.fixture.network_passphrase,
+            }
+        )
+
+    async def transactions(self, request: web.Request) -> web.Response:
+        self.requests["ledger_transactions"] += 1
+        sequence = int(request.match_info["sequence"])
+        if sequence not in self.records or sequence > self.latest_ledger():
+            return web.json_response(
+                {"title": "Resource Missing", "status": 404}, status=404
+            )
+        cursor = int(request.query.get("cursor") or 0)
+        limit = int(request.query.get("limit") or 10)
+        page = [r for r in self.records[sequence] if int(r["paging_token"]) > cursor]
+        page = page[:limit]
+        if page:
+            cursor = int(page[-1]["paging_token"])
+        next_url = request.url.with_query(
+            cursor=str(cursor), limit=str(limit), order="asc", include_failed="false"
+        )
+        return web.json_response(
+            {
+                "_links": {"next": {"href": str(next_url)}},
+                "_embedded": {"records": page},
+            }
+        )
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        """Stream the transactions after `cursor` as they close, like
+        Horizon's server-sent events."""
+        self.requests["stream"] += 1
+        if request.headers.get("Accept") != "text/event-stream":
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        await response.write(b'retry: 1000\nevent: open\ndata: "hello"\n\n')
+        cursor = int(request.query.get("cursor") or 0)
+        for sequence, records in self.records.items():
+            if (sequence + 1) << 32 <= cursor:
+                continue
+            while self.latest_ledger() < sequence:
+                await asyncio.sleep(0.05)
+            for r in records:
+                if int(r["paging_token"]) > cursor:
+                    event = f"id: {r['paging_token']}\ndata: {json.dumps(r)}\n\n"
+                    await response.write(event.encode())
+        # Horizon keeps the stream open until a new ledger closes.
+        while True:
+            await asyncio.sleep(60)
@@ -0,0 +1,151 @@
+"""A Telegram Bot API recording the messages it is sent.
+
+Like Telegram, it enforces a global and a per chat rate of messages, and
+answers those exceeding them with a 429 and a `retry_after`.
+https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+"""
+
+import asyncio
+import json
+import math
+import re
+import time
+from typing import NamedTuple
+
+from aiohttp import web
+
+# Limits documented by Telegram.
+DEFAULT_GLOBAL_RATE = 30.0
+DEFAULT_CHAT_RATE = 1.0
+# Round trip of a request to api.telegram.org.
+DEFAULT_LATENCY = 0.05
+
+_TX_HASH = re.compile(r"/tx/([0-9a-f]{64})")
+
+
+class Delivery(NamedTuple):
+    # Monotonic time the message was accepted at.
+    time: float
+    chat_id: int
+    # Of every notification of the message, in order.
+    tx_hashes: list[str]
+
+
+class RateLimit:
+    """Like `src.send_notification.TokenBucket`, but tells how long to wait
+    instead of waiting."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def wait_time(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        self._tokens -= 1
+
+
+class FakeTelegram:
+    def __init__(
+        self,
+        global_rate: float = DEFAULT_GLOBAL_RATE,
+        chat_rate: float = DEFAULT_CHAT_RATE,
+        latency: float = DEFAULT_LATENCY,
+    ) -> None:
+        self.chat_rate = chat_rate
+        self.latency = latency
+        self.global_limit = RateLimit(global_rate)
+        self.chat_limits: dict[int, RateLimit] = {}
+        self.deliveries: list[Delivery] = []
+        # sendMessage requests answered with a 429.
+        self.rejected = 0
+        self.requests = 0
+
+    @property
+    def last_delivery_at(self) -> float:
+        return self.deliveries[-1].time if self.deliveries else 0.0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        method = request.match_info["method"].lower()
+        await asyncio.sleep(self.latency)
+        if method == "getme":
+            return ok(
+                {
+                    "id": 1,
+                    "is_bot": True,
+                    "first_name": "Bench",
+                    "username": "bench_bot",
+                }
+            )
+        if method == "getupdates":
+            # Long polling for updates which never come.
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 1.0))
+            return ok([])
+        if method == "sendmessage":
+            return self.send_message(params)
+        return ok(True)
+
+    def send_message(self, params: dict) -> web.Response:
+        chat_id = int(params["chat_id"])
+        chat_limit = self.chat_limits.get(chat_id)
+        if chat_limit is None:
+            chat_limit = self.chat_limits[chat_id] = RateLimit(self.chat_rate)
+        wait_time = max(self.global_limit.wait_time(), chat_limit.wait_time())
+        if wait_time:
+            self.rejected += 1
+            retry_after = math.ceil(wait_time)
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                },
+                status=429,
+            )
+        self.global_limit.take()
+        chat_limit.take()
+        text = params["text"]
+        reply_markup = params.get("reply_markup") or ""
+        if not isinstance(reply_markup, str):
+            reply_markup = json.dumps(reply_markup)
+        self.deliveries.append(
+            Delivery(
+                time.monotonic(),
+                chat_id,
+                # A single notification links its transaction in the keyboard.
+                _TX_HASH.findall(text) or _TX_HASH.findall(reply_markup),
+            )
+        )
+        return ok(
+            {
+                "message_id": len(self.deliveries),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+        )
+
+
+def ok(result: object) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
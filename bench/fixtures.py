@@ -0,0 +1,381 @@
+"""Ledgers served by the fake Horizon.
+
+A fixture is a gzipped JSON lines file: a header with the network
+passphrase, then a line per ledger holding its sequence and its transaction
+records, as Horizon returns them from `/ledgers/{sequence}/transactions`.
+
+    python -m bench.fixtures record START END OUTPUT [--horizon-url URL]
+    python -m bench.fixtures generate OUTPUT [--ledgers 120] [--transactions 50]
+
+`record` saves ledgers of a real network. `generate` builds synthetic ones,
+with payments, path payments and account creations between a pool of
+accounts, and the result meta of their balance changes, so that
+`NOTIFY_FROM_META` can be benchmarked as well.
+"""
+
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import random
+from dataclasses import dataclass
+from functools import lru_cache
+
+from stellar_sdk import (
+    Account,
+    AiohttpClient,
+    Asset,
+    Keypair,
+    Network,
+    ServerAsync,
+    TransactionBuilder,
+)
+from stellar_sdk import xdr as stellar_xdr
+
+from src.decoder import transaction_id
+
+DEFAULT_LEDGERS = 120
+DEFAULT_TRANSACTIONS = 50
+DEFAULT_ACCOUNTS = 10000
+# The first ledger of generated fixtures, like a recent mainnet one.
+FIRST_LEDGER = 48000000
+USDC = Asset("USDC", "GA5ZSEJYB37JRC5AVCIA5MOP4RHTM335X2KGX3IHOJAPP5RE34K4KZVN")
+
+
+@dataclass
+class Ledger:
+    sequence: int
+    # Horizon transaction records, in application order.
+    records: list[dict]
+
+
+@dataclass
+class Fixture:
+    network_passphrase: str
+    ledgers: list[Ledger]
+
+    @property
+    def first_ledger(self) -> int:
+        return self.ledgers[0].sequence
+
+    @property
+    def last_ledger(self) -> int:
+        return self.ledgers[-1].sequence
+
+    @property
+    def transactions(self) -> int:
+        return sum(len(ledger.records) for ledger in self.ledgers)
+
+
+def load_fixture(path: str) -> Fixture:
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        ledgers = [Ledger(**json.loads(line)) for line in f]
+    if not ledgers:
+        raise ValueError(f"{path} holds no ledger")
+    for previous, ledger in zip(ledgers, ledgers[1:]):
+        if ledger.sequence != previous.sequence + 1:
+            raise ValueError(f"{path} misses ledger {previous.sequence + 1}")
+    return Fixture(header["network_passphrase"], ledgers)
+
+
+def save_fixture(fixture: Fixture, path: str) -> None:
+    with gzip.open(path, "wt") as f:
+        f.write(json.dumps({"network_passphrase": fixture.network_passphrase}) + "\n")
+        for ledger in fixture.ledgers:
+            f.write(
+                json.dumps({"sequence": ledger.sequence, "records": ledger.records})
+                + "\n"
+            )
+
+
+async def record(start: int, end: int, horizon_url: str) -> Fixture:
+    """Fetch the successful transactions of ledgers [start, end]."""
+    async with ServerAsync(horizon_url, client=AiohttpClient()) as server:
+        root = await server.root().call()
+        ledgers = []
+        for sequence in range(start, end + 1):
+            builder = (
+                server.transactions()
+                .for_ledger(sequence)
+                .include_failed(False)
+                .limit(200)
+            )
+            records = (await builder.call())["_embedded"]["records"]
+            while page := (await builder.next())["_embedded"]["records"]:
+                records += page
+            for r in records:
+                r.pop("_links", None)
+            ledgers.append(Ledger(sequence, records))
+    return Fixture(root["network_passphrase"], ledgers)
+
+
+class _Generator:
+    def __init__(self, accounts: int, seed: int) -> None:
+        self.random = random.Random(seed)
+        self.keypairs = [
+            Keypair.from_raw_ed25519_seed(self.random.randbytes(32))
+            for _ in range(accounts)
+        ]
+        self.sequences = [0] * accounts
+
+    def amount(self) -> int:
+        # In stroops, one in ten below the default thresholds.
+        if self.random.random() < 0.1:
+            return self.random.randint(1, 99999)
+        return self.random.randint(10**5, 10**11)
+
+    def transaction(self, tx_id: int, created_at: str) -> dict:
+        index = self.random.randrange(len(self.keypairs))
+        source = self.keypairs[index]
+        self.sequences[index] += 1
+        builder = TransactionBuilder(
+            Account(source.public_key, self.sequences[index]),
+            Network.PUBLIC_NETWORK_PASSPHRASE,
+            base_fee=100,
+        ).add_time_bounds(0, 0)
+        operations = []
+        for _ in range(self.random.choice((1, 1, 1, 2, 3))):
+            operations.append(self.operation(builder, source.public_key))
+        tx = builder.build()
+        tx.sign(source)
+        fee = _account_changes(
+            source.public_key, self.random.randint(10**8, 10**12), 0
+        )
+        meta = stellar_xdr.TransactionMeta(
+            2,
+            v2=stellar_xdr.TransactionMetaV2(
+                stellar_xdr.LedgerEntryChanges(fee),
+                [
+                    stellar_xdr.OperationMeta(stellar_xdr.LedgerEntryChanges(changes))
+                    for changes in operations
+                ],
+                stellar_xdr.LedgerEntryChanges([]),
+            ),
+        )
+        return {
+            "id": tx.hash_hex(),
+            "paging_token": str(tx_id),
+            "successful": True,
+            "hash": tx.hash_hex(),
+            "ledger": tx_id >> 32,
+            "created_at": created_at,
+            "source_account": source.public_key,
+            "operation_count": len(operations),
+            "envelope_xdr": tx.to_xdr(),
+            "result_meta_xdr": meta.to_xdr(),
+        }
+
+    def operation(
+        self, builder: TransactionBuilder, source: str
+    ) -> list[stellar_xdr.LedgerEntryChange]:
+        """Append an operation to `builder` and return its ledger entry
+        changes."""
+        destination = self.random.choice(self.keypairs).public_key
+        amount = self.amount()
+        balance = self.random.randint(10**11, 10**13)
+        kind = self.random.random()
+        if kind < 0.5:
+            builder.append_payment_op(destination, Asset.native(), _units(amount))
+            return _account_changes(source, balance, -amount) + _account_changes(
+                destination, balance, amount
+            )
+        if kind < 0.7:
+            builder.append_payment_op(destination, USDC, _units(amount))
+            return _trust_line_changes(source, balance, -amount) + _trust_line_changes(
+                destination, balance, amount
+            )
+        if kind < 0.85:
+            received = amount * self.random.randint(90, 110) // 100
+            builder.append_path_payment_strict_send_op(
+                destination, USDC, _units(amount), Asset.native(), _units(received), []
+            )
+            return _trust_line_changes(source, balance, -amount) + _account_changes(
+                destination, balance, received
+            )
+        if kind < 0.9:
+            destination = Keypair.from_raw_ed25519_seed(
+                self.random.randbytes(32)
+            ).public_key
+            builder.append_create_account_op(destination, _units(amount))
+            return _account_changes(source, balance, -amount) + [
+                stellar_xdr.LedgerEntryChange(
+                    stellar_xdr.LedgerEntryChangeType.LEDGER_ENTRY_CREATED,
+                    created=_entry(_account(destination, amount)),
+                )
+            ]
+        # Not notified, it only changes the fee paid.
+        builder.append_manage_data_op("bench", b"value")
+        return _account_changes(source, balance, 0)
+
+
+def _units(stroops: int) -> str:
+    return f"{stroops // 10**7}.{stroops % 10**7:07d}"
+
+
+@lru_cache(maxsize=None)
+def _account_id(account_id: str) -> stellar_xdr.AccountID:
+    return Keypair.from_public_key(account_id).xdr_account_id()
+
+
+def _entry(data: stellar_xdr.LedgerEntryData) -> stellar_xdr.LedgerEntry:
+    return stellar_xdr.LedgerEntry(
+        stellar_xdr.Uint32(FIRST_LEDGER - 1), data, stellar_xdr.LedgerEntryExt(0)
+    )
+
+
+def _account(account_id: str, balance: int) -> stellar_xdr.LedgerEntryData:
+    return stellar_xdr.LedgerEntryData(
+        stellar_xdr.LedgerEntryType.ACCOUNT,
+        account=stellar_xdr.AccountEntry(
+            _account_id(account_id),
+            stellar_xdr.Int64(balance),
+            stellar_xdr.SequenceNumber(stellar_xdr.Int64(1)),
+            stellar_xdr.Uint32(0),
+            None,
+            stellar_xdr.Uint32(0),
+            stellar_xdr.String32(b""),
+            stellar_xdr.Thresholds(b"\x01\x00\x00\x00"),
+            [],
+            stellar_xdr.AccountEntryExt(0),
+        ),
+    )
+
+
+def _trust_line(account_id: str, balance: int) -> stellar_xdr.LedgerEntryData:
+    return stellar_xdr.LedgerEntryData(
+        stellar_xdr.LedgerEntryType.TRUSTLINE,
+        trust_line=stellar_xdr.TrustLineEntry(
+            _account_id(account_id),
+            stellar_xdr.TrustLineAsset(
+                stellar_xdr.AssetType.ASSET_TYPE_CREDIT_ALPHANUM4,
+                alpha_num4=stellar_xdr.AlphaNum4(
+                    stellar_xdr.AssetCode4(USDC.code.encode()),
+                    _account_id(USDC.issuer),
+                ),
+            ),
+            stellar_xdr.Int64(balance),
+            stellar_xdr.Int64(2**62),
+            stellar_xdr.Uint32(1),
+            stellar_xdr.TrustLineEntryExt(0),
+        ),
+    )
+
+
+def _changes(
+    before: stellar_xdr.LedgerEntryData, after: stellar_xdr.LedgerEntryData
+) -> list[stellar_xdr.LedgerEntryChange]:
+    change_type = stellar_xdr.LedgerEntryChangeType
+    return [
+        stellar_xdr.LedgerEntryChange(
+            change_type.LEDGER_ENTRY_STATE, state=_entry(before)
+        ),
+        stellar_xdr.LedgerEntryChange(
+            change_type.LEDGER_ENTRY_UPDATED, updated=_entry(after)
+        ),
+    ]
+
+
+def _account_changes(
+    account_id: str, balance: int, delta: int
+) -> list[stellar_xdr.LedgerEntryChange]:
+    return _changes(
+        _account(account_id, balance), _account(account_id, balance + delta)
+    )
+
+
+def _trust_line_changes(
+    account_id: str, balance: int, delta: int
+) -> list[stellar_xdr.LedgerEntryChange]:
+    return _changes(
+        _trust_line(account_id, balance), _trust_line(account_id, balance + delta)
+    )
+
+
+def generate(
+    ledgers: int = DEFAULT_LEDGERS,
+    transactions: int = DEFAULT_TRANSACTIONS,
+    accounts: int = DEFAULT_ACCOUNTS,
+    seed: int = 0,
+) -> Fixture:
+    """Generate `ledgers` ledgers of `transactions` transactions each, between
+    `accounts` accounts. The same arguments give the same fixture."""
+    generator = _Generator(accounts, seed)
+    closed_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    fixture = Fixture(Network.PUBLIC_NETWORK_PASSPHRASE, [])
+    for sequence in range(FIRST_LEDGER, FIRST_LEDGER + ledgers):
+        created_at = closed_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+        fixture.ledgers.append(
+            Ledger(
+                sequence,
+                [
+                    generator.transaction(transaction_id(sequence, order), created_at)
+                    for order in range(1, transactions + 1)
+                ],
+            )
+        )
+        closed_at += datetime.timedelta(seconds=5)
+    return fixture
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build benchmark ledger fixtures.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record ledgers of a network")
+    record_parser.add_argument("start", type=int, help="first ledger to record")
+    record_parser.add_argument("end", type=int, help="last ledger to record")
+    record_parser.add_argument("output", help="path of the .jsonl.gz fixture")
+    record_parser.add_argument(
+        "--horizon-url",
+        default="https://horizon.stellar.org",
+        help="defaults to https://horizon.stellar.org",
+    )
+    generate_parser = commands.add_parser("generate", help="generate ledgers")
+    generate_parser.add_argument("output", help="path of the .jsonl.gz fixture")
+    add_generate_arguments(generate_parser)
+    args = parser.parse_args()
+    if args.command == "record" and not 1 <= args.start <= args.end:
+        parser.error("the range must be 1 <= start <= end")
+    return args
+
+
+def add_generate_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--ledgers",
+        type=int,
+        default=DEFAULT_LEDGERS,
+        help=f"ledgers to generate, defaults to {DEFAULT_LEDGERS}",
+    )
+    parser.add_argument(
+        "--transactions",
+        type=int,
+        default=DEFAULT_TRANSACTIONS,
+        help=f"transactions per ledger, defaults to {DEFAULT_TRANSACTIONS}",
+    )
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        default=DEFAULT_ACCOUNTS,
+        help=f"accounts paying each other, defaults to {DEFAULT_ACCOUNTS}",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed, defaults to 0"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    if args.command == "record":
+        fixture = asyncio.run(record(args.start, args.end, args.horizon_url))
+    else:
+        fixture = generate(args.ledgers, args.transactions, args.accounts, args.seed)
+    save_fixture(fixture, args.output)
+    print(
+        f"saved {len(fixture.ledgers)} ledgers, {fixture.transactions} "
+        f"transactions to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,786 @@
+"""Benchmark the bot end to end, offline:
+
+    python -m bench [--fixture PATH] [--mode unified|split] [--chats 500]
+                    [--ingesters 1] [--kill-interval 0]
+                    [--env NAME=VALUE ...] [--output results.json]
+
+The bot runs as in production, `src/main.py` or the monitor and sender
+services, against a local `mongod`, a fake Horizon serving the ledgers of a
+fixture (see `bench.fixtures`, one is generated if none is given) and a fake
+Telegram Bot API. `--chats` chats watching accounts of the fixture are
+seeded first. Then:
+
+1. catch up: the first `--backlog` ledgers are closed at once, which gives
+   the ledger ingest rate, until every message is sent;
+2. live: the other ledgers close one every `--close-interval` seconds,
+   which gives the latency from the close of a ledger to the delivery of
+   its notifications by the fake Telegram.
+
+The results are printed as JSON, along with the operations counted by
+mongod (`top`), the peak memory of the bot processes and the time spent in
+each stage of ingestion, so that two runs can be compared.
+
+The notifications delivered are checked against those built from the
+fixture, so that a run with `--ingesters` monitors, one of which is killed
+every `--kill-interval` seconds, tells whether a ledger was skipped or
+notified twice.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from aiohttp import ClientError, ClientSession, web
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient  # type: ignore[import]
+from prometheus_client.parser import text_string_to_metric_families
+from pymongo.errors import OperationFailure
+
+from bench.fake_horizon import FakeHorizon
+from bench.fake_telegram import (
+    DEFAULT_CHAT_RATE,
+    DEFAULT_GLOBAL_RATE,
+    DEFAULT_LATENCY,
+    FakeTelegram,
+)
+from bench.fixtures import Fixture, add_generate_arguments, generate, load_fixture
+from src.db import Chat, MessageState, SystemInfo, get_client, get_db, utc_now
+from src.account_index import account_index
+from src.config import get_config
+from src.decoder import decode_transactions, transaction_id
+from src.horizon import close_server
+from src.monitor_ledger import load_thresholds, prepare_ledger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The processes of each mode, see README.md.
+MODES = {
+    "unified": ["src/main.py"],
+    "split": ["src/monitor_ledger.py", "src/send_notification.py"],
+}
+MONITOR = "src/monitor_ledger.py"
+# The processes ingesting ledgers.
+INGESTERS = ("src/main.py", MONITOR)
+DEFAULT_CHATS = 500
+DEFAULT_ACCOUNTS_PER_CHAT = 1
+DEFAULT_BACKLOG = 100
+DEFAULT_CLOSE_INTERVAL = 1.0
+DEFAULT_TIMEOUT = 600.0
+BOT_TOKEN = "123456:bench"
+# Seconds without a delivery after which the message queue is checked.
+IDLE_TIME = 2.0
+POLL_INTERVAL = 0.1
+# Seconds given to the bot to stop gracefully.
+STOP_TIMEOUT = 20.0
+# Operations counted by `top` for each collection.
+TOP_FIELDS = ("insert", "queries", "getmore", "update", "remove", "commands")
+
+
+class BotProcess:
+    def __init__(
+        self,
+        script: str,
+        env: dict[str, str],
+        log_dir: str,
+        name: Optional[str] = None,
+    ) -> None:
+        self.script = script
+        self.name = name or os.path.splitext(os.path.basename(script))[0]
+        self.metrics_port = free_port()
+        self.log_path = os.path.join(log_dir, f"{self.name}.log")
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, script)],
+                env={**env, "METRICS_PORT": str(self.metrics_port)},
+                cwd=ROOT,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+    def check(self) -> None:
+        code = self.process.poll()
+        if code is not None:
+            raise RuntimeError(f"{self.name} exited with {code}, see {self.log_path}")
+
+    def peak_rss(self) -> Optional[float]:
+        """Return the peak resident memory of the process in MB, on Linux."""
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+    def stop(self) -> None:
+        if self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{self.name} did not stop in time, killed it.")
+            self.process.kill()
+            self.process.wait()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_server(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+async def start_mongod(
+    binary: str, tmp: str, log_dir: str
+) -> tuple[subprocess.Popen, str]:
+    path = shutil.which(binary)
+    if path is None:
+        raise SystemExit(f"{binary} not found, install MongoDB or pass --mongodb-uri")
+    port = free_port()
+    db_path = os.path.join(tmp, "db")
+    os.mkdir(db_path)
+    process = subprocess.Popen(
+        [
+            path,
+            "--dbpath",
+            db_path,
+            "--port",
+            str(port),
+            "--bind_ip",
+            "127.0.0.1",
+            "--logpath",
+            os.path.join(log_dir, "mongod.log"),
+        ]
+    )
+    uri = f"mongodb://127.0.0.1:{port}"
+    client = AsyncIOMotorClient(uri, serverSelectionTimeoutMS=500)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            await client.admin.command("ping")
+            break
+        except Exception:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"mongod did not start, see {log_dir}/mongod.log")
+            await asyncio.sleep(0.2)
+    client.close()
+    return process, uri
+
+
+def involved_accounts(fixture: Fixture) -> list[str]:
+    """Return the accounts paying or paid by the operations of `fixture`."""
+    records = decode_transactions(
+        [
+            (transaction_id(ledger.sequence, order), r["envelope_xdr"])
+            for ledger in fixture.ledgers
+            for order, r in enumerate(ledger.records, 1)
+        ],
+        fixture.network_passphrase,
+        {},
+    )
+    return sorted({r.from_ for r in records} | {r.to for r in records})
+
+
+async def seed_chats(
+    fixture: Fixture, chats: int, accounts_per_chat: int, seed: int
+) -> int:
+    """Seed the chats and the processed ledger, and return the number of
+    watched accounts."""
+    accounts = involved_accounts(fixture)
+    rng = random.Random(seed)
+    documents = [
+        Chat(
+            chat_id=chat_id,
+            account_ids=rng.sample(accounts, min(accounts_per_chat, len(accounts))),
+            updated_time=utc_now(),
+        ).dict()
+        for chat_id in range(1, chats + 1)
+    ]
+    if documents:
+        await get_db().chat.insert_many(documents)
+    await Chat.create_indexes()
+    await SystemInfo.update_processed_ledger(fixture.first_ledger - 1)
+    return len({a for document in documents for a in document["account_ids"]})
+
+
+async def mongo_top() -> Optional[dict[str, dict[str, int]]]:
+    """Return the operations counted by mongod for each collection of the
+    database, `None` if `top` is not allowed."""
+    try:
+        totals = (await get_client().admin.command("top"))["totals"]
+    except OperationFailure as e:
+        logger.warning(f"mongod operations not counted: {e}")
+        return None
+    prefix = f"{get_db().name}."
+    return {
+        namespace[len(prefix) :]: {
+            field: totals[namespace][field]["count"] for field in TOP_FIELDS
+        }
+        for namespace in totals
+        if namespace.startswith(prefix)
+    }
+
+
+def top_difference(
+    before: dict[str, dict[str, int]], after: dict[str, dict[str, int]]
+) -> dict:
+    collections = {}
+    for name, counts in after.items():
+        previous = before.get(name, {})
+        difference = {
+            field: count - previous.get(field, 0) for field, count in counts.items()
+        }
+        if any(difference.values()):
+            collections[name] = difference
+    return {
+        "total": sum(sum(counts.values()) for counts in collections.values()),
+        "collections": collections,
+    }
+
+
+async def scrape(session: ClientSession, port: int) -> dict[str, float]:
+    """Return the samples of the metrics served on `port`, keyed by name and
+    labels."""
+    async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+        text = await response.text()
+    samples = {}
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            key = sample.name + "".join(
+                f"[{value}]" for value in sample.labels.values()
+            )
+            samples[key] = sample.value
+    return samples
+
+
+def percentiles(values: list[float]) -> dict[str, Optional[float]]:
+    values = sorted(values)
+
+    def percentile(p: float) -> Optional[float]:
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(p * len(values)))], 3)
+
+    return {
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": percentile(1.0),
+    }
+
+
+class Benchmark:
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        fixture: Fixture,
+        horizon: FakeHorizon,
+        telegram: FakeTelegram,
+        processes: list[BotProcess],
+        env: dict[str, str],
+        log_dir: str,
+    ) -> None:
+        self.args = args
+        self.fixture = fixture
+        self.horizon = horizon
+        self.telegram = telegram
+        self.processes = processes
+        # Of the monitors started in place of killed ones.
+        self.env = env
+        self.log_dir = log_dir
+        self.session = ClientSession()
+        self.deadline = time.monotonic() + args.timeout
+        self.mongo_checks = 0
+        self.kills = 0
+
+    def check(self, what: str) -> None:
+        for process in self.processes:
+            process.check()
+        if time.monotonic() > self.deadline:
+            raise TimeoutError(f"timed out waiting for {what}")
+
+    async def wait_until(self, condition: Callable[[], bool], what: str) -> None:
+        while not condition():
+            self.check(what)
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def processed_ledger(self) -> float:
+        """Return the last ledger processed, as reported by the ingesters.
+        Several monitors report the ledger up to which all of them processed
+        every ledger, see `src.monitor_ledger.advance_processed_ledger`."""
+        processed_ledger = 0.0
+        for process in self.processes:
+            if process.script not in INGESTERS:
+                continue
+            try:
+                samples = await scrape(self.session, process.metrics_port)
+            except ClientError:
+                # The metrics server is not up yet.
+                continue
+            processed_ledger = max(
+                processed_ledger, samples.get("stellar_bot_processed_ledger", 0)
+            )
+        return processed_ledger
+
+    async def wait_processed(self, ledger: int) -> float:
+        """Wait until `ledger` is processed, and return when it was."""
+        while True:
+            self.check(f"ledger {ledger}")
+            if await self.processed_ledger() >= ledger:
+                return time.monotonic()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def wait_drained(self, since: float) -> Optional[dict]:
+        """Wait until every queued message is sent, and return the mongod
+        operations counted right before the check telling so."""
+        while True:
+            await self.wait_until(
+                lambda: time.monotonic() - max(self.telegram.last_delivery_at, since)
+                >= IDLE_TIME,
+                "the deliveries",
+            )
+            top = await mongo_top()
+            self.mongo_checks += 1
+            unsent = await get_db().message.count_documents(
+                {"state": {"$ne": MessageState.SENT}}
+            )
+            if unsent == 0:
+                return top
+            since = time.monotonic()
+
+    async def kill_monitors(self, last_ledger: int) -> None:
+        """Kill a monitor every `--kill-interval` seconds, in the middle of the
+        ledgers it processes, and start another one in its place, until
+        `last_ledger` is processed."""
+        while True:
+            await asyncio.sleep(self.args.kill_interval)
+            if await self.processed_ledger() >= last_ledger:
+                return
+            monitor = random.choice(
+                [process for process in self.processes if process.script == MONITOR]
+            )
+            self.processes.remove(monitor)
+            monitor.kill()
+            self.kills += 1
+            self.processes.append(
+                BotProcess(
+                    MONITOR, self.env, self.log_dir, f"monitor_ledger_r{self.kills}"
+                )
+            )
+
+    def check_notifications(self, expected: Counter[tuple[int, str]]) -> dict:
+        """Compare the notifications delivered for each chat and transaction
+        to those `expected`."""
+        delivered = Counter(
+            (delivery.chat_id, tx_hash)
+            for delivery in self.telegram.deliveries
+            for tx_hash in delivery.tx_hashes
+        )
+        return {
+            "expected": sum(expected.values()),
+            "missing": sum((expected - delivered).values()),
+            "duplicated": sum((delivered - expected).values()),
+        }
+
+    def notifications(self, first: int, last: int) -> list[tuple[float, int]]:
+        """Return the delivery time and ledger of the notifications of
+        ledgers [first, last]."""
+        ledgers = {
+            r["hash"]: ledger.sequence
+            for ledger in self.fixture.ledgers
+            if first <= ledger.sequence <= last
+            for r in ledger.records
+        }
+        return [
+            (delivery.time, ledgers[tx_hash])
+            for delivery in self.telegram.deliveries
+            for tx_hash in delivery.tx_hashes
+            if tx_hash in ledgers
+        ]
+
+    async def run(self, results: dict) -> None:
+        stream = self.args.env_overrides.get("INGEST_MODE", "").lower() == "stream"
+        top_before = top = await mongo_top()
+        await self.wait_until(lambda: self.horizon.started_at is not None, "the bot")
+        killer = None
+        if self.args.kill_interval:
+            killer = asyncio.create_task(
+                self.kill_monitors(self.fixture.last_ledger - stream)
+            )
+        try:
+            top = await self.run_stages(results, top)
+        finally:
+            if killer is not None:
+                killer.cancel()
+                results["kills"] = self.kills
+        await self.collect(results, top_before, top)
+        results["check"] = self.check_notifications(
+            await expected_notifications(self.fixture)
+        )
+        logger.info(f"check: {results['check']}")
+        if results["check"]["missing"] or results["check"]["duplicated"]:
+            raise RuntimeError(f"notifications not delivered once: {results['check']}")
+
+    async def run_stages(self, results: dict, top: Optional[dict]) -> Optional[dict]:
+        """Catch up, then close the live ledgers, and return the mongod
+        operations counted once their messages are sent."""
+        assert self.horizon.started_at is not None
+        stream = self.args.env_overrides.get("INGEST_MODE", "").lower() == "stream"
+        backlog_end = self.horizon.backlog_end
+        last_ledger = self.fixture.last_ledger
+
+        if self.horizon.backlog:
+            # The stream cannot tell its last ledger is complete until a
+            # transaction of the next one arrives.
+            processed_at = await self.wait_processed(backlog_end - stream)
+            seconds = processed_at - self.horizon.started_at
+            top = await self.wait_drained(processed_at)
+            results["catch_up"] = {
+                "ledgers": self.horizon.backlog,
+                "seconds": round(seconds, 3),
+                "ledgers_per_second": round(self.horizon.backlog / seconds, 3),
+                "notifications": len(
+                    self.notifications(self.fixture.first_ledger, backlog_end)
+                ),
+                "drain_seconds": round(
+                    max(self.telegram.last_delivery_at, processed_at)
+                    - self.horizon.started_at,
+                    3,
+                ),
+            }
+            logger.info(f"catch up: {results['catch_up']}")
+
+        if last_ledger > backlog_end:
+            self.horizon.start_live()
+            processed_at = await self.wait_processed(last_ledger - stream)
+            top = await self.wait_drained(processed_at)
+            live = self.notifications(backlog_end + 1, last_ledger)
+            results["live"] = {
+                "ledgers": last_ledger - backlog_end,
+                "notifications": len(live),
+                "latency_seconds": percentiles(
+                    [
+                        delivered_at - self.horizon.closed_at(ledger)
+                        for delivered_at, ledger in live
+                    ]
+                ),
+            }
+            logger.info(f"live: {results['live']}")
+        return top
+
+    async def collect(
+        self, results: dict, top_before: Optional[dict], top: Optional[dict]
+    ) -> None:
+        results["telegram"] = {
+            "messages": len(self.telegram.deliveries),
+            "notifications": sum(len(d.tx_hashes) for d in self.telegram.deliveries),
+            "rejected": self.telegram.rejected,
+            "requests": self.telegram.requests,
+        }
+        results["horizon_requests"] = dict(self.horizon.requests)
+        if top_before is not None and top is not None:
+            results["mongo_ops"] = top_difference(top_before, top)
+        # Counts of unsent messages by the harness, all but the last of which
+        # are in `mongo_ops`.
+        results["harness_mongo_checks"] = self.mongo_checks
+        results["peak_rss_mb"] = {
+            process.name: process.peak_rss() for process in self.processes
+        }
+        samples: dict[str, float] = {}
+        for process in self.processes:
+            samples.update(await scrape(self.session, process.metrics_port))
+        results["stage_seconds"] = {
+            stage: {
+                "count": samples.get(f"stellar_bot_stage_seconds_count[{stage}]"),
+                "sum": samples.get(f"stellar_bot_stage_seconds_sum[{stage}]"),
+            }
+            for stage in ("fetch", "decode", "resolve", "insert")
+        }
+        results["send_seconds"] = {
+            "count": samples.get("stellar_bot_send_seconds_count"),
+            "sum": samples.get("stellar_bot_send_seconds_sum"),
+        }
+        results["retry_after"] = samples.get("stellar_bot_retry_after_total")
+
+    async def close(self) -> None:
+        await self.session.close()
+
+
+async def expected_notifications(fixture: Fixture) -> Counter[tuple[int, str]]:
+    """Count the notifications of each transaction for each chat, built from
+    the fixture with the settings of the bot."""
+    await load_thresholds()
+    if get_config().account_index:
+        await account_index.load()
+    expected: Counter[tuple[int, str]] = Counter()
+    for ledger in fixture.ledgers:
+        events, messages = await prepare_ledger(ledger.sequence)
+        tx_hashes = {event.id: event.tx_hash for event in events}
+        expected.update(
+            (message.chat_id, tx_hashes[message.event_ids[0]]) for message in messages
+        )
+    await close_server()
+    return expected
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args: argparse.Namespace, mongodb_uri: str, log_dir: str) -> dict:
+    if args.fixture:
+        fixture = load_fixture(args.fixture)
+    else:
+        logger.info("generating a fixture...")
+        fixture = generate(args.ledgers, args.transactions, args.accounts, args.seed)
+    backlog = min(args.backlog, len(fixture.ledgers))
+    horizon = FakeHorizon(fixture, backlog, args.close_interval)
+    telegram = FakeTelegram(args.tg_global_rate, args.tg_chat_rate, args.tg_latency)
+    horizon_runner, horizon_url = await start_server(horizon.app())
+    telegram_runner, telegram_url = await start_server(telegram.app())
+
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "MONGODB_URI": mongodb_uri,
+        "DB_NAME": f"bench_{os.getpid()}_{int(time.time())}",
+        "BOT_TOKEN": BOT_TOKEN,
+        "HORIZON_URL": horizon_url,
+        "TELEGRAM_API_URL": telegram_url,
+        "NETWORK_PASSPHRASE": fixture.network_passphrase,
+        **args.env_overrides,
+    }
+    # The chats are seeded with the models of the bot.
+    os.environ.update(env)
+    results: dict = {
+        "commit": git_commit(),
+        "options": {
+            "mode": args.mode,
+            "ingesters": args.ingesters,
+            "kill_interval": args.kill_interval,
+            "chats": args.chats,
+            "accounts_per_chat": args.accounts_per_chat,
+            "backlog": backlog,
+            "close_interval": args.close_interval,
+            "env": args.env_overrides,
+            "tg_global_rate": args.tg_global_rate,
+            "tg_chat_rate": args.tg_chat_rate,
+            "tg_latency": args.tg_latency,
+        },
+        "fixture": {
+            "path": args.fixture,
+            "ledgers": len(fixture.ledgers),
+            "transactions": fixture.transactions,
+        },
+    }
+    processes: list[BotProcess] = []
+    try:
+        results["watched_accounts"] = await seed_chats(
+            fixture, args.chats, args.accounts_per_chat, args.seed
+        )
+        processes = [BotProcess(script, env, log_dir) for script in MODES[args.mode]]
+        # The first ingester of the mode is one of them.
+        processes += [
+            BotProcess(MONITOR, env, log_dir, f"monitor_ledger_{i}")
+            for i in range(1, args.ingesters)
+        ]
+        bench = Benchmark(args, fixture, horizon, telegram, processes, env, log_dir)
+        try:
+            await bench.run(results)
+        except (TimeoutError, RuntimeError) as e:
+            logger.error(e)
+            results["error"] = str(e)
+        finally:
+            await bench.close()
+    finally:
+        for process in processes:
+            process.stop()
+        if not args.keep_db:
+            await get_client().drop_database(env["DB_NAME"])
+        await horizon_runner.cleanup()
+        await telegram_runner.cleanup()
+    return results
+
+
+async def run(args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        log_dir = args.log_dir or tmp
+        os.makedirs(log_dir, exist_ok=True)
+        if args.mongodb_uri:
+            return await benchmark(args, args.mongodb_uri, log_dir)
+        mongod, mongodb_uri = await start_mongod(args.mongod, tmp, log_dir)
+        try:
+            return await benchmark(args, mongodb_uri, log_dir)
+        finally:
+            mongod.terminate()
+            mongod.wait()
+
+
+def environment_variable(value: str) -> tuple[str, str]:
+    name, sep, setting = value.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE: {value}")
+    return name, setting
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m bench", description="Benchmark the bot offline."
+    )
+    parser.add_argument(
+        "--fixture",
+        help="ledgers to serve, see bench/fixtures.py, generated by default",
+    )
+    add_generate_arguments(parser)
+    parser.add_argument(
+        "--mode",
+        choices=MODES,
+        default="unified",
+        help="run src/main.py, or the monitor and sender services, defaults to "
+        "unified",
+    )
+    parser.add_argument(
+        "--ingesters",
+        type=int,
+        default=1,
+        help="monitors ingesting the ledgers together, those beyond the first "
+        "run src/monitor_ledger.py, defaults to 1",
+    )
+    parser.add_argument(
+        "--kill-interval",
+        type=float,
+        default=0,
+        help="kill a src/monitor_ledger.py process every this many seconds "
+        "and start another, until the last ledger is processed, e.g. with "
+        "--env INGEST_LEASE=5, not killed by default",
+    )
+    parser.add_argument(
+        "--chats",
+        type=int,
+        default=DEFAULT_CHATS,
+        help=f"chats to seed, defaults to {DEFAULT_CHATS}",
+    )
+    parser.add_argument(
+        "--accounts-per-chat",
+        type=int,
+        default=DEFAULT_ACCOUNTS_PER_CHAT,
+        help=f"accounts of the fixture watched by each chat, defaults to "
+        f"{DEFAULT_ACCOUNTS_PER_CHAT}",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=DEFAULT_BACKLOG,
+        help=f"ledgers to catch up on, the others close while the bot runs, "
+        f"defaults to {DEFAULT_BACKLOG}",
+    )
+    parser.add_argument(
+        "--close-interval",
+        type=float,
+        default=DEFAULT_CLOSE_INTERVAL,
+        help=f"seconds between two live ledgers, defaults to "
+        f"{DEFAULT_CLOSE_INTERVAL}",
+    )
+    parser.add_argument(
+        "--env",
+        dest="env_overrides",
+        nargs="+",
+        metavar="NAME=VALUE",
+        type=environment_variable,
+        default=[],
+        help="settings of the bot, e.g. NOTIFY_FROM_META=true INGEST_MODE=stream",
+    )
+    parser.add_argument(
+        "--tg-global-rate",
+        type=float,
+        default=DEFAULT_GLOBAL_RATE,
+        help=f"messages per second accepted by the fake Telegram, defaults to "
+        f"{DEFAULT_GLOBAL_RATE}",
+    )
+    parser.add_argument(
+        "--tg-chat-rate",
+        type=float,
+        default=DEFAULT_CHAT_RATE,
+        help=f"messages per second accepted for a chat, defaults to "
+        f"{DEFAULT_CHAT_RATE}",
+    )
+    parser.add_argument(
+        "--tg-latency",
+        type=float,
+        default=DEFAULT_LATENCY,
+        help=f"seconds the fake Telegram takes to answer, defaults to "
+        f"{DEFAULT_LATENCY}",
+    )
+    parser.add_argument(
+        "--mongodb-uri",
+        help="use this MongoDB instead of starting mongod, the benchmark "
+        "database is dropped at the end",
+    )
+    parser.add_argument(
+        "--mongod", default="mongod", help="mongod binary, defaults to mongod"
+    )
+    parser.add_argument("--keep-db", action="store_true", help="keep the database")
+    parser.add_argument(
+        "--log-dir", help="where to keep the logs of the bot, discarded by default"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"seconds before giving up, defaults to {DEFAULT_TIMEOUT}",
+    )
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+    args.env_overrides = dict(args.env_overrides)
+    if args.backlog < 0 or args.close_interval < 0 or args.chats < 0:
+        parser.error("--backlog, --close-interval and --chats must be positive")
+    if args.ingesters < 1 or args.kill_interval < 0:
+        parser.error("--ingesters must be at least 1 and --kill-interval positive")
+    if args.kill_interval and args.mode == "unified" and args.ingesters == 1:
+        parser.error("--kill-interval needs --mode split or --ingesters above 1")
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if "error" in results:
+        sys.exit(1)
@@ -0,0 +1,943 @@
+"""Benchmarks of single stages of the bot, offline:
+
+    python -m bench.micro resolve [--ledgers 20] [--chats 500] [--idle-chats 10000]
+    python -m bench.micro horizon [--requests 2000] [--concurrency 20] [--latency 0.005]
+    python -m bench.micro decode [--ledgers 40] [--workers 0 1 4 8] [--window 10]
+    python -m bench.micro claim [--messages 20000] [--consumers 1 4 16] [--batch 100]
+    python -m bench.micro digest [--chats 100] [--waves 5] [--digest-interval 3]
+    python -m bench.micro parse [--ledgers 40] [--repeat 3]
+    python -m bench.micro meta [--ledgers 40] [--watched 500] [--repeat 3]
+    python -m bench.micro render [--ledgers 10] [--chats 1 10 100] [--batch 100]
+
+Where `python -m bench` runs the whole bot, each command here times one
+stage on ledgers generated by `bench.fixtures`, and prints the results as
+JSON:
+
+- `resolve`: resolving the chats watching the accounts of each ledger, with
+  a query per operation, a query per ledger and the account index.
+- `horizon`: requests to a stub Horizon through the shared, pooled server,
+  and through a server per request as the call sites did before.
+- `decode`: decoding the envelopes of each ledger with `monitor_ledger.decode`,
+  in the process or in pools of worker processes.
+- `claim`: concurrent senders draining the message queue with
+  `Message.claim`, and one message at a time as it did before.
+- `digest`: a burst of notifications to many chats sent to a fake Telegram,
+  right away and gathered in digests.
+- `parse`: decoding envelopes with `decode_transactions`, which reads them
+  from the XDR, and by parsing whole envelopes with the SDK.
+- `meta`: reading the balance changes of watched accounts from transaction
+  meta, in two passes as the monitor does and by decoding every meta.
+- `render`: the bytes messages are stored in, with their text as before
+  events were and referencing events, and the messages per second the
+  sender renders from events read from MongoDB or already cached.
+
+Commands reading MongoDB start a local `mongod`, unless `--mongodb-uri` is
+given; their database is dropped at the end.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import bson
+from aiohttp import web
+from bson import ObjectId
+from pymongo import ReturnDocument
+from stellar_sdk import (
+    AiohttpClient,
+    FeeBumpTransactionEnvelope,
+    Network,
+    ServerAsync,
+    parse_transaction_envelope_from_xdr,
+)
+
+from bench.fixtures import (
+    FIRST_LEDGER,
+    Fixture,
+    Ledger,
+    add_generate_arguments,
+    generate,
+)
+from bench.fake_telegram import FakeTelegram
+from bench.harness import (
+    BOT_TOKEN,
+    involved_accounts,
+    mongo_top,
+    seed_chats,
+    start_mongod,
+    start_server,
+    top_difference,
+)
+from src import horizon, monitor_ledger
+from src.account_index import AccountIndex
+from src.config import get_config
+from src.db import (
+    Chat,
+    Event,
+    Message,
+    MessageState,
+    get_client,
+    get_db,
+    utc_now,
+)
+from src.decoder import (
+    DESCRIBERS,
+    OperationRecord,
+    decode_transactions,
+    transaction_id,
+)
+from src.meta import decode_balance_changes, find_accounts
+from src.render import RENDER_CACHE_SIZE, Renderer, render_event
+from src.send_notification import create_dispatcher
+
+DEFAULT_LEDGERS = 20
+DEFAULT_CHATS = 500
+DEFAULT_IDLE_CHATS = 10000
+DEFAULT_REQUESTS = 2000
+DEFAULT_CONCURRENCY = 20
+DEFAULT_LATENCY = 0.005
+DEFAULT_DECODE_LEDGERS = 40
+DEFAULT_DECODE_WORKERS = [0, 1, 4, 8]
+DEFAULT_WINDOW = 10
+DEFAULT_MESSAGES = 20000
+DEFAULT_CONSUMERS = [1, 4, 16]
+DEFAULT_BATCH = 100
+DEFAULT_BURST_CHATS = 100
+DEFAULT_WAVES = 5
+DEFAULT_WAVE_INTERVAL = 0.5
+DEFAULT_DIGEST_INTERVAL = 3
+DEFAULT_REPEAT = 3
+DEFAULT_WATCHED = 500
+DEFAULT_RENDER_LEDGERS = 10
+DEFAULT_CHATS_PER_EVENT = [1, 10, 100]
+
+
+def ledger_transactions(ledger: Ledger) -> list[tuple[int, str]]:
+    return [
+        (transaction_id(ledger.sequence, order), record["envelope_xdr"])
+        for order, record in enumerate(ledger.records, 1)
+    ]
+
+
+def fixture_of(args: argparse.Namespace) -> Fixture:
+    return generate(args.ledgers, args.transactions, args.accounts, args.seed)
+
+
+def configure(**env: str) -> None:
+    """Configure the bot from `env`, before its config is first read."""
+    os.environ.update(
+        {
+            "MONGODB_URI": "mongodb://127.0.0.1:27017",
+            "BOT_TOKEN": BOT_TOKEN,
+            "HORIZON_URL": "http://127.0.0.1:8000",
+            "NETWORK_PASSPHRASE": Network.PUBLIC_NETWORK_PASSPHRASE,
+            **env,
+        }
+    )
+
+
+@asynccontextmanager
+async def database(args: argparse.Namespace) -> AsyncIterator[None]:
+    """Point the bot at a database of its own, on `--mongodb-uri` or on a
+    local mongod."""
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        mongod = None
+        mongodb_uri = args.mongodb_uri
+        if mongodb_uri is None:
+            mongod, mongodb_uri = await start_mongod(args.mongod, tmp, tmp)
+        configure(
+            MONGODB_URI=mongodb_uri,
+            DB_NAME=f"bench_micro_{os.getpid()}_{int(time.time())}",
+        )
+        try:
+            yield
+        finally:
+            await get_client().drop_database(get_db().name)
+            if mongod is not None:
+                mongod.terminate()
+                mongod.wait()
+
+
+async def time_ledgers(
+    ledgers: list[list[OperationRecord]],
+    stage: Callable[[list[OperationRecord]], Awaitable[object]],
+) -> dict:
+    """Run `stage` on the records of each ledger, and return the time and
+    the MongoDB operations it took per ledger."""
+    before = await mongo_top()
+    started_at = time.perf_counter()
+    for records in ledgers:
+        await stage(records)
+    seconds = time.perf_counter() - started_at
+    after = await mongo_top()
+    result: dict = {"ms_per_ledger": round(1000 * seconds / len(ledgers), 3)}
+    if before is not None and after is not None:
+        result["operations_per_ledger"] = top_difference(before, after)["total"] / len(
+            ledgers
+        )
+    return result
+
+
+def ledger_accounts(records: list[OperationRecord]) -> list[str]:
+    return list({r.from_ for r in records} | {r.to for r in records})
+
+
+async def resolve(args: argparse.Namespace) -> dict:
+    fixture = fixture_of(args)
+    ledgers = [
+        decode_transactions(ledger_transactions(ledger), fixture.network_passphrase, {})
+        for ledger in fixture.ledgers
+    ]
+    async with database(args):
+        watched = await seed_chats(fixture, args.chats, 1, args.seed)
+        # Chats watching accounts the ledgers never pay.
+        if args.idle_chats:
+            await get_db().chat.insert_many(
+                [
+                    Chat(
+                        chat_id=-chat_id,
+                        account_ids=[f"IDLE{chat_id}"],
+                        updated_time=utc_now(),
+                    ).dict()
+                    for chat_id in range(1, args.idle_chats + 1)
+                ]
+            )
+        index = AccountIndex()
+        await index.load()
+
+        async def per_operation(records: list[OperationRecord]) -> None:
+            # As monitor_ledger did before the chats of a ledger were
+            # resolved at once.
+            for record in records:
+                await Chat.get_chat_ids_by_enable([record.from_, record.to])
+
+        async def per_ledger(records: list[OperationRecord]) -> None:
+            await Chat.get_chat_ids_by_accounts(ledger_accounts(records))
+
+        async def indexed(records: list[OperationRecord]) -> None:
+            index.get_chat_ids_by_accounts(ledger_accounts(records))
+
+        return {
+            "ledgers": len(ledgers),
+            "operations_per_ledger": sum(map(len, ledgers)) / len(ledgers),
+            "chats": args.chats + args.idle_chats,
+            "watched_accounts": watched,
+            "per_operation": await time_ledgers(ledgers, per_operation),
+            "per_ledger": await time_ledgers(ledgers, per_ledger),
+            "account_index": await time_ledgers(ledgers, indexed),
+        }
+
+
+class StubHorizon:
+    """Answer the root of Horizon after `latency` seconds, and record the
+    client address of each request."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.peers: set[tuple[str, int]] = set()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.root)
+        return app
+
+    async def root(self, request: web.Request) -> web.Response:
+        assert request.transport is not None
+        self.peers.add(request.transport.get_extra_info("peername")[:2])
+        await asyncio.sleep(self.latency)
+        return web.json_response({"history_latest_ledger": FIRST_LEDGER})
+
+
+async def time_requests(
+    request: Callable[[], Awaitable[Any]], requests: int, concurrency: int
+) -> dict:
+    """Make `requests` requests, `concurrency` at a time, and return their
+    rate."""
+    remaining = iter(range(requests))
+
+    async def client() -> None:
+        for _ in remaining:
+            await request()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return {"requests_per_sec": round(requests / (time.perf_counter() - started_at))}
+
+
+async def per_request_root() -> dict[str, Any]:
+    # As the call sites did before they shared a server.
+    async with ServerAsync(get_config().horizon_url, client=AiohttpClient()) as server:
+        return await server.root().call()
+
+
+async def horizon_requests(args: argparse.Namespace) -> dict:
+    stub = StubHorizon(args.latency)
+    runner, url = await start_server(stub.app())
+    configure(HORIZON_URL=url)
+    results = {"requests": args.requests, "concurrency": args.concurrency}
+    try:
+        for name, request in (
+            ("shared", horizon.get_root),
+            ("per_request", per_request_root),
+        ):
+            stub.peers.clear()
+            results[name] = await time_requests(
+                request, args.requests, args.concurrency
+            )
+            results[name]["connections"] = len(stub.peers)
+    finally:
+        await horizon.close_server()
+        await runner.cleanup()
+    return results
+
+
+async def decode_ledgers(
+    ledgers: list[list[tuple[int, str]]], window: int
+) -> list[list[OperationRecord]]:
+    """Decode `window` ledgers at a time, as `process_ledgers` does."""
+    records = []
+    for first in range(0, len(ledgers), window):
+        records += await asyncio.gather(
+            *map(monitor_ledger.decode, ledgers[first : first + window])
+        )
+    return records
+
+
+async def decode(args: argparse.Namespace) -> dict:
+    fixture = fixture_of(args)
+    ledgers = [ledger_transactions(ledger) for ledger in fixture.ledgers]
+    configure()
+    config = get_config()
+    results: dict = {"envelopes": fixture.transactions, "window": args.window}
+    expected = None
+    for workers in args.workers:
+        config.decode_workers = workers
+        try:
+            # Spawn the workers and import the decoder in each of them.
+            await decode_ledgers(ledgers[:1] * max(workers, 1), workers or 1)
+            started_at = time.perf_counter()
+            records = await decode_ledgers(ledgers, args.window)
+            seconds = time.perf_counter() - started_at
+        finally:
+            if monitor_ledger._decode_pool is not None:
+                monitor_ledger._decode_pool.shutdown()
+                monitor_ledger._decode_pool = None
+        if expected is None:
+            expected = records
+        assert records == expected, f"{workers} workers decoded other records"
+        results[f"workers_{workers}"] = {
+            "envelopes_per_sec": round(fixture.transactions / seconds)
+        }
+    return results
+
+
+async def claim_one_by_one(worker_id: str, limit: int, lease: float) -> list[Message]:
+    # As `Message.claim` did before it claimed a batch at once.
+    messages = []
+    for _ in range(limit):
+        record = await get_db().message.find_one_and_update(
+            {
+                "state": MessageState.PENDING,
+                "available_time": {"$not": {"$gt": utc_now()}},
+            },
+            {
+                "$set": {
+                    "state": MessageState.CLAIMED,
+                    "worker_id": worker_id,
+                    "lease_expires": utc_now() + datetime.timedelta(seconds=lease),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", 1), ("order_key", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if record is None:
+            break
+        messages.append(Message(**record))
+    return messages
+
+
+async def drain(
+    claim: Callable[[str, int, float], Awaitable[list[Message]]],
+    messages: int,
+    consumers: int,
+    batch: int,
+) -> dict:
+    """Queue `messages` messages, and return the rate at which `consumers`
+    concurrent senders claim them `batch` at a time."""
+    await get_db().message.delete_many({})
+    for first in range(0, messages, 10000):
+        await Message.new_messages(
+            [
+                Message(chat_id=order_key % 1000, order_key=order_key)
+                for order_key in range(first, min(first + 10000, messages))
+            ]
+        )
+    claimed: list = []
+
+    async def consumer(worker: int) -> None:
+        while batch_messages := await claim(f"bench-{worker}", batch, 60.0):
+            claimed.extend(message.id for message in batch_messages)
+
+    before = await mongo_top()
+    started_at = time.perf_counter()
+    await asyncio.gather(*map(consumer, range(consumers)))
+    seconds = time.perf_counter() - started_at
+    after = await mongo_top()
+    assert len(claimed) == len(set(claimed)) == messages, "claims overlap"
+    result: dict = {"messages_per_sec": round(messages / seconds)}
+    if before is not None and after is not None:
+        result["operations_per_message"] = round(
+            top_difference(before, after)["total"] / messages, 3
+        )
+    return result
+
+
+async def claim(args: argparse.Namespace) -> dict:
+    results: dict = {"messages": args.messages, "batch": args.batch}
+    async with database(args):
+        await Message.create_indexes()
+        for name, claim_messages in (
+            ("batched", Message.claim),
+            ("one_by_one", claim_one_by_one),
+        ):
+            results[name] = {
+                f"consumers_{consumers}": await drain(
+                    claim_messages, args.messages, consumers, args.batch
+                )
+                for consumers in args.consumers
+            }
+    return results
+
+
+async def send_burst(args: argparse.Namespace, telegram: FakeTelegram) -> dict:
+    """Queue a message to each chat per wave, and return how many Telegram
+    messages the dispatcher sent them in, and how long it took."""
+    await get_db().message.delete_many({})
+    telegram.deliveries.clear()
+    telegram.rejected = 0
+    dispatcher = create_dispatcher()
+    task = asyncio.create_task(dispatcher.run())
+    started_at = time.monotonic()
+    order_key = 0
+    for _ in range(args.waves):
+        messages = []
+        for chat_id in range(1, args.chats + 1):
+            order_key += 1
+            messages.append(
+                Message(
+                    chat_id=chat_id,
+                    content=f"Notification {order_key}",
+                    tx_hash=f"{order_key:064x}",
+                    order_key=order_key,
+                )
+            )
+        await Message.new_messages(messages)
+        await asyncio.sleep(args.wave_interval)
+    while (await Message.count_by_state())[MessageState.SENT] < order_key:
+        await asyncio.sleep(0.2)
+    dispatcher.stopping.set()
+    await task
+    return {
+        "telegram_messages": len(telegram.deliveries),
+        "seconds": round(telegram.last_delivery_at - started_at, 3),
+        "rejected": telegram.rejected,
+    }
+
+
+async def digest(args: argparse.Namespace) -> dict:
+    # With the limits of Telegram.
+    telegram = FakeTelegram()
+    runner, url = await start_server(telegram.app())
+    results: dict = {"notifications": args.chats * args.waves}
+    try:
+        async with database(args):
+            get_config().telegram_api_url = url
+            await Message.create_indexes()
+            await get_db().chat.insert_many(
+                [
+                    Chat(chat_id=chat_id, account_ids=[], updated_time=utc_now()).dict()
+                    for chat_id in range(1, args.chats + 1)
+                ]
+            )
+            for name, digest_interval in (
+                ("immediate", 0),
+                ("digest", args.digest_interval),
+            ):
+                await get_db().chat.update_many(
+                    {}, {"$set": {"digest_interval": digest_interval}}
+                )
+                results[name] = await send_burst(args, telegram)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def decode_with_sdk(
+    transactions: list[tuple[int, str]], network_passphrase: str
+) -> list[tuple[int, str, str, str, str]]:
+    # As the decoder did before it read envelopes from the XDR: every
+    # envelope is built into SDK objects, and hashed by packing it again.
+    records = []
+    for tx_id, envelope in transactions:
+        te = parse_transaction_envelope_from_xdr(envelope, network_passphrase)
+        if isinstance(te, FeeBumpTransactionEnvelope):
+            tx = te.transaction.inner_transaction_envelope.transaction
+        else:
+            tx = te.transaction
+        tx_hash = None
+        for index, op in enumerate(tx.operations):
+            describe = DESCRIBERS.get(type(op))
+            if describe is None:
+                continue
+            description = describe(op, op.source or tx.source)
+            if tx_hash is None:
+                tx_hash = te.hash_hex()
+            to = description.to
+            records.append(
+                (
+                    tx_id | (index + 1),
+                    description.type,
+                    tx_hash,
+                    description.from_.account_id,
+                    to if isinstance(to, str) else to.account_id,
+                )
+            )
+    return records
+
+
+def best_rate(decode: Callable[[], Any], envelopes: int, repeat: int) -> int:
+    """Return the envelopes per second of the fastest of `repeat` runs."""
+    seconds = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        decode()
+        seconds.append(time.perf_counter() - started_at)
+    return round(envelopes / min(seconds))
+
+
+async def parse(args: argparse.Namespace) -> dict:
+    fixture = fixture_of(args)
+    transactions = [
+        transaction
+        for ledger in fixture.ledgers
+        for transaction in ledger_transactions(ledger)
+    ]
+    passphrase = fixture.network_passphrase
+    assert [
+        (r.operation_id, r.type, r.tx_hash, r.from_, r.to)
+        for r in decode_transactions(transactions, passphrase, {})
+    ] == decode_with_sdk(transactions, passphrase), "the SDK decodes other records"
+    decoder = best_rate(
+        lambda: decode_transactions(transactions, passphrase, {}),
+        len(transactions),
+        args.repeat,
+    )
+    sdk = best_rate(
+        lambda: decode_with_sdk(transactions, passphrase),
+        len(transactions),
+        args.repeat,
+    )
+    return {
+        "envelopes": len(transactions),
+        "decoder": {"envelopes_per_sec": decoder},
+        "sdk": {"envelopes_per_sec": sdk},
+        "speedup": round(decoder / sdk, 2),
+    }
+
+
+def peak_memory(run: Callable[[], Any]) -> int:
+    """Return the peak memory allocated by `run()`, in KiB."""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+async def meta(args: argparse.Namespace) -> dict:
+    fixture = fixture_of(args)
+    accounts = involved_accounts(fixture)
+    watched = set(
+        random.Random(args.seed).sample(accounts, min(args.watched, len(accounts)))
+    )
+    passphrase = fixture.network_passphrase
+    ledgers = [
+        [
+            (tx_id, record["envelope_xdr"], record["result_meta_xdr"])
+            for (tx_id, _), record in zip(ledger_transactions(ledger), ledger.records)
+        ]
+        for ledger in fixture.ledgers
+    ]
+
+    def two_passes() -> list[OperationRecord]:
+        # As `monitor_ledger.build_meta_messages`.
+        records = []
+        for transactions in ledgers:
+            indexes_by_account = find_accounts([m for _, _, m in transactions])
+            found = watched & indexes_by_account.keys()
+            indexes = sorted(
+                {
+                    index
+                    for account_id in found
+                    for index in indexes_by_account[account_id]
+                }
+            )
+            records += decode_balance_changes(
+                [transactions[index] for index in indexes], found, passphrase, {}
+            )
+        return records
+
+    def decode_all() -> list[OperationRecord]:
+        return [
+            record
+            for transactions in ledgers
+            for record in decode_balance_changes(transactions, watched, passphrase, {})
+        ]
+
+    records = two_passes()
+    assert records == decode_all(), "the two passes miss balance changes"
+    return {
+        "transactions": fixture.transactions,
+        "watched_accounts": len(watched),
+        "records": len(records),
+        **{
+            name: {
+                "transactions_per_sec": best_rate(
+                    run, fixture.transactions, args.repeat
+                ),
+                "peak_kib": peak_memory(run),
+            }
+            for name, run in (("two_passes", two_passes), ("decode_all", decode_all))
+        },
+    }
+
+
+class CountingRenderer(Renderer):
+    """A renderer counting the events it renders, i.e. those it reads when
+    nothing is added to it."""
+
+    events_rendered = 0
+
+    def add(self, events: list[Event]) -> None:
+        self.events_rendered += len(events)
+        super().add(events)
+
+
+def bson_size(documents: list[Any]) -> int:
+    """Return the bytes `documents` are stored in, as they are inserted."""
+    return sum(
+        len(bson.encode(document.dict(by_alias=True, exclude_none=True)))
+        for document in documents
+    )
+
+
+def content_messages(events: list[Event], chats: int) -> list[Message]:
+    # As the monitor queued them before events were: the text of the
+    # operation in the message of each chat.
+    return [
+        Message(
+            id=ObjectId(),
+            chat_id=chat_id,
+            content=render_event(event),
+            tx_hash=event.tx_hash,
+            order_key=order_key,
+            dedup_key=f"{event.tx_hash}:{order_key & 0xFFF}:{chat_id}",
+        )
+        for event in events
+        for order_key in [int(event.id.split(":")[1])]
+        for chat_id in range(1, chats + 1)
+    ]
+
+
+def event_messages(events: list[Event], chats: int) -> list[Message]:
+    # As `monitor_ledger.build_messages`.
+    return [
+        Message(
+            id=ObjectId(),
+            chat_id=chat_id,
+            network=event.network,
+            event_ids=[event.id],
+            order_key=order_key,
+            dedup_key=f"{event.network}:{order_key}:{chat_id}",
+        )
+        for event in events
+        for order_key in [int(event.id.split(":")[1])]
+        for chat_id in range(1, chats + 1)
+    ]
+
+
+async def render_batches(
+    messages: list[Message], renderer: CountingRenderer, batch: int
+) -> dict:
+    """Render `messages` `batch` at a time, in the order senders claim them."""
+    started_at = time.perf_counter()
+    for first in range(0, len(messages), batch):
+        await renderer.render(messages[first : first + batch])
+    seconds = time.perf_counter() - started_at
+    assert all(message.content is not None for message in messages)
+    return {
+        "messages_per_sec": round(len(messages) / seconds),
+        "events_rendered": renderer.events_rendered,
+    }
+
+
+async def render(args: argparse.Namespace) -> dict:
+    fixture = fixture_of(args)
+    results: dict = {}
+    async with database(args):
+        events = [
+            monitor_ledger.new_event(record)
+            for ledger in fixture.ledgers
+            for record in decode_transactions(
+                ledger_transactions(ledger), fixture.network_passphrase, {}
+            )
+        ]
+        results["events"] = len(events)
+        events_kib = bson_size(events) / 1024
+        await Event.new_events(events)
+        for chats in args.chats:
+            contents_kib = bson_size(content_messages(events, chats)) / 1024
+            messages = event_messages(events, chats)
+            stored_kib = events_kib + bson_size(messages) / 1024
+            # Read and rendered by the sender, and primed by an ingester in
+            # the same process.
+            cold = CountingRenderer(args.cache_size)
+            warm = CountingRenderer(args.cache_size)
+            warm.add(events)
+            results[f"chats_{chats}"] = {
+                "messages": len(messages),
+                "contents_kib": round(contents_kib),
+                "events_kib": round(stored_kib),
+                "ratio": round(stored_kib / contents_kib, 2),
+                "cold": await render_batches(messages, cold, args.batch),
+                "warm": await render_batches(
+                    event_messages(events, chats), warm, args.batch
+                ),
+            }
+    return results
+
+
+def add_database_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--mongodb-uri",
+        help="use this MongoDB instead of starting mongod, the benchmark "
+        "database is dropped at the end",
+    )
+    parser.add_argument(
+        "--mongod", default="mongod", help="mongod binary, defaults to mongod"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.micro",
+        description="Benchmark single stages of the bot offline.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    resolve_parser = commands.add_parser(
+        "resolve", help="resolve the chats of each ledger"
+    )
+    resolve_parser.set_defaults(run=resolve)
+    add_generate_arguments(resolve_parser)
+    resolve_parser.set_defaults(ledgers=DEFAULT_LEDGERS)
+    resolve_parser.add_argument(
+        "--chats",
+        type=int,
+        default=DEFAULT_CHATS,
+        help=f"chats watching an account of the ledgers each, defaults to "
+        f"{DEFAULT_CHATS}",
+    )
+    resolve_parser.add_argument(
+        "--idle-chats",
+        type=int,
+        default=DEFAULT_IDLE_CHATS,
+        help=f"chats watching accounts the ledgers never pay, defaults to "
+        f"{DEFAULT_IDLE_CHATS}",
+    )
+    add_database_arguments(resolve_parser)
+
+    horizon_parser = commands.add_parser(
+        "horizon", help="request a stub Horizon, with a shared server or not"
+    )
+    horizon_parser.set_defaults(run=horizon_requests)
+    horizon_parser.add_argument(
+        "--requests",
+        type=int,
+        default=DEFAULT_REQUESTS,
+        help=f"requests of each kind, defaults to {DEFAULT_REQUESTS}",
+    )
+    horizon_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"requests in flight, defaults to {DEFAULT_CONCURRENCY}",
+    )
+    horizon_parser.add_argument(
+        "--latency",
+        type=float,
+        default=DEFAULT_LATENCY,
+        help=f"seconds the stub takes to answer, defaults to {DEFAULT_LATENCY}",
+    )
+
+    decode_parser = commands.add_parser(
+        "decode", help="decode the envelopes of each ledger"
+    )
+    decode_parser.set_defaults(run=decode)
+    add_generate_arguments(decode_parser)
+    decode_parser.set_defaults(ledgers=DEFAULT_DECODE_LEDGERS)
+    decode_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=DEFAULT_DECODE_WORKERS,
+        help="sizes of the decoding process pool to compare, 0 decodes in the "
+        "process, defaults to " + " ".join(map(str, DEFAULT_DECODE_WORKERS)),
+    )
+    decode_parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        help=f"ledgers decoded concurrently, as CATCHUP_WINDOW, defaults to "
+        f"{DEFAULT_WINDOW}",
+    )
+
+    claim_parser = commands.add_parser(
+        "claim", help="drain the message queue with concurrent senders"
+    )
+    claim_parser.set_defaults(run=claim)
+    claim_parser.add_argument(
+        "--messages",
+        type=int,
+        default=DEFAULT_MESSAGES,
+        help=f"messages queued, defaults to {DEFAULT_MESSAGES}",
+    )
+    claim_parser.add_argument(
+        "--consumers",
+        type=int,
+        nargs="+",
+        default=DEFAULT_CONSUMERS,
+        help="numbers of concurrent senders to compare, defaults to "
+        + " ".join(map(str, DEFAULT_CONSUMERS)),
+    )
+    claim_parser.add_argument(
+        "--batch",
+        type=int,
+        default=DEFAULT_BATCH,
+        help=f"messages claimed at once, defaults to {DEFAULT_BATCH}",
+    )
+    add_database_arguments(claim_parser)
+
+    digest_parser = commands.add_parser(
+        "digest", help="send a burst of notifications with and without digests"
+    )
+    digest_parser.set_defaults(run=digest)
+    digest_parser.add_argument(
+        "--chats",
+        type=int,
+        default=DEFAULT_BURST_CHATS,
+        help=f"chats notified, defaults to {DEFAULT_BURST_CHATS}",
+    )
+    digest_parser.add_argument(
+        "--waves",
+        type=int,
+        default=DEFAULT_WAVES,
+        help=f"notifications to each chat, defaults to {DEFAULT_WAVES}",
+    )
+    digest_parser.add_argument(
+        "--wave-interval",
+        type=float,
+        default=DEFAULT_WAVE_INTERVAL,
+        help=f"seconds between two notifications to a chat, defaults to "
+        f"{DEFAULT_WAVE_INTERVAL}",
+    )
+    digest_parser.add_argument(
+        "--digest-interval",
+        type=int,
+        default=DEFAULT_DIGEST_INTERVAL,
+        help=f"digest interval of the chats, in seconds, defaults to "
+        f"{DEFAULT_DIGEST_INTERVAL}",
+    )
+    add_database_arguments(digest_parser)
+
+    parse_parser = commands.add_parser(
+        "parse", help="decode envelopes with the decoder and with the SDK"
+    )
+    parse_parser.set_defaults(run=parse)
+    add_generate_arguments(parse_parser)
+    parse_parser.set_defaults(ledgers=DEFAULT_DECODE_LEDGERS)
+    parse_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help=f"runs of each, the fastest counts, defaults to {DEFAULT_REPEAT}",
+    )
+
+    meta_parser = commands.add_parser(
+        "meta", help="read balance changes from transaction meta"
+    )
+    meta_parser.set_defaults(run=meta)
+    add_generate_arguments(meta_parser)
+    meta_parser.set_defaults(ledgers=DEFAULT_DECODE_LEDGERS)
+    meta_parser.add_argument(
+        "--watched",
+        type=int,
+        default=DEFAULT_WATCHED,
+        help=f"accounts of the ledgers watched, defaults to {DEFAULT_WATCHED}",
+    )
+    meta_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help=f"runs of each, the fastest counts, defaults to {DEFAULT_REPEAT}",
+    )
+
+    render_parser = commands.add_parser(
+        "render", help="store events or texts of messages, and render them"
+    )
+    render_parser.set_defaults(run=render)
+    add_generate_arguments(render_parser)
+    render_parser.set_defaults(ledgers=DEFAULT_RENDER_LEDGERS)
+    render_parser.add_argument(
+        "--chats",
+        type=int,
+        nargs="+",
+        default=DEFAULT_CHATS_PER_EVENT,
+        help="numbers of chats notified of each operation to compare, defaults "
+        "to " + " ".join(map(str, DEFAULT_CHATS_PER_EVENT)),
+    )
+    render_parser.add_argument(
+        "--batch",
+        type=int,
+        default=DEFAULT_BATCH,
+        help=f"messages rendered at once, as claimed, defaults to {DEFAULT_BATCH}",
+    )
+    render_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=RENDER_CACHE_SIZE,
+        help=f"texts of events cached, defaults to {RENDER_CACHE_SIZE}",
+    )
+    add_database_arguments(render_parser)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results: Optional[dict] = asyncio.run(args.run(args))
+    print(json.dumps({"command": args.command, **(results or {})}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
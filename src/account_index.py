@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+from collections import defaultdict
+from typing import Optional
+
+from loguru import logger
+
+from src.db import get_db, utc_now
+from src.filters import ChatFilter
+
+
+class AccountIndex:
+    """In-memory map of watched account id -> enabled chat ids, along with
+    the compiled filters of the chats which have one.
+
+    The index is loaded from the `chat` collection once and then kept fresh by
+    polling for chats whose `updated_time` changed since the last refresh.
+    """
+
+    # Re-read a small window before the last seen update to tolerate writes
+    # that commit slightly out of `updated_time` order.
+    REFRESH_OVERLAP = datetime.timedelta(seconds=5)
+    PROJECTION = {
+        "chat_id": 1,
+        "account_ids": 1,
+        "enable": 1,
+        "filter": 1,
+        "updated_time": 1,
+    }
+
+    def __init__(self) -> None:
+        self._chat_ids_by_account: dict[str, set[int]] = defaultdict(set)
+        self._accounts_by_chat: dict[int, set[str]] = {}
+        self._filters_by_chat: dict[int, ChatFilter] = {}
+        self._last_updated_time: Optional[datetime.datetime] = None
+
+    def __len__(self) -> int:
+        return len(self._chat_ids_by_account)
+
+    def __contains__(self, account_id: str) -> bool:
+        return account_id in self._chat_ids_by_account
+
+    def get_chat_ids_by_accounts(self, account_ids: list[str]) -> dict[str, list[int]]:
+        chat_ids_by_account = {}
+        for account_id in account_ids:
+            chat_ids = self._chat_ids_by_account.get(account_id)
+            if chat_ids:
+                chat_ids_by_account[account_id] = list(chat_ids)
+        return chat_ids_by_account
+
+    def get_chat_filters(self, chat_ids: list[int]) -> dict[int, ChatFilter]:
+        return {
+            chat_id: self._filters_by_chat[chat_id]
+            for chat_id in chat_ids
+            if chat_id in self._filters_by_chat
+        }
+
+    async def load(self) -> None:
+        self._chat_ids_by_account.clear()
+        self._accounts_by_chat.clear()
+        self._filters_by_chat.clear()
+        self._last_updated_time = None
+        async for chat in get_db().chat.find({}, self.PROJECTION):
+            self._apply(chat)
+        if self._last_updated_time is None:
+            # No chat carries `updated_time` yet, start polling from now on.
+            self._last_updated_time = utc_now()
+        logger.info(
+            f"account index loaded, {len(self._chat_ids_by_account)} accounts "
+            f"watched by {len(self._accounts_by_chat)} chats."
+        )
+
+    async def refresh(self) -> None:
+        if self._last_updated_time is None:
+            await self.load()
+            return
+        since = self._last_updated_time - self.REFRESH_OVERLAP
+        async for chat in get_db().chat.find(
+            {"updated_time": {"$gte": since}},
+            self.PROJECTION,
+        ):
+            self._apply(chat)
+
+    async def keep_fresh(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"refresh account index error: {e}")
+
+    def _apply(self, chat: dict) -> None:
+        chat_id = chat["chat_id"]
+        for account_id in self._accounts_by_chat.pop(chat_id, ()):
+            chat_ids = self._chat_ids_by_account[account_id]
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self._chat_ids_by_account[account_id]
+        if chat.get("enable", True):
+            account_ids = set(chat.get("account_ids", ()))
+            for account_id in account_ids:
+                self._chat_ids_by_account[account_id].add(chat_id)
+            self._accounts_by_chat[chat_id] = account_ids
+        self._filters_by_chat.pop(chat_id, None)
+        if chat.get("enable", True) and chat.get("filter"):
+            try:
+                self._filters_by_chat[chat_id] = ChatFilter.compile(chat["filter"])
+            except ValueError as e:
+                logger.error(f"invalid filter of chat {chat_id}: {e}")
+        updated_time = chat.get("updated_time")
+        if updated_time is not None and (
+            self._last_updated_time is None or updated_time > self._last_updated_time
+        ):
+            self._last_updated_time = updated_time
+
+
+account_index = AccountIndex()
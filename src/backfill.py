@@ -0,0 +1,169 @@
+"""Replay a range of ledgers, e.g. after an outage or for a newly watched
+account:
+
+    python src/backfill.py START END [--accounts G... ...] [--workers N]
+
+The range is split into chunks replayed concurrently by `--workers` workers,
+each going through its chunk in ledger order. The progress of every chunk is
+checkpointed in the `backfill_chunk` collection, so running the same command
+again resumes where it stopped.
+
+Messages carry a `dedup_key`, so ledgers already processed by the monitor,
+or by a previous run, are not notified twice as long as their messages are
+kept, i.e. up to `SENT_MESSAGE_TTL` after they were sent, and a backfill can
+run along with the monitor. Backfilled messages have a lower priority than
+live ones, senders only claim them once no live message is pending.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+from loguru import logger
+from stellar_sdk import StrKey
+
+from src.account_index import account_index
+from src.config import get_config
+from src.db import BackfillChunk, Event, Message, MessagePriority
+from src.monitor_ledger import load_thresholds, prepare_ledger, save_notifications
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+
+@dataclass
+class BackfillStats:
+    ledgers: int = 0
+    messages: int = 0
+    # Messages already queued or sent.
+    duplicates: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def rate(self) -> float:
+        return self.ledgers / max(time.monotonic() - self.started_at, 1e-9)
+
+
+def job_name(start: int, end: int, accounts: Optional[set[str]]) -> str:
+    name = f"{get_config().network}-{start}-{end}"
+    if accounts:
+        digest = hashlib.sha1(",".join(sorted(accounts)).encode()).hexdigest()
+        name += f"-{digest[:8]}"
+    return name
+
+
+async def backfill_chunk(
+    chunk: BackfillChunk, accounts: Optional[set[str]], stats: BackfillStats
+) -> None:
+    for ledger_id in range(chunk.processed_ledger + 1, chunk.end + 1):
+        notifications = await prepare_ledger(ledger_id, accounts)
+        for message in notifications.messages:
+            message.priority = MessagePriority.BACKFILL
+        queued = await save_notifications(notifications)
+        await BackfillChunk.update_processed_ledger(chunk.job, chunk.start, ledger_id)
+        stats.ledgers += 1
+        stats.messages += len(queued)
+        stats.duplicates += len(notifications.messages) - len(queued)
+
+
+async def work(
+    chunks: deque[BackfillChunk],
+    accounts: Optional[set[str]],
+    stats: BackfillStats,
+) -> None:
+    while chunks:
+        chunk = chunks.popleft()
+        await backfill_chunk(chunk, accounts, stats)
+        logger.info(
+            f"backfilled ledgers {chunk.start}-{chunk.end}, {len(chunks)} chunks "
+            f"left, {stats.rate:.2f} ledgers/sec"
+        )
+
+
+async def backfill(
+    start: int,
+    end: int,
+    accounts: Optional[set[str]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    job: Optional[str] = None,
+) -> BackfillStats:
+    """Queue the messages of ledgers in [start, end], only for the chats
+    watching `accounts` if given."""
+    job = job or job_name(start, end, accounts)
+    await Message.create_indexes()
+    await Event.create_indexes()
+    await BackfillChunk.create_indexes()
+    await BackfillChunk.create_chunks(job, start, end, chunk_size)
+    chunks = deque(await BackfillChunk.get_unfinished(job))
+    logger.info(f"backfill job {job}: {len(chunks)} chunks to replay")
+    await load_thresholds()
+    if get_config().account_index:
+        await account_index.load()
+
+    stats = BackfillStats()
+    await asyncio.gather(*(work(chunks, accounts, stats) for _ in range(workers)))
+    logger.info(
+        f"backfill job {job} done: {stats.ledgers} ledgers, {stats.messages} "
+        f"messages, {stats.duplicates} duplicates, {stats.rate:.2f} ledgers/sec"
+    )
+    return stats
+
+
+def account_id(value: str) -> str:
+    if not StrKey.is_valid_ed25519_public_key(value):
+        raise argparse.ArgumentTypeError(f"invalid account id: {value}")
+    return value
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay a range of ledgers.")
+    parser.add_argument("start", type=int, help="first ledger to replay")
+    parser.add_argument("end", type=int, help="last ledger to replay")
+    parser.add_argument(
+        "--accounts",
+        nargs="+",
+        type=account_id,
+        help="only notify the chats watching these accounts",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"ledgers per chunk, defaults to {DEFAULT_CHUNK_SIZE}",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"chunks replayed concurrently, defaults to {DEFAULT_WORKERS}",
+    )
+    parser.add_argument(
+        "--job",
+        help="name of the job to resume, derived from the network, range and "
+        "accounts by default",
+    )
+    args = parser.parse_args()
+    if args.start < 1 or args.end < args.start:
+        parser.error("the range must be 1 <= start <= end")
+    if args.chunk_size < 1 or args.workers < 1:
+        parser.error("--chunk-size and --workers must be at least 1")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(
+        backfill(
+            args.start,
+            args.end,
+            set(args.accounts) if args.accounts else None,
+            args.chunk_size,
+            args.workers,
+            args.job,
+        )
+    )
@@ -1,18 +1,73 @@
+import asyncio
+import signal
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
 import loguru
-from stellar_sdk import Keypair, ServerAsync
+from aiohttp import web
+from stellar_sdk import Keypair
 from stellar_sdk.exceptions import Ed25519PublicKeyInvalidError
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import CommandHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.helpers import escape_markdown
 
-from src.config import tg_app, config
+from src.config import get_config, get_tg_app
 from src.db import Chat, SystemInfo
+from src.filters import ChatFilter, Direction, parse_asset_key, to_stroops
+from src.horizon import close_server, get_cached_latest_ledger
+
+# Longest digest interval a chat can set, in seconds.
+MAX_DIGEST_INTERVAL = 3600
+# Chats whose state is cached for /list.
+CHAT_CACHE_SIZE = 10000
+# Seconds a chat is cached for. The commands of this process refresh the
+# chats they change, other changes, e.g. the sender disabling a chat which
+# blocked the bot, show up once it expired.
+CHAT_CACHE_TTL = 60.0
+# Telegram sends the secret token of the webhook in this header.
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class ChatCache:
+    """The most recently used chats, with `Chat` as written or read last."""
+
+    def __init__(self, size: int = CHAT_CACHE_SIZE, ttl: float = CHAT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._chats: OrderedDict[int, tuple[float, Chat]] = OrderedDict()
+
+    def get(self, chat_id: int) -> Optional[Chat]:
+        cached = self._chats.get(chat_id)
+        if cached is None:
+            return None
+        expires_at, chat = cached
+        if time.monotonic() > expires_at:
+            del self._chats[chat_id]
+            return None
+        self._chats.move_to_end(chat_id)
+        return chat
+
+    def put(self, chat_id: int, chat: Optional[Chat]) -> None:
+        """Cache `chat` as written by a command, forget it if the command
+        found no chat."""
+        self._chats.pop(chat_id, None)
+        if chat is None:
+            return
+        self._chats[chat_id] = (time.monotonic() + self.ttl, chat)
+        if len(self._chats) > self.size:
+            self._chats.popitem(last=False)
+
+
+chat_cache = ChatCache()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.effective_chat is not None
     chat_id = update.effective_chat.id
-    await Chat.new_chat(chat_id)
+    chat_cache.put(chat_id, await Chat.new_chat(chat_id))
     await context.bot.send_message(
         chat_id=chat_id,
         text="Hello, I'm Stellar Notification Bot! "
@@ -34,7 +89,7 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     account_id = context.args[0].strip()
     try:
         Keypair.from_public_key(account_id)
-        await Chat.add_stellar_account(chat_id, account_id)
+        chat_cache.put(chat_id, await Chat.add_stellar_account(chat_id, account_id))
         await context.bot.send_message(
             chat_id=chat_id,
             text=f"Added successfully! You will receive notifications "
@@ -62,7 +117,7 @@ async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
     account_id = context.args[0].strip()
-    await Chat.remove_stellar_account(chat_id, account_id)
+    chat_cache.put(chat_id, await Chat.remove_stellar_account(chat_id, account_id))
     await context.bot.send_message(
         chat_id=chat_id,
         text=f"Removed successfully! You will not receive notifications "
@@ -75,7 +130,7 @@ async def enable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.effective_chat is not None
     assert update.message is not None
     chat_id = update.effective_chat.id
-    await Chat.enable_notification(chat_id)
+    chat_cache.put(chat_id, await Chat.enable_notification(chat_id))
     await context.bot.send_message(
         chat_id=chat_id,
         text=f"Enabled successfully! You will receive notifications "
@@ -88,7 +143,7 @@ async def disable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.effective_chat is not None
     assert update.message is not None
     chat_id = update.effective_chat.id
-    await Chat.disable_notification(chat_id)
+    chat_cache.put(chat_id, await Chat.disable_notification(chat_id))
     await context.bot.send_message(
         chat_id=chat_id,
         text=f"Disabled successfully! You will not receive notifications "
@@ -97,6 +152,127 @@ async def disable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    assert update.effective_chat is not None
+    assert update.message is not None
+    chat_id = update.effective_chat.id
+    if (
+        context.args is None
+        or len(context.args) != 1
+        or not context.args[0].isdigit()
+        or int(context.args[0]) > MAX_DIGEST_INTERVAL
+    ):
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"Usage: /digest <seconds>, at most {MAX_DIGEST_INTERVAL} seconds. "
+            f"Use /digest 0 to receive notifications right away.",
+            reply_to_message_id=update.message.message_id,
+        )
+        return
+    digest_interval = int(context.args[0])
+    chat_cache.put(chat_id, await Chat.set_digest_interval(chat_id, digest_interval))
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"Updated successfully! Notifications will be gathered "
+        f"for {digest_interval} seconds before being sent.",
+        reply_to_message_id=update.message.message_id,
+    )
+
+
+def describe_filter(filter: Optional[dict]) -> str:
+    if not filter:
+        return "No filter, you are notified of every operation."
+    lines = [f"Direction: {filter.get('direction', Direction.BOTH)}"]
+    for asset, amount in filter.get("min_amounts", {}).items():
+        lines.append(f"Minimum {asset}: {amount}")
+    if filter.get("allow_assets"):
+        lines.append(f"Only: {', '.join(filter['allow_assets'])}")
+    if filter.get("deny_assets"):
+        lines.append(f"Not: {', '.join(filter['deny_assets'])}")
+    return "\n".join(lines)
+
+
+def update_filter(filter: Optional[dict], args: list[str]) -> Optional[dict]:
+    """Return `filter` changed by the arguments of /filter, raise ValueError
+    if they are invalid."""
+    if args == ["clear"]:
+        return None
+    filter = dict(filter or {})
+    if len(args) == 2 and args[0] == "direction":
+        filter["direction"] = args[1]
+    elif len(args) == 3 and args[0] == "min":
+        asset, amount = args[1], args[2]
+        min_amounts = dict(filter.get("min_amounts", {}))
+        stroops = to_stroops(amount)
+        if stroops < 0:
+            raise ValueError(f"invalid amount: {amount}")
+        elif stroops == 0:
+            min_amounts.pop(asset, None)
+        else:
+            min_amounts[asset] = amount
+        filter["min_amounts"] = min_amounts
+    elif len(args) >= 1 and args[0] in ("allow", "deny"):
+        filter[f"{args[0]}_assets"] = args[1:]
+    else:
+        raise ValueError(f"invalid arguments: {args}")
+    for asset in [
+        *filter.get("min_amounts", {}),
+        *filter.get("allow_assets", []),
+        *filter.get("deny_assets", []),
+    ]:
+        _, issuer = parse_asset_key(asset)
+        if issuer is not None:
+            Keypair.from_public_key(issuer)
+    # Rejects what the ingesters could not compile.
+    ChatFilter.compile(filter)
+    return {key: value for key, value in filter.items() if value} or None
+
+
+async def set_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    assert update.effective_chat is not None
+    assert update.message is not None
+    chat_id = update.effective_chat.id
+    chat = await Chat.get_chat(chat_id)
+    if chat is None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="No account added yet, add one by /add command.",
+            reply_to_message_id=update.message.message_id,
+        )
+        return
+    if not context.args:
+        chat_cache.put(chat_id, chat)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=describe_filter(chat.filter),
+            reply_to_message_id=update.message.message_id,
+        )
+        return
+    try:
+        filter = update_filter(chat.filter, context.args)
+    except (ValueError, Ed25519PublicKeyInvalidError):
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Usage:\n"
+            "/filter direction <both|incoming|outgoing>\n"
+            "/filter min <asset> <amount>, 0 to remove the minimum\n"
+            "/filter allow <asset> ..., to be notified of these assets only\n"
+            "/filter deny <asset> ..., not to be notified of these assets\n"
+            "/filter clear\n"
+            "Assets are XLM or CODE:ISSUER.",
+            reply_to_message_id=update.message.message_id,
+        )
+        return
+    chat = await Chat.set_filter(chat_id, filter)
+    chat_cache.put(chat_id, chat)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"Updated successfully!\n"
+        f"{describe_filter(chat.filter if chat is not None else None)}",
+        reply_to_message_id=update.message.message_id,
+    )
+
+
 async def system(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.effective_chat is not None
     assert update.message is not None
@@ -104,8 +280,7 @@ async def system(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     latest_processed_ledger = await SystemInfo.get_processed_ledger()
 
-    async with ServerAsync(config.horizon_url) as server:
-        latest_ledger = (await server.root().call())["history_latest_ledger"]
+    latest_ledger = await get_cached_latest_ledger()
 
     await context.bot.send_message(
         chat_id=chat_id,
@@ -120,13 +295,128 @@ async def system(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
-tg_app.add_handler(CommandHandler("start", start))
-tg_app.add_handler(CommandHandler("add", add))
-tg_app.add_handler(CommandHandler("remove", remove))
-tg_app.add_handler(CommandHandler("enable", enable))
-tg_app.add_handler(CommandHandler("disable", disable))
-tg_app.add_handler(CommandHandler("system", system))
+async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    assert update.effective_chat is not None
+    assert update.message is not None
+    chat_id = update.effective_chat.id
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        chat = await Chat.get_chat(chat_id)
+        chat_cache.put(chat_id, chat)
+    if chat is None or not chat.account_ids:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="No account added yet, add one by /add command.",
+            reply_to_message_id=update.message.message_id,
+        )
+        return
+    lines = ["*Accounts*", *(f"`{account_id}`" for account_id in chat.account_ids)]
+    if not chat.enable:
+        lines.append(escape_markdown("Notifications are disabled, /enable them.", 2))
+    if chat.digest_interval:
+        lines.append(
+            escape_markdown(
+                f"Notifications are gathered for {chat.digest_interval} seconds.", 2
+            )
+        )
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="\n".join(lines),
+        reply_to_message_id=update.message.message_id,
+        parse_mode=ParseMode.MARKDOWN_V2,
+    )
+
+
+def add_handlers(app: Application) -> None:
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("add", add))
+    app.add_handler(CommandHandler("remove", remove))
+    app.add_handler(CommandHandler("enable", enable))
+    app.add_handler(CommandHandler("disable", disable))
+    app.add_handler(CommandHandler("digest", digest))
+    app.add_handler(CommandHandler("filter", set_filter))
+    app.add_handler(CommandHandler("system", system))
+    app.add_handler(CommandHandler("list", list_accounts))
+
+
+def webhook_app(tg_app: Application) -> web.Application:
+    """Return a web app putting the updates posted to `config.webhook_url`
+    on the update queue of `tg_app`.
+
+    Updates are answered as soon as queued, `tg_app` processes up to
+    `config.concurrent_updates` of them at once.
+    """
+    secret = get_config().webhook_secret
+
+    async def receive(request: web.Request) -> web.Response:
+        if secret is not None and request.headers.get(SECRET_TOKEN_HEADER) != secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await tg_app.update_queue.put(Update.de_json(data, tg_app.bot))
+        return web.Response()
+
+    webhook_url = get_config().webhook_url
+    assert webhook_url is not None
+    app = web.Application()
+    app.router.add_post(urlparse(webhook_url).path or "/", receive)
+    return app
+
+
+async def start_updates(tg_app: Application) -> Optional[web.AppRunner]:
+    """Start receiving updates, from Telegram's webhook if
+    `config.webhook_url` is set, by polling otherwise. Return the web server
+    of the webhook, to pass to `stop_updates`."""
+    config = get_config()
+    if config.webhook_url is None:
+        assert tg_app.updater is not None
+        await tg_app.updater.start_polling()
+        return None
+    runner = web.AppRunner(webhook_app(tg_app))
+    await runner.setup()
+    await web.TCPSite(runner, config.webhook_listen, config.webhook_port).start()
+    await tg_app.bot.set_webhook(
+        config.webhook_url,
+        secret_token=config.webhook_secret,
+        # Telegram's limit.
+        max_connections=min(config.concurrent_updates, 100),
+    )
+    loguru.logger.info(
+        f"Receiving updates on {config.webhook_listen}:{config.webhook_port}"
+    )
+    return runner
+
+
+async def stop_updates(tg_app: Application, runner: Optional[web.AppRunner]) -> None:
+    # The webhook is left set, Telegram keeps the updates until we are back.
+    if runner is not None:
+        await runner.cleanup()
+    elif tg_app.updater is not None:
+        await tg_app.updater.stop()
+
+
+async def main() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await Chat.create_indexes()
+    tg_app = get_tg_app()
+    add_handlers(tg_app)
+    await tg_app.initialize()
+    runner = await start_updates(tg_app)
+    await tg_app.start()
+    await stop.wait()
+    loguru.logger.info("Stopping bot...")
+    await stop_updates(tg_app, runner)
+    await tg_app.stop()
+    await tg_app.shutdown()
+    await close_server()
+
 
 if __name__ == "__main__":
     loguru.logger.info("Starting bot...")
-    tg_app.run_polling()
+    asyncio.run(main())
@@ -1,57 +1,221 @@
+import hashlib
 import os
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
 
 import loguru
 from dotenv import load_dotenv
-from telegram.ext import ApplicationBuilder
 
-load_dotenv()
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+
+# Names of the networks known to stellar.expert, by passphrase.
+NETWORK_NAMES = {
+    "Public Global Stellar Network ; September 2015": "public",
+    "Test SDF Network ; September 2015": "testnet",
+}
+
+
+def network_name(network_passphrase: str) -> str:
+    """Return the key the data of a network is stored under: its name if it
+    is a known one, otherwise the start of its network id."""
+    name = NETWORK_NAMES.get(network_passphrase)
+    if name is None:
+        name = hashlib.sha256(network_passphrase.encode()).hexdigest()[:16]
+    return name
 
 
 @dataclass
 class Config:
     dev_mode: bool
     mongodb_uri: str
-    bot_token: str
+    # Only needed by the entry points talking to Telegram, see `get_tg_app`.
+    bot_token: Optional[str]
     db_name: str
     network_passphrase: str
+    # Derived from `network_passphrase`, see `network_name`.
+    network: str
     horizon_url: str
     ignore_tiny_payment: bool
+    account_index: bool
+    account_index_refresh_interval: float
+    ingest_mode: str
+    ledger_source: str
+    history_archive_path: Optional[str]
+    catchup_window: int
+    decode_workers: int
+    horizon_pool_size: int
+    horizon_timeout: float
+    horizon_max_retries: int
+    send_workers: int
+    send_global_rate: float
+    send_per_chat_rate: float
+    message_lease: float
+    write_batch_size: int
+    write_batch_interval: float
+    metrics_port: Optional[int]
+    notify_from_meta: bool
+    sent_message_ttl: int
+    telegram_api_url: Optional[str]
+    concurrent_updates: int
+    webhook_url: Optional[str]
+    webhook_listen: str
+    webhook_port: int
+    webhook_secret: Optional[str]
+    ingest_range_size: int
+    ingest_lease: float
+
+
+def load_config() -> Config:
+    load_dotenv()
+
+    dev_mode = os.getenv("DEV_MODE", "false").lower() == "true"
+    mongodb_uri = os.getenv("MONGODB_URI")
+    bot_token = os.getenv("BOT_TOKEN")
+    db_name = os.getenv("DB_NAME", "stellar_notification_bot")
+    horizon_url = os.getenv("HORIZON_URL")
+    network_passphrase = os.getenv("NETWORK_PASSPHRASE")
+    ignore_tiny_payment = os.getenv("IGNORE_TINY_PAYMENT", "true").lower() == "true"
+    account_index = os.getenv("ACCOUNT_INDEX", "true").lower() == "true"
+    account_index_refresh_interval = float(
+        os.getenv("ACCOUNT_INDEX_REFRESH_INTERVAL", "5")
+    )
+    ingest_mode = os.getenv("INGEST_MODE", "poll").lower()
+    ledger_source = os.getenv("LEDGER_SOURCE", "horizon").lower()
+    history_archive_path = os.getenv("HISTORY_ARCHIVE_PATH")
+    catchup_window = int(os.getenv("CATCHUP_WINDOW", "10"))
+    decode_workers = int(os.getenv("DECODE_WORKERS", "0"))
+    horizon_pool_size = int(os.getenv("HORIZON_POOL_SIZE", "20"))
+    horizon_timeout = float(os.getenv("HORIZON_TIMEOUT", "30"))
+    horizon_max_retries = int(os.getenv("HORIZON_MAX_RETRIES", "5"))
+    send_workers = int(os.getenv("SEND_WORKERS", "8"))
+    send_global_rate = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+    send_per_chat_rate = float(os.getenv("SEND_PER_CHAT_RATE", "1"))
+    message_lease = float(os.getenv("MESSAGE_LEASE", "300"))
+    write_batch_size = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+    write_batch_interval = float(os.getenv("WRITE_BATCH_INTERVAL", "1"))
+    metrics_port = (
+        int(os.environ["METRICS_PORT"]) if os.getenv("METRICS_PORT") else None
+    )
+    notify_from_meta = os.getenv("NOTIFY_FROM_META", "false").lower() == "true"
+    sent_message_ttl = int(os.getenv("SENT_MESSAGE_TTL", str(7 * 24 * 3600)))
+    telegram_api_url = os.getenv("TELEGRAM_API_URL")
+    concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "16"))
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_listen = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    webhook_port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    ingest_range_size = int(os.getenv("INGEST_RANGE_SIZE", "100"))
+    ingest_lease = float(os.getenv("INGEST_LEASE", "30"))
+
+    if dev_mode:
+        loguru.logger.info("Running in dev mode")
+        loguru.logger.info(f"Env: {os.environ}")
+
+    if mongodb_uri is None:
+        raise ValueError("MONGODB_URI is not set")
+
+    if horizon_url is None:
+        raise ValueError("HORIZON_URL is not set")
+
+    if network_passphrase is None:
+        raise ValueError("NETWORK_PASSPHRASE is not set")
+
+    if ingest_mode not in ("poll", "stream"):
+        raise ValueError("INGEST_MODE must be poll or stream")
+
+    if ledger_source not in ("horizon", "archive"):
+        raise ValueError("LEDGER_SOURCE must be horizon or archive")
+
+    if ledger_source == "archive":
+        if history_archive_path is None:
+            raise ValueError("HISTORY_ARCHIVE_PATH is not set")
+        if ingest_mode == "stream":
+            raise ValueError("INGEST_MODE stream requires LEDGER_SOURCE horizon")
+
+    if catchup_window < 1:
+        raise ValueError("CATCHUP_WINDOW must be at least 1")
+
+    if write_batch_size < 1:
+        raise ValueError("WRITE_BATCH_SIZE must be at least 1")
+
+    if concurrent_updates < 1:
+        raise ValueError("CONCURRENT_UPDATES must be at least 1")
+
+    if ingest_range_size < 1:
+        raise ValueError("INGEST_RANGE_SIZE must be at least 1")
 
+    if ingest_lease <= 0:
+        raise ValueError("INGEST_LEASE must be positive")
 
-DEV_MODE = os.getenv("DEV_MODE", "false").lower() == "true"
-MONGODB_URI = os.getenv("MONGODB_URI")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-DB_NAME = os.getenv("DB_NAME", "stellar_notification_bot")
-HORIZON_URL = os.getenv("HORIZON_URL")
-NETWORK_PASSPHRASE = os.getenv("NETWORK_PASSPHRASE")
-IGNORE_TINY_PAYMENT = os.getenv("IGNORE_TINY_PAYMENT", "true").lower() == "true"
+    return Config(
+        dev_mode=dev_mode,
+        mongodb_uri=mongodb_uri,
+        bot_token=bot_token,
+        db_name=db_name,
+        horizon_url=horizon_url,
+        network_passphrase=network_passphrase,
+        network=network_name(network_passphrase),
+        ignore_tiny_payment=ignore_tiny_payment,
+        account_index=account_index,
+        account_index_refresh_interval=account_index_refresh_interval,
+        ingest_mode=ingest_mode,
+        ledger_source=ledger_source,
+        history_archive_path=history_archive_path,
+        catchup_window=catchup_window,
+        decode_workers=decode_workers,
+        horizon_pool_size=horizon_pool_size,
+        horizon_timeout=horizon_timeout,
+        horizon_max_retries=horizon_max_retries,
+        send_workers=send_workers,
+        send_global_rate=send_global_rate,
+        send_per_chat_rate=send_per_chat_rate,
+        message_lease=message_lease,
+        write_batch_size=write_batch_size,
+        write_batch_interval=write_batch_interval,
+        metrics_port=metrics_port,
+        notify_from_meta=notify_from_meta,
+        sent_message_ttl=sent_message_ttl,
+        telegram_api_url=telegram_api_url,
+        concurrent_updates=concurrent_updates,
+        webhook_url=webhook_url,
+        webhook_listen=webhook_listen,
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        ingest_range_size=ingest_range_size,
+        ingest_lease=ingest_lease,
+    )
 
-if DEV_MODE:
-    loguru.logger.info("Running in dev mode")
-    loguru.logger.info(f"Env: {os.environ}")
 
-if MONGODB_URI is None:
-    raise ValueError("MONGODB_URI is not set")
+_config: Optional[Config] = None
+_tg_app: Optional["Application"] = None
 
-if BOT_TOKEN is None:
-    raise ValueError("BOT_TOKEN is not set")
 
-if HORIZON_URL is None:
-    raise ValueError("HORIZON_URL is not set")
+def get_config() -> Config:
+    """Return the configuration, read from the environment on first use."""
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
 
-if NETWORK_PASSPHRASE is None:
-    raise ValueError("NETWORK_PASSPHRASE is not set")
 
-config = Config(
-    dev_mode=DEV_MODE,
-    mongodb_uri=MONGODB_URI,
-    bot_token=BOT_TOKEN,
-    db_name=DB_NAME,
-    horizon_url=HORIZON_URL,
-    network_passphrase=NETWORK_PASSPHRASE,
-    ignore_tiny_payment=IGNORE_TINY_PAYMENT,
-)
+def get_tg_app() -> "Application":
+    """Return the Telegram application, built on first use so that entry
+    points not talking to Telegram do not pay for it."""
+    global _tg_app
+    if _tg_app is None:
+        from telegram.ext import ApplicationBuilder
 
-# telegram
-tg_app = ApplicationBuilder().token(config.bot_token).build()
+        bot_token = get_config().bot_token
+        if bot_token is None:
+            raise ValueError("BOT_TOKEN is not set")
+        builder = (
+            ApplicationBuilder()
+            .token(bot_token)
+            .concurrent_updates(get_config().concurrent_updates)
+        )
+        if get_config().telegram_api_url is not None:
+            builder = builder.base_url(f"{get_config().telegram_api_url}/bot")
+        _tg_app = builder.build()
+    return _tg_app
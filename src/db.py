@@ -2,123 +2,980 @@ from __future__ import annotations
 
 import asyncio
 import datetime
-from typing import Optional
+from typing import Optional, Union
 
 import loguru
 from bson import ObjectId
-from motor.motor_asyncio import AsyncIOMotorClient  # type: ignore[import]
+from motor.motor_asyncio import (  # type: ignore[import]
+    AsyncIOMotorClient,
+    AsyncIOMotorCollection,
+    AsyncIOMotorDatabase,
+)
 from pydantic import BaseModel, Field
-from stellar_sdk import ServerAsync
+from pymongo import DeleteMany, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 
-from src.config import config
+from src.config import get_config
+from src.horizon import get_latest_ledger
 
-client: AsyncIOMotorClient = AsyncIOMotorClient(config.mongodb_uri)
-db = client[config.db_name]
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(get_config().mongodb_uri, tz_aware=True)
+    return _client
+
+
+def get_db() -> AsyncIOMotorDatabase:
+    return get_client()[get_config().db_name]
 
 
 class Chat(BaseModel):
     chat_id: int
     account_ids: list[str]
     enable: bool = True
-    created_time: datetime.datetime = datetime.datetime.now(tz=datetime.timezone.utc)
+    created_time: datetime.datetime = Field(default_factory=utc_now)
+    updated_time: Optional[datetime.datetime] = None
+    # Seconds to gather notifications before sending them as one digest.
+    digest_interval: int = 0
+    # Compiled by `filters.ChatFilter.compile`.
+    filter: Optional[dict] = None
+
+    @staticmethod
+    async def create_indexes() -> None:
+        index = (await get_db().chat.index_information()).get("chat_id_1")
+        if index is None or not index.get("unique"):
+            await Chat._merge_duplicates()
+            if index is not None:
+                # Created before chat ids were unique.
+                await get_db().chat.drop_index("chat_id_1")
+        await get_db().chat.create_index("chat_id", unique=True)
+        await get_db().chat.create_index("updated_time")
+        await get_db().chat.create_index([("account_ids", 1), ("enable", 1)])
+
+    @staticmethod
+    async def _merge_duplicates() -> None:
+        """Merge the chats stored more than once before chat ids were unique
+        into one, watching the accounts of all of them, with the other
+        fields of the one updated last."""
+        async for duplicate in get_db().chat.aggregate(
+            [
+                {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}},
+            ]
+        ):
+            # Never updated first.
+            chats = await (
+                get_db()
+                .chat.find({"chat_id": duplicate["_id"]})
+                .sort("updated_time", 1)
+                .to_list(None)
+            )
+            merged: dict = {}
+            for chat in chats:
+                merged.update(chat)
+            merged["account_ids"] = list(
+                dict.fromkeys(
+                    account_id for chat in chats for account_id in chat["account_ids"]
+                )
+            )
+            created_times = [
+                chat["created_time"] for chat in chats if "created_time" in chat
+            ]
+            if created_times:
+                merged["created_time"] = min(created_times)
+            await get_db().chat.replace_one({"_id": merged["_id"]}, merged)
+            await get_db().chat.delete_many(
+                {"chat_id": duplicate["_id"], "_id": {"$ne": merged["_id"]}}
+            )
+            loguru.logger.info(
+                f"Merged {len(chats)} chats {duplicate['_id']}, watching "
+                f"{len(merged['account_ids'])} accounts"
+            )
 
     @staticmethod
     async def get_chat_ids_by_enable(account_ids: list[str]) -> list[int]:
         return [
             chat["chat_id"]
-            async for chat in db.chat.find(
+            async for chat in get_db().chat.find(
                 {"$or": [{"account_ids": acc} for acc in account_ids], "enable": True},
                 {"chat_id": 1, "_id": 0},
             )
         ]
 
     @staticmethod
-    async def new_chat(chat_id: int) -> None:
-        if not Chat.is_chat_id_exist(chat_id):
-            await db.chat.insert_one(Chat(chat_id=chat_id, account_ids=list()).dict())
-        else:
-            await Chat.enable_notification(chat_id)
+    async def get_chat_ids_by_accounts(account_ids: list[str]) -> dict[str, list[int]]:
+        """Return the enabled chat ids watching each of `account_ids`, with a
+        single query. Accounts nobody watches are left out."""
+        wanted = set(account_ids)
+        chat_ids_by_account: dict[str, list[int]] = {}
+        async for chat in get_db().chat.find(
+            {"account_ids": {"$in": list(wanted)}, "enable": True},
+            {"chat_id": 1, "account_ids": 1, "_id": 0},
+        ):
+            for account_id in chat["account_ids"]:
+                if account_id in wanted:
+                    chat_ids_by_account.setdefault(account_id, []).append(
+                        chat["chat_id"]
+                    )
+        return chat_ids_by_account
+
+    @staticmethod
+    async def get_chat_filters(chat_ids: list[int]) -> dict[int, dict]:
+        """Return the `filter` of those of `chat_ids` which have one."""
+        return {
+            chat["chat_id"]: chat["filter"]
+            async for chat in get_db().chat.find(
+                {"chat_id": {"$in": chat_ids}, "filter": {"$type": "object"}},
+                {"chat_id": 1, "filter": 1, "_id": 0},
+            )
+        }
+
+    @staticmethod
+    async def _update(
+        chat_id: int, update: dict, upsert: bool = False
+    ) -> Optional[Chat]:
+        """Apply `update` to the chat and return it updated, in one round trip.
+
+        When upserting, a missing chat is created with the default values of
+        the fields `update` leaves alone.
+        """
+        update = {**update, "$currentDate": {"updated_time": True}}
+        if upsert:
+            updated = {field for fields in update.values() for field in fields}
+            update["$setOnInsert"] = Chat(chat_id=chat_id, account_ids=[]).dict(
+                exclude={"chat_id", *updated}
+            )
+        chat = await get_db().chat.find_one_and_update(
+            {"chat_id": chat_id},
+            update,
+            {"_id": 0},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
+        )
+        return Chat(**chat) if chat is not None else None
+
+    @staticmethod
+    async def get_chat(chat_id: int) -> Optional[Chat]:
+        chat = await get_db().chat.find_one({"chat_id": chat_id}, {"_id": 0})
+        return Chat(**chat) if chat is not None else None
+
+    @staticmethod
+    async def new_chat(chat_id: int) -> Chat:
+        """Create the chat, or enable it again."""
+        chat = await Chat._update(chat_id, {"$set": {"enable": True}}, upsert=True)
+        assert chat is not None
+        return chat
 
     @staticmethod
-    async def add_stellar_account(chat_id: int, account_id: str) -> None:
-        await db.chat.update_one(
-            {"chat_id": chat_id}, {"$addToSet": {"account_ids": account_id}}
+    async def add_stellar_account(chat_id: int, account_id: str) -> Chat:
+        chat = await Chat._update(
+            chat_id, {"$addToSet": {"account_ids": account_id}}, upsert=True
         )
+        assert chat is not None
+        return chat
 
     @staticmethod
-    async def remove_stellar_account(chat_id: int, account_id: str) -> None:
-        await db.chat.update_one(
-            {"chat_id": chat_id}, {"$pull": {"account_ids": account_id}}
+    async def remove_stellar_account(chat_id: int, account_id: str) -> Optional[Chat]:
+        return await Chat._update(chat_id, {"$pull": {"account_ids": account_id}})
+
+    @staticmethod
+    async def set_digest_interval(chat_id: int, digest_interval: int) -> Optional[Chat]:
+        return await Chat._update(
+            chat_id, {"$set": {"digest_interval": digest_interval}}
         )
 
     @staticmethod
-    async def disable_notification(chat_id: int) -> None:
-        await db.chat.update_one({"chat_id": chat_id}, {"$set": {"enable": False}})
+    async def set_filter(chat_id: int, filter: Optional[dict]) -> Optional[Chat]:
+        """Set the `filter` of the chat, remove it if `None`."""
+        if filter is None:
+            return await Chat._update(chat_id, {"$unset": {"filter": ""}})
+        return await Chat._update(chat_id, {"$set": {"filter": filter}})
+
+    @staticmethod
+    async def get_digest_intervals(chat_ids: list[int]) -> dict[int, int]:
+        return {
+            chat["chat_id"]: chat.get("digest_interval", 0)
+            async for chat in get_db().chat.find(
+                {"chat_id": {"$in": chat_ids}},
+                {"chat_id": 1, "digest_interval": 1, "_id": 0},
+            )
+        }
+
+    @staticmethod
+    async def disable_notification(chat_id: int) -> Optional[Chat]:
+        return await Chat._update(chat_id, {"$set": {"enable": False}})
 
     @staticmethod
-    async def enable_notification(chat_id: int) -> None:
-        await db.chat.update_one({"chat_id": chat_id}, {"$set": {"enable": True}})
+    async def enable_notification(chat_id: int) -> Optional[Chat]:
+        return await Chat._update(chat_id, {"$set": {"enable": True}})
 
     @staticmethod
     async def is_chat_id_exist(chat_id: int) -> bool:
-        return (await db.chat.find_one({"chat_id": chat_id})) is not None
+        return (await get_db().chat.find_one({"chat_id": chat_id})) is not None
+
+
+def _network() -> dict:
+    """Filter the documents of the network we ingest."""
+    return {"network": get_config().network}
 
 
 class SystemInfo(BaseModel):
+    """The progress of ingesting a network, one document per network."""
+
+    # See `config.network`.
+    network: str
     processed_ledger: int = 0
+    # Paging token of the last processed transaction when ingesting from the
+    # Horizon stream, `None` when the last ledger was crawled.
+    paging_token: Optional[str] = None
 
     @staticmethod
-    async def update_processed_ledger(ledger: int) -> None:
-        if db.system_info.find_one() is None:
-            await db.system_info.insert_one(SystemInfo(processed_ledger=ledger).dict())
-        else:
-            await db.system_info.update_one({}, {"$set": {"processed_ledger": ledger}})
+    async def create_indexes() -> None:
+        await get_db().system_info.create_index("network", unique=True)
+        # A document written before per-network state existed is taken over
+        # by the first network to start.
+        if await get_db().system_info.find_one(_network()) is None:
+            await get_db().system_info.update_one(
+                {"network": {"$exists": False}}, {"$set": _network()}
+            )
+
+    @staticmethod
+    async def update_processed_ledger(
+        ledger: int, paging_token: Optional[str] = None
+    ) -> None:
+        await get_db().system_info.update_one(
+            _network(),
+            {"$set": {"processed_ledger": ledger, "paging_token": paging_token}},
+            upsert=True,
+        )
+
+    @staticmethod
+    async def advance_processed_ledger(ledger: int) -> None:
+        """Set `processed_ledger` to `ledger` unless it is past it already,
+        e.g. when monitors processing ranges report it out of order."""
+        await get_db().system_info.update_one(
+            _network(),
+            {"$max": {"processed_ledger": ledger}, "$set": {"paging_token": None}},
+            upsert=True,
+        )
 
     @staticmethod
     async def get_processed_ledger() -> int:
-        info = await db.system_info.find_one({}, {"processed_ledger": 1, "_id": 0})
+        info = await get_db().system_info.find_one(
+            _network(), {"processed_ledger": 1, "_id": 0}
+        )
         if info is None:
             raise SystemError(
-                "processed_ledger is 0, start from 0 will cost a lot of time, set a proper value in db."
+                "processed_ledger is 0, start from 0 will cost a lot of time, set a proper value in db "
+                "and replay older ledgers with src/backfill.py."
             )
         return info["processed_ledger"]
 
+    @staticmethod
+    async def get_paging_token() -> Optional[str]:
+        info = await get_db().system_info.find_one(
+            _network(), {"paging_token": 1, "_id": 0}
+        )
+        if info is None:
+            return None
+        return info.get("paging_token")
+
     @staticmethod
     async def init_processed_ledger() -> None:
-        async with ServerAsync(config.horizon_url) as server:
-            latest_ledger = (await server.root().call())["history_latest_ledger"]
-        if db.system_info.find_one({}) is not None:
+        latest_ledger = await get_latest_ledger()
+        if await get_db().system_info.find_one(_network()) is not None:
             loguru.logger.info("processed_ledger is not 0, skip init.")
             return
         await SystemInfo.update_processed_ledger(latest_ledger)
         loguru.logger.info(f"init processed_ledger to {latest_ledger}")
 
 
+def _lease_free(now: datetime.datetime) -> dict:
+    """Filter documents whose lease is not held, or expired."""
+    return {"$or": [{"lease_expires": None}, {"lease_expires": {"$lt": now}}]}
+
+
+class LedgerRange(BaseModel):
+    """A range of ledgers of a network, processed in order by the monitor
+    holding its lease, see `src.monitor_ledger.poll_ledgers`.
+
+    A monitor renews its lease while it works on the range, and checkpoints
+    each ledger it processes; once the lease expires, e.g. because the
+    monitor died, another one resumes the range after its last checkpoint.
+    """
+
+    network: str
+    start: int
+    end: int
+    # Last ledger whose messages are queued, `start - 1` before the first.
+    processed_ledger: int
+    worker_id: Optional[str] = None
+    lease_expires: Optional[datetime.datetime] = None
+
+    @staticmethod
+    async def create_indexes() -> None:
+        await get_db().ledger_range.create_index(
+            [("network", 1), ("start", 1)], unique=True
+        )
+
+    @staticmethod
+    async def get_last_end() -> Optional[int]:
+        last = await get_db().ledger_range.find_one(
+            _network(), {"end": 1, "_id": 0}, sort=[("start", -1)]
+        )
+        return last["end"] if last is not None else None
+
+    @staticmethod
+    async def create_ranges(first: int, last: int, size: int) -> None:
+        """Cover [first, last] with ranges ending on multiples of `size`, so
+        that monitors creating them at the same time agree on them."""
+        if first > last:
+            return
+        network = get_config().network
+        starts = [first, *range((first - 1) // size * size + size + 1, last + 1, size)]
+        await get_db().ledger_range.bulk_write(
+            [
+                UpdateOne(
+                    {"network": network, "start": start},
+                    {
+                        "$setOnInsert": LedgerRange(
+                            network=network,
+                            start=start,
+                            end=(start - 1) // size * size + size,
+                            processed_ledger=start - 1,
+                        ).dict(exclude_none=True)
+                    },
+                    upsert=True,
+                )
+                for start in starts
+            ],
+            ordered=False,
+        )
+
+    @classmethod
+    async def claim(
+        cls, worker_id: str, latest_ledger: int, lease: float
+    ) -> Optional[LedgerRange]:
+        """Claim the first range with ledgers up to `latest_ledger` left to
+        process, whose lease is not held by another monitor."""
+        now = utc_now()
+        record = await get_db().ledger_range.find_one_and_update(
+            {
+                **_network(),
+                "processed_ledger": {"$lt": latest_ledger},
+                "$expr": {"$lt": ["$processed_ledger", "$end"]},
+                **_lease_free(now),
+            },
+            {
+                "$set": {
+                    "worker_id": worker_id,
+                    "lease_expires": now + datetime.timedelta(seconds=lease),
+                }
+            },
+            sort=[("start", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return cls(**record) if record is not None else None
+
+    @staticmethod
+    async def renew(start: int, worker_id: str, lease: float) -> bool:
+        """Extend the lease of `worker_id` on the range, and return whether
+        it still held it."""
+        result = await get_db().ledger_range.update_one(
+            {**_network(), "start": start, "worker_id": worker_id},
+            {"$set": {"lease_expires": utc_now() + datetime.timedelta(seconds=lease)}},
+        )
+        return result.matched_count == 1
+
+    @staticmethod
+    async def checkpoint(start: int, worker_id: str, ledger: int, lease: float) -> bool:
+        """Mark `ledger` processed and extend the lease, unless `worker_id`
+        lost the lease or `ledger` does not follow the last processed one."""
+        result = await get_db().ledger_range.update_one(
+            {
+                **_network(),
+                "start": start,
+                "worker_id": worker_id,
+                "processed_ledger": ledger - 1,
+            },
+            {
+                "$set": {
+                    "processed_ledger": ledger,
+                    "lease_expires": utc_now() + datetime.timedelta(seconds=lease),
+                }
+            },
+        )
+        return result.matched_count == 1
+
+    @staticmethod
+    async def release(start: int, worker_id: str) -> None:
+        await get_db().ledger_range.update_one(
+            {**_network(), "start": start, "worker_id": worker_id},
+            {"$unset": {"worker_id": "", "lease_expires": ""}},
+        )
+
+    @staticmethod
+    async def get_processed_ledger() -> Optional[int]:
+        """Return the last ledger such that every ledger up to it is
+        processed, `None` if there is no range."""
+        first_unfinished = await get_db().ledger_range.find_one(
+            {**_network(), "$expr": {"$lt": ["$processed_ledger", "$end"]}},
+            {"processed_ledger": 1, "_id": 0},
+            sort=[("start", 1)],
+        )
+        if first_unfinished is not None:
+            return first_unfinished["processed_ledger"]
+        return await LedgerRange.get_last_end()
+
+    @staticmethod
+    async def delete_processed(ledger: int) -> None:
+        """Delete the ranges ending at `ledger` or before, which must all be
+        processed."""
+        await get_db().ledger_range.delete_many({**_network(), "end": {"$lte": ledger}})
+
+
+class IngestLeader(BaseModel):
+    """The monitor streaming the ledgers of a network, see
+    `src.monitor_ledger.stream_ledgers`. Other monitors stand by until its
+    lease expires."""
+
+    network: str = Field(alias="_id")
+    worker_id: str
+    lease_expires: datetime.datetime
+
+    @staticmethod
+    async def acquire(worker_id: str, lease: float) -> bool:
+        """Take or renew the lead for `lease` seconds, and return whether
+        `worker_id` leads."""
+        now = utc_now()
+        try:
+            await get_db().ingest_leader.update_one(
+                {
+                    "_id": get_config().network,
+                    "$or": [{"worker_id": worker_id}, _lease_free(now)],
+                },
+                {
+                    "$set": {
+                        "worker_id": worker_id,
+                        "lease_expires": now + datetime.timedelta(seconds=lease),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Led by another monitor.
+            return False
+        return True
+
+    @staticmethod
+    async def release(worker_id: str) -> None:
+        await get_db().ingest_leader.delete_one(
+            {"_id": get_config().network, "worker_id": worker_id}
+        )
+
+
+class BackfillChunk(BaseModel):
+    """A range of ledgers replayed by a backfill job, see `src.backfill`."""
+
+    job: str
+    start: int
+    end: int
+    # Last ledger whose messages are queued, `start - 1` before the first.
+    processed_ledger: int
+
+    @staticmethod
+    async def create_indexes() -> None:
+        await get_db().backfill_chunk.create_index(
+            [("job", 1), ("start", 1)], unique=True
+        )
+
+    @staticmethod
+    async def create_chunks(job: str, start: int, end: int, size: int) -> None:
+        """Split [start, end] into chunks of `size` ledgers, keeping the
+        progress of those already created by a previous run of `job`."""
+        await get_db().backfill_chunk.bulk_write(
+            [
+                UpdateOne(
+                    {"job": job, "start": chunk_start},
+                    {
+                        "$setOnInsert": BackfillChunk(
+                            job=job,
+                            start=chunk_start,
+                            end=min(chunk_start + size - 1, end),
+                            processed_ledger=chunk_start - 1,
+                        ).dict()
+                    },
+                    upsert=True,
+                )
+                for chunk_start in range(start, end + 1, size)
+            ],
+            ordered=False,
+        )
+
+    @classmethod
+    async def get_unfinished(cls, job: str) -> list[BackfillChunk]:
+        return [
+            cls(**chunk)
+            async for chunk in get_db().backfill_chunk.find(
+                {"job": job, "$expr": {"$lt": ["$processed_ledger", "$end"]}},
+                {"_id": 0},
+                sort=[("start", 1)],
+            )
+        ]
+
+    @staticmethod
+    async def update_processed_ledger(job: str, start: int, ledger: int) -> None:
+        await get_db().backfill_chunk.update_one(
+            {"job": job, "start": start}, {"$set": {"processed_ledger": ledger}}
+        )
+
+
+class AssetThreshold(BaseModel):
+    """Payments of `asset` (`XLM` or `CODE:ISSUER`) below `min_amount` are
+    not notified."""
+
+    asset: str
+    min_amount: str
+
+    @staticmethod
+    async def get_min_amounts() -> dict[str, str]:
+        return {
+            threshold["asset"]: threshold["min_amount"]
+            async for threshold in get_db().asset_threshold.find({}, {"_id": 0})
+        }
+
+
+def _claimed_by_us(messages: list[Message]) -> dict:
+    """Filter `messages` as long as the claims we got them by still hold."""
+    return {
+        "_id": {"$in": [message.id for message in messages]},
+        "worker_id": {"$in": list({message.worker_id for message in messages})},
+    }
+
+
+def _released(available_time: Optional[datetime.datetime]) -> dict:
+    """Update giving claimed messages back to the queue."""
+    return {
+        "$set": {"state": MessageState.PENDING, "available_time": available_time},
+        "$unset": {"worker_id": "", "lease_expires": ""},
+    }
+
+
+class MessagePriority:
+    LIVE = 0
+    # Replayed ledgers, claimed once no live message is pending.
+    BACKFILL = 1
+
+
+class MessageState:
+    PENDING = "pending"
+    CLAIMED = "claimed"
+    # Kept for `config.sent_message_ttl` seconds so that replayed ledgers do
+    # not notify them again.
+    SENT = "sent"
+
+
+# Error code of a duplicate key.
+DUPLICATE_KEY = 11000
+
+
+async def _insert_new(
+    collection: AsyncIOMotorCollection, documents: list[dict]
+) -> set[int]:
+    """Insert `documents`, skipping those whose unique keys already exist,
+    and return the indexes of the skipped ones."""
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        return {error["index"] for error in errors}
+    return set()
+
+
+async def _create_ttl_index(
+    collection: AsyncIOMotorCollection, field: str, ttl: int
+) -> None:
+    try:
+        await collection.create_index(field, expireAfterSeconds=ttl)
+    except OperationFailure:
+        # Created with another TTL.
+        await get_db().command(
+            "collMod",
+            collection.name,
+            index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl},
+        )
+
+
+class Event(BaseModel):
+    """An operation notified to chats, stored once however many chats watch
+    it. Messages reference events and are rendered from them when sent, see
+    `src.render`.
+    """
+
+    # The network and TOID of the operation, followed by the account of a
+    # balance change.
+    id: str = Field(alias="_id")
+    # `None` for events stored before networks were, of the public network.
+    network: Optional[str] = None
+    type: str
+    tx_hash: str
+    from_: str = Field(alias="from")
+    to: str
+    # Code, issuer (`None` for XLM) and amount in stroops of each asset.
+    amounts: list[tuple[str, Optional[str], int]] = []
+    from_muxed_id: Optional[int] = None
+    to_muxed_id: Optional[int] = None
+    balance_id: Optional[str] = None
+    cause: Optional[str] = None
+    created_time: datetime.datetime = Field(default_factory=utc_now)
+
+    class Config:
+        allow_population_by_field_name = True
+
+    @staticmethod
+    async def create_indexes() -> None:
+        # Outlives the messages sent, unless they wait longer than that.
+        await _create_ttl_index(
+            get_db().event, "created_time", get_config().sent_message_ttl
+        )
+
+    @staticmethod
+    async def new_events(events: list[Event]) -> None:
+        """Insert `events`, those of replayed ledgers already exist."""
+        if events:
+            await _insert_new(
+                get_db().event,
+                [event.dict(by_alias=True, exclude_none=True) for event in events],
+            )
+
+    @classmethod
+    async def get_events(cls, event_ids: list[str]) -> dict[str, Event]:
+        return {
+            event["_id"]: cls(**event)
+            async for event in get_db().event.find({"_id": {"$in": event_ids}})
+        }
+
+
 class Message(BaseModel):
+    """A notification of events to a chat, waiting to be sent.
+
+    `db.message` is used as a queue: senders claim pending messages for
+    `lease` seconds, then ack (mark sent) or nack (release) them. Messages
+    whose lease expired, e.g. because their sender crashed, are requeued.
+    """
+
     id: Optional[ObjectId] = Field(alias="_id")
-    content: str
     chat_id: int
-    tx_hash: str
-    created_time: datetime.datetime = datetime.datetime.now(tz=datetime.timezone.utc)
+    # Of the events, `None` for messages queued before networks were.
+    network: Optional[str] = None
+    event_ids: list[str] = []
+    # Rendered from the events by the sender. Stored by messages queued
+    # before events were.
+    content: Optional[str] = None
+    tx_hash: Optional[str] = None
+    # TOID of the operation, so messages are sent in the order of the ledger.
+    order_key: int = 0
+    # Messages of a lower priority, i.e. a higher value, are claimed once
+    # those of higher priorities are, see `MessagePriority`.
+    priority: int = MessagePriority.LIVE
+    created_time: datetime.datetime = Field(default_factory=utc_now)
+    state: str = MessageState.PENDING
+    worker_id: Optional[str] = None
+    lease_expires: Optional[datetime.datetime] = None
+    attempts: int = 0
+    # Not claimed before this time, see `defer`.
+    available_time: Optional[datetime.datetime] = None
+    # Unique, so the same notification is only queued once, even by several
+    # ingesters, see `new_messages`.
+    dedup_key: Optional[str] = None
+    sent_time: Optional[datetime.datetime] = None
 
     class Config:
         arbitrary_types_allowed = True
 
     @staticmethod
-    async def new_messages(messages: list["Message"]) -> None:
+    async def create_indexes() -> None:
+        await get_db().message.create_index(
+            [("state", 1), ("priority", 1), ("order_key", 1)]
+        )
+        await get_db().message.create_index([("state", 1), ("lease_expires", 1)])
+        await get_db().message.create_index([("chat_id", 1), ("state", 1)])
+        await get_db().message.create_index(
+            "dedup_key",
+            unique=True,
+            partialFilterExpression={"dedup_key": {"$type": "string"}},
+        )
+        await _create_ttl_index(
+            get_db().message, "sent_time", get_config().sent_message_ttl
+        )
+        # Messages queued before the queue had states.
+        await get_db().message.update_many(
+            {"state": {"$exists": False}}, {"$set": {"state": MessageState.PENDING}}
+        )
+
+    @staticmethod
+    async def new_messages(messages: list["Message"]) -> list["Message"]:
+        """Insert `messages` and return those inserted, leaving out the ones
+        whose `dedup_key` is already queued or sent."""
         if not messages:
-            return
-        await db.message.insert_many([message.dict() for message in messages])
+            return []
+        for message in messages:
+            if message.id is None:
+                # Known before the insert, so the messages can be acked
+                # without reading them back.
+                message.id = ObjectId()
+        duplicates = await _insert_new(
+            get_db().message,
+            [message.dict(by_alias=True, exclude_none=True) for message in messages],
+        )
+        return [
+            message for index, message in enumerate(messages) if index not in duplicates
+        ]
+
+    @staticmethod
+    def preclaim(messages: list["Message"], worker_id: str, lease: float) -> None:
+        """Mark `messages` claimed by `worker_id` before they are inserted."""
+        lease_expires = utc_now() + datetime.timedelta(seconds=lease)
+        for message in messages:
+            message.state = MessageState.CLAIMED
+            message.worker_id = worker_id
+            message.lease_expires = lease_expires
+            message.attempts += 1
 
     @classmethod
-    async def get_oldest_unsent_message(cls) -> Optional[Message]:
-        record = await db.message.find_one({}, sort=[("created_time", 1)])
-        if not record:
-            return None
-        return cls(**record)
+    async def claim(cls, worker_id: str, limit: int, lease: float) -> list[Message]:
+        """Claim up to `limit` pending messages for `worker_id`, by priority
+        then in ledger order.
+
+        The first pending messages are claimed with a single update guarded
+        on their state, again for those other claimers won in between.
+        """
+        # As in `claim_chat`, returns the messages this call won only.
+        claim_id = f"{worker_id}/{ObjectId()}"
+        lease_expires = utc_now() + datetime.timedelta(seconds=lease)
+        claimed = 0
+        while claimed < limit:
+            available = {
+                "state": MessageState.PENDING,
+                "available_time": {"$not": {"$gt": utc_now()}},
+            }
+            candidates = [
+                record["_id"]
+                async for record in get_db().message.find(
+                    available,
+                    {"_id": 1},
+                    # Messages queued before priorities were have none,
+                    # which sorts first like the live ones.
+                    sort=[("priority", 1), ("order_key", 1)],
+                    limit=limit - claimed,
+                )
+            ]
+            if not candidates:
+                break
+            result = await get_db().message.update_many(
+                {"_id": {"$in": candidates}, **available},
+                {
+                    "$set": {
+                        "state": MessageState.CLAIMED,
+                        "worker_id": claim_id,
+                        "lease_expires": lease_expires,
+                    },
+                    "$inc": {"attempts": 1},
+                },
+            )
+            claimed += result.modified_count
+            if result.modified_count == len(candidates):
+                break
+        if not claimed:
+            return []
+        return [
+            cls(**record)
+            async for record in get_db().message.find(
+                {"worker_id": claim_id}, sort=[("priority", 1), ("order_key", 1)]
+            )
+        ]
+
+    @classmethod
+    async def claim_chat(
+        cls, chat_id: int, worker_id: str, lease: float
+    ) -> list[Message]:
+        """Claim every pending message of `chat_id`, deferred ones included,
+        so they can be sent together."""
+        # A claim id unique to this call, so only the messages it won are
+        # returned and not those the worker claimed before.
+        claim_id = f"{worker_id}/{ObjectId()}"
+        await get_db().message.update_many(
+            {"chat_id": chat_id, "state": MessageState.PENDING},
+            {
+                "$set": {
+                    "state": MessageState.CLAIMED,
+                    "worker_id": claim_id,
+                    "lease_expires": utc_now() + datetime.timedelta(seconds=lease),
+                },
+                "$inc": {"attempts": 1},
+            },
+        )
+        return [
+            cls(**record)
+            async for record in get_db().message.find(
+                {"worker_id": claim_id}, sort=[("order_key", 1)]
+            )
+        ]
+
+    @staticmethod
+    async def defer(
+        messages: list[Message], available_time: Optional[datetime.datetime]
+    ) -> None:
+        """Release claimed `messages`, no one can claim them again before
+        `available_time`."""
+        if not messages:
+            return
+        await get_db().message.update_many(
+            _claimed_by_us(messages), _released(available_time)
+        )
+
+    @staticmethod
+    async def count_by_state() -> dict[str, int]:
+        # A count per state is answered from the index starting with state,
+        # where grouping by state would read every message.
+        return {
+            state: await get_db().message.count_documents({"state": state})
+            for state in (
+                MessageState.PENDING,
+                MessageState.CLAIMED,
+                MessageState.SENT,
+            )
+        }
+
+    @staticmethod
+    async def requeue_expired_leases() -> int:
+        result = await get_db().message.update_many(
+            {
+                "state": MessageState.CLAIMED,
+                "lease_expires": {"$lt": utc_now()},
+            },
+            {
+                "$set": {"state": MessageState.PENDING},
+                "$unset": {"worker_id": "", "lease_expires": ""},
+            },
+        )
+        return result.modified_count
 
-    async def remove(self):
-        await db.message.delete_one({"_id": self.id})
+
+class WriteBatcher:
+    """Buffer acknowledgements and chat updates and write them with
+    `bulk_write`, once `max_size` writes are buffered or at the latest every
+    `interval` seconds.
+
+    Buffered writes are lost if the process dies, which only means the
+    messages are sent again once their lease expires. Run `run` in the
+    background and await `close` on shutdown to write what is left.
+    """
+
+    def __init__(self, max_size: int, interval: float) -> None:
+        self.max_size = max_size
+        self.interval = interval
+        self._chat_writes: list[UpdateOne] = []
+        self._message_writes: list[Union[DeleteMany, UpdateMany]] = []
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._chat_writes) + len(self._message_writes)
+
+    async def ack(self, messages: list[Message]) -> None:
+        """Mark `messages` sent, they leave the queue."""
+        if not messages:
+            return
+        self._message_writes.append(
+            UpdateMany(
+                _claimed_by_us(messages),
+                {
+                    "$set": {"state": MessageState.SENT},
+                    "$currentDate": {"sent_time": True},
+                    "$unset": {"worker_id": "", "lease_expires": ""},
+                },
+            )
+        )
+        await self._flush_if_full()
+
+    async def release(self, messages: list[Message]) -> None:
+        """Give claimed `messages` back to the queue, after the acks buffered
+        before."""
+        if not messages:
+            return
+        self._message_writes.append(
+            UpdateMany(_claimed_by_us(messages), _released(None))
+        )
+        await self._flush_if_full()
+
+    async def disable_chat(self, chat_id: int) -> None:
+        """Disable the notifications of `chat_id` and drop every message
+        still queued for it."""
+        self._chat_writes.append(
+            UpdateOne(
+                {"chat_id": chat_id},
+                {"$set": {"enable": False}, "$currentDate": {"updated_time": True}},
+            )
+        )
+        self._message_writes.append(
+            DeleteMany({"chat_id": chat_id, "state": {"$ne": MessageState.SENT}})
+        )
+        await self._flush_if_full()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            chat_writes, self._chat_writes = self._chat_writes, []
+            message_writes, self._message_writes = self._message_writes, []
+            try:
+                if chat_writes:
+                    await get_db().chat.bulk_write(chat_writes, ordered=False)
+                    chat_writes = []
+                if message_writes:
+                    # Ordered, a release must not overtake an ack.
+                    await get_db().message.bulk_write(message_writes, ordered=True)
+                    message_writes = []
+            finally:
+                # Keep what was not written for the next flush.
+                self._chat_writes[:0] = chat_writes
+                self._message_writes[:0] = message_writes
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                loguru.logger.error(f"flush {len(self)} buffered writes error: {e}")
+
+    async def close(self) -> None:
+        await self.flush()
+
+    async def _flush_if_full(self) -> None:
+        if len(self) >= self.max_size:
+            await self.flush()
+
+
+_write_batcher: Optional[WriteBatcher] = None
+
+
+def get_write_batcher() -> WriteBatcher:
+    global _write_batcher
+    if _write_batcher is None:
+        config = get_config()
+        _write_batcher = WriteBatcher(
+            config.write_batch_size, config.write_batch_interval
+        )
+    return _write_batcher
 
 
 # Init DB
@@ -0,0 +1,313 @@
+"""Decoding of transaction envelopes into compact operation records.
+
+Everything here is pure CPU work without I/O, so it can run in a
+`ProcessPoolExecutor`; keep this module free of imports from the rest of the
+bot, which would connect to Mongo and Telegram in every worker.
+"""
+
+import base64
+import hashlib
+import struct
+from typing import Any, Callable, NamedTuple, Optional, Union
+
+from loguru import logger
+from stellar_sdk import (
+    AccountMerge,
+    Asset,
+    ClaimClaimableBalance,
+    Clawback,
+    CreateAccount,
+    MuxedAccount,
+    Operation,
+    PathPaymentStrictReceive,
+    PathPaymentStrictSend,
+    Payment,
+    StrKey,
+)
+from stellar_sdk import xdr as stellar_xdr
+
+from src.filters import Thresholds, is_below_thresholds
+
+
+class AssetAmount(NamedTuple):
+    code: str
+    # `None` for XLM.
+    issuer: Optional[str]
+    amount: str
+
+
+class OperationRecord(NamedTuple):
+    type: str
+    # TOID of the operation, orders operations across ledgers.
+    operation_id: int
+    tx_hash: str
+    from_: str
+    to: str
+    # Meaning depends on `type`, see `DESCRIBERS`.
+    amounts: tuple[AssetAmount, ...] = ()
+    # Ids of muxed (M...) accounts, `from_` and `to` are their G... accounts.
+    from_muxed_id: Optional[int] = None
+    to_muxed_id: Optional[int] = None
+    # The claimable balance id of `claim_claimable_balance`.
+    balance_id: Optional[str] = None
+    # The type of the operation behind a `balance_change`, see `src.meta`.
+    cause: Optional[str] = None
+
+
+class OperationDescription(NamedTuple):
+    type: str
+    from_: MuxedAccount
+    # A plain account id where the operation takes no muxed account.
+    to: Union[MuxedAccount, str]
+    amounts: tuple[AssetAmount, ...] = ()
+    balance_id: Optional[str] = None
+
+
+def to_asset_amount(asset: Asset, amount: str) -> AssetAmount:
+    if asset.is_native():
+        return AssetAmount("XLM", None, amount)
+    return AssetAmount(asset.code, asset.issuer, amount)
+
+
+def transaction_id(ledger_id: int, application_order: int) -> int:
+    """Return the TOID of a transaction, `application_order` starts at 1.
+    https://github.com/stellar/go/blob/master/toid/main.go
+    """
+    return ledger_id << 32 | application_order << 12
+
+
+def describe_account_merge(
+    op: AccountMerge, source: MuxedAccount
+) -> OperationDescription:
+    return OperationDescription("account_merge", source, op.destination)
+
+
+def describe_create_account(
+    op: CreateAccount, source: MuxedAccount
+) -> OperationDescription:
+    # The amount is the starting balance.
+    return OperationDescription(
+        "create_account",
+        source,
+        op.destination,
+        (AssetAmount("XLM", None, op.starting_balance),),
+    )
+
+
+def describe_payment(op: Payment, source: MuxedAccount) -> OperationDescription:
+    return OperationDescription(
+        "payment", source, op.destination, (to_asset_amount(op.asset, op.amount),)
+    )
+
+
+def describe_path_payment_strict_send(
+    op: PathPaymentStrictSend, source: MuxedAccount
+) -> OperationDescription:
+    # The amounts are the send amount and the destination min.
+    return OperationDescription(
+        "path_payment_strict_send",
+        source,
+        op.destination,
+        (
+            to_asset_amount(op.send_asset, op.send_amount),
+            to_asset_amount(op.dest_asset, op.dest_min),
+        ),
+    )
+
+
+def describe_path_payment_strict_receive(
+    op: PathPaymentStrictReceive, source: MuxedAccount
+) -> OperationDescription:
+    # The amounts are the send max and the destination amount.
+    return OperationDescription(
+        "path_payment_strict_receive",
+        source,
+        op.destination,
+        (
+            to_asset_amount(op.send_asset, op.send_max),
+            to_asset_amount(op.dest_asset, op.dest_amount),
+        ),
+    )
+
+
+def describe_claim_claimable_balance(
+    op: ClaimClaimableBalance, source: MuxedAccount
+) -> OperationDescription:
+    # The claimed amount is only known from the ledger entry, which the
+    # envelope does not hold.
+    return OperationDescription(
+        "claim_claimable_balance", source, source, balance_id=op.balance_id
+    )
+
+
+def describe_clawback(op: Clawback, source: MuxedAccount) -> OperationDescription:
+    # The funds go from the holder back to the issuer, the source.
+    return OperationDescription(
+        "clawback", op.from_, source, (to_asset_amount(op.asset, op.amount),)
+    )
+
+
+# The operations we notify about, and how to tell who is involved in them.
+DESCRIBERS: dict[
+    type[Operation], Callable[[Any, MuxedAccount], OperationDescription]
+] = {
+    AccountMerge: describe_account_merge,
+    CreateAccount: describe_create_account,
+    Payment: describe_payment,
+    PathPaymentStrictSend: describe_path_payment_strict_send,
+    PathPaymentStrictReceive: describe_path_payment_strict_receive,
+    ClaimClaimableBalance: describe_claim_claimable_balance,
+    Clawback: describe_clawback,
+}
+
+
+# The operation classes to decode, by the XDR type of their operations.
+OPERATION_CLASSES: dict[stellar_xdr.OperationType, type[Operation]] = {
+    stellar_xdr.OperationType.ACCOUNT_MERGE: AccountMerge,
+    stellar_xdr.OperationType.CREATE_ACCOUNT: CreateAccount,
+    stellar_xdr.OperationType.PAYMENT: Payment,
+    stellar_xdr.OperationType.PATH_PAYMENT_STRICT_SEND: PathPaymentStrictSend,
+    stellar_xdr.OperationType.PATH_PAYMENT_STRICT_RECEIVE: PathPaymentStrictReceive,
+    stellar_xdr.OperationType.CLAIM_CLAIMABLE_BALANCE: ClaimClaimableBalance,
+    stellar_xdr.OperationType.CLAWBACK: Clawback,
+}
+
+
+def _signatures_size(signatures: list[stellar_xdr.DecoratedSignature]) -> int:
+    # Length of the array, then a 4 bytes hint and a padded opaque each.
+    return 4 + sum(8 + (len(s.signature.signature) + 3) // 4 * 4 for s in signatures)
+
+
+def transaction_hash(
+    network_id: bytes,
+    te: stellar_xdr.TransactionEnvelope,
+    data: Optional[bytes] = None,
+) -> str:
+    """Hash `te`, packed as `data` if given.
+
+    The transaction is hashed from its bytes in `data`, which sit between the
+    envelope type and the signatures, instead of being packed again. This is
+    much cheaper than building the SDK envelope to hash it.
+    """
+    tx: Union[
+        stellar_xdr.FeeBumpTransaction,
+        stellar_xdr.Transaction,
+        stellar_xdr.TransactionV0,
+    ]
+    tagged_type: stellar_xdr.EnvelopeType
+    if te.type == stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX_FEE_BUMP:
+        assert te.fee_bump is not None
+        tx, signatures = te.fee_bump.tx, te.fee_bump.signatures
+        tagged_type = stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX_FEE_BUMP
+        prefix = b""
+    elif te.type == stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX:
+        assert te.v1 is not None
+        tx, signatures = te.v1.tx, te.v1.signatures
+        tagged_type = stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX
+        prefix = b""
+    else:
+        assert te.v0 is not None
+        # A v0 transaction is hashed as its v1 form. The v1 source is a
+        # MuxedAccount (KEY_TYPE_ED25519 == 0, then the same 32 bytes), and
+        # `Preconditions` packs like the optional v0 `timeBounds`.
+        tx, signatures = te.v0.tx, te.v0.signatures
+        tagged_type = stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX
+        prefix = b"\x00\x00\x00\x00"
+    if data is None:
+        tx_bytes = tx.to_xdr_bytes()
+    else:
+        tx_bytes = data[4 : len(data) - _signatures_size(signatures)]
+    return hashlib.sha256(
+        network_id + struct.pack(">i", tagged_type.value) + prefix + tx_bytes
+    ).hexdigest()
+
+
+def unwrap_transaction(
+    te: stellar_xdr.TransactionEnvelope,
+) -> Union[stellar_xdr.Transaction, stellar_xdr.TransactionV0]:
+    """Return the transaction of `te`, the inner one of a fee bump."""
+    if te.type == stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX_FEE_BUMP:
+        assert te.fee_bump is not None
+        inner = te.fee_bump.tx.inner_tx.v1
+        assert inner is not None
+        return inner.tx
+    if te.type == stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX:
+        assert te.v1 is not None
+        return te.v1.tx
+    assert te.v0 is not None
+    return te.v0.tx
+
+
+def decode_transactions(
+    transactions: list[tuple[int, str]],
+    network_passphrase: str,
+    thresholds: Thresholds,
+) -> list[OperationRecord]:
+    """Decode `(transaction id, envelope)` pairs into the records of the
+    operations we notify about, see `DESCRIBERS`.
+
+    Fee bump transactions are unwrapped, their operations are recorded under
+    the hash of the fee bump. Operations whose amounts are all below
+    `thresholds` are left out.
+
+    Only the operations in `DESCRIBERS` are turned into SDK objects, the
+    rest of the envelope is read from the XDR.
+    """
+    network_id = hashlib.sha256(network_passphrase.encode()).digest()
+    records = []
+    for tx_id, transaction in transactions:
+        try:
+            data = base64.b64decode(transaction)
+            te = stellar_xdr.TransactionEnvelope.from_xdr_bytes(data)
+        except Exception as e:
+            logger.error(f"parse transaction error: {e}")
+            continue
+
+        tx = unwrap_transaction(te)
+        tx_source: Optional[MuxedAccount] = None
+        tx_hash: Optional[str] = None
+        for index, op_xdr in enumerate(tx.operations):
+            cls = OPERATION_CLASSES.get(op_xdr.body.type)
+            if cls is None:
+                continue
+            op = cls.from_xdr_object(op_xdr)
+            source = op.source
+            if source is None:
+                if tx_source is None:
+                    tx_source = _transaction_source(tx)
+                source = tx_source
+            description = DESCRIBERS[cls](op, source)
+            if thresholds and is_below_thresholds(description.amounts, thresholds):
+                continue
+            if tx_hash is None:
+                tx_hash = transaction_hash(network_id, te, data)
+            from_ = description.from_
+            to = description.to
+            if isinstance(to, str):
+                to_account_id, to_muxed_id = to, None
+            else:
+                to_account_id, to_muxed_id = to.account_id, to.account_muxed_id
+            records.append(
+                OperationRecord(
+                    description.type,
+                    tx_id | (index + 1),
+                    tx_hash,
+                    from_.account_id,
+                    to_account_id,
+                    description.amounts,
+                    from_.account_muxed_id,
+                    to_muxed_id,
+                    description.balance_id,
+                )
+            )
+    return records
+
+
+def _transaction_source(
+    tx: Union[stellar_xdr.Transaction, stellar_xdr.TransactionV0],
+) -> MuxedAccount:
+    if isinstance(tx, stellar_xdr.TransactionV0):
+        return MuxedAccount(
+            StrKey.encode_ed25519_public_key(tx.source_account_ed25519.uint256)
+        )
+    return MuxedAccount.from_xdr_object(tx.source_account)
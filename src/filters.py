@@ -0,0 +1,123 @@
+"""Filtering of operations by amount, asset and direction.
+
+Thresholds are compiled into plain dicts keyed by `(code, issuer)` with
+amounts in stroops, so checking an operation costs a dict lookup and an
+integer comparison per amount. Like `src.decoder`, this module has no
+imports from the rest of the bot and its values can be sent to the decode
+worker processes.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    from src.decoder import AssetAmount, OperationRecord
+
+STROOPS_PER_UNIT = 10**7
+
+AssetKey = tuple[str, Optional[str]]
+# Minimum amount of each asset in stroops, smaller amounts are filtered out.
+Thresholds = dict[AssetKey, int]
+
+# Used when the `asset_threshold` collection is empty.
+DEFAULT_THRESHOLDS = {
+    "XLM": "0.01",
+    "AQUA:GBNZILSTVQZ4R7IKQDGHYGY2QXL5QOFJYQMXPKWRRM5PAV7Y4M67AQUA": "100",
+    "USDC:GA5ZSEJYB37JRC5AVCIA5MOP4RHTM335X2KGX3IHOJAPP5RE34K4KZVN": "0.01",
+}
+
+
+class Direction:
+    BOTH = "both"
+    # Only operations paying a watched account.
+    INCOMING = "incoming"
+    # Only operations paid by a watched account.
+    OUTGOING = "outgoing"
+
+
+def to_stroops(amount: str) -> int:
+    # Balance changes are signed, see `src.meta`.
+    sign = -1 if amount.startswith("-") else 1
+    whole, _, fraction = amount.lstrip("+-").partition(".")
+    return sign * (int(whole or 0) * STROOPS_PER_UNIT + int(fraction[:7].ljust(7, "0")))
+
+
+def from_stroops(stroops: int) -> str:
+    sign = "-" if stroops < 0 else ""
+    whole, fraction = divmod(abs(stroops), STROOPS_PER_UNIT)
+    decimals = f"{fraction:07d}".rstrip("0")
+    return f"{sign}{whole}.{decimals}" if decimals else f"{sign}{whole}"
+
+
+def parse_asset_key(asset: str) -> AssetKey:
+    """Parse `XLM` or `CODE:ISSUER`."""
+    if asset.upper() in ("XLM", "NATIVE"):
+        return "XLM", None
+    code, _, issuer = asset.partition(":")
+    if not code or not issuer:
+        raise ValueError(f"invalid asset: {asset}")
+    return code, issuer
+
+
+def compile_thresholds(min_amounts: dict[str, str]) -> Thresholds:
+    """Compile `{"CODE:ISSUER": "amount"}` into thresholds."""
+    return {
+        parse_asset_key(asset): to_stroops(amount)
+        for asset, amount in min_amounts.items()
+    }
+
+
+def is_below_thresholds(amounts: Iterable[AssetAmount], thresholds: Thresholds) -> bool:
+    """Whether every amount is below the threshold of its asset, in absolute
+    value.
+
+    Operations without amounts, or with an amount of an asset without a
+    threshold, are never below.
+    """
+    below = False
+    for amount in amounts:
+        threshold = thresholds.get((amount.code, amount.issuer))
+        if threshold is None or abs(to_stroops(amount.amount)) >= threshold:
+            return False
+        below = True
+    return below
+
+
+class ChatFilter(NamedTuple):
+    """What a chat wants to be notified about, on top of the global
+    thresholds."""
+
+    thresholds: Thresholds = {}
+    # Empty for every asset.
+    allow_assets: frozenset[AssetKey] = frozenset()
+    deny_assets: frozenset[AssetKey] = frozenset()
+    direction: str = Direction.BOTH
+
+    @classmethod
+    def compile(cls, document: dict) -> ChatFilter:
+        """Compile the `filter` field of a chat document."""
+        direction = document.get("direction", Direction.BOTH)
+        if direction not in (Direction.BOTH, Direction.INCOMING, Direction.OUTGOING):
+            raise ValueError(f"invalid direction: {direction}")
+        return cls(
+            compile_thresholds(document.get("min_amounts", {})),
+            frozenset(parse_asset_key(a) for a in document.get("allow_assets", ())),
+            frozenset(parse_asset_key(a) for a in document.get("deny_assets", ())),
+            direction,
+        )
+
+    def allows(self, record: OperationRecord, incoming: bool, outgoing: bool) -> bool:
+        """Whether the chat is notified of `record`, which pays one of its
+        accounts if `incoming` and is paid by one of them if `outgoing`."""
+        if self.direction == Direction.INCOMING and not incoming:
+            return False
+        if self.direction == Direction.OUTGOING and not outgoing:
+            return False
+        if record.amounts:
+            assets = {(amount.code, amount.issuer) for amount in record.amounts}
+            if self.allow_assets and not assets & self.allow_assets:
+                return False
+            if assets & self.deny_assets:
+                return False
+        return not is_below_thresholds(record.amounts, self.thresholds)
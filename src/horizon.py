@@ -0,0 +1,91 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from loguru import logger
+from stellar_sdk import AiohttpClient, ServerAsync
+from stellar_sdk.exceptions import BaseHorizonError, ConnectionError
+
+from src.config import get_config
+
+T = TypeVar("T")
+
+# Seconds `get_cached_latest_ledger` keeps the latest ledger, about a ledger.
+LATEST_LEDGER_TTL = 5.0
+
+_server: Optional[ServerAsync] = None
+_latest_ledger: Optional[tuple[float, int]] = None
+_latest_ledger_lock: Optional[asyncio.Lock] = None
+
+
+def get_server() -> ServerAsync:
+    """Return the process wide Horizon server.
+
+    The underlying aiohttp session keeps its connections alive, so it has to
+    be created inside the running event loop and shared by all callers.
+    """
+    global _server
+    if _server is None:
+        client = AiohttpClient(
+            pool_size=get_config().horizon_pool_size,
+            request_timeout=get_config().horizon_timeout,
+        )
+        _server = ServerAsync(get_config().horizon_url, client=client)
+    return _server
+
+
+async def close_server() -> None:
+    global _server
+    if _server is not None:
+        await _server.close()
+        _server = None
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, BaseHorizonError):
+        return e.status == 429 or 500 <= e.status < 600
+    return isinstance(e, (ConnectionError, asyncio.TimeoutError))
+
+
+async def call_with_retry(request: Callable[[], Awaitable[T]]) -> T:
+    """Await `request()`, retrying with jittered exponential backoff when
+    Horizon is rate limiting us, failing with 5xx or unreachable."""
+    attempt = 0
+    while True:
+        try:
+            return await request()
+        except Exception as e:
+            if attempt >= get_config().horizon_max_retries or not _is_retryable(e):
+                raise
+            # "Full jitter", spreads the retries of concurrent callers.
+            delay = random.uniform(0, min(30.0, 0.5 * 2**attempt))
+            attempt += 1
+            logger.warning(
+                f"Horizon request failed ({type(e).__name__}: {e}), "
+                f"retry {attempt} in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+async def get_root() -> dict[str, Any]:
+    return await call_with_retry(get_server().root().call)
+
+
+async def get_latest_ledger() -> int:
+    return (await get_root())["history_latest_ledger"]
+
+
+async def get_cached_latest_ledger() -> int:
+    """Like `get_latest_ledger`, but cached for `LATEST_LEDGER_TTL` seconds.
+
+    Concurrent callers wait for the same request, e.g. a burst of /system.
+    """
+    global _latest_ledger, _latest_ledger_lock
+    if _latest_ledger_lock is None:
+        _latest_ledger_lock = asyncio.Lock()
+    async with _latest_ledger_lock:
+        if _latest_ledger is None or time.monotonic() > _latest_ledger[0]:
+            latest_ledger = await get_latest_ledger()
+            _latest_ledger = (time.monotonic() + LATEST_LEDGER_TTL, latest_ledger)
+        return _latest_ledger[1]
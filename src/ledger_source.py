@@ -0,0 +1,208 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import struct
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from stellar_sdk import xdr as stellar_xdr
+
+from src.config import get_config
+from src.decoder import transaction_hash
+from src.horizon import call_with_retry, get_latest_ledger, get_server
+
+
+class LedgerSource(ABC):
+    """Where `monitor_ledger` reads ledgers from."""
+
+    # Whether `get_transaction_metas` is supported.
+    has_meta = False
+
+    @abstractmethod
+    async def get_latest_ledger(self) -> int:
+        """Return the sequence of the latest ledger available."""
+
+    @abstractmethod
+    async def get_transactions(self, ledger_id: int) -> list[str]:
+        """Return the base64 encoded envelopes of the successful transactions
+        of `ledger_id`, in application order."""
+
+    async def get_transaction_metas(self, ledger_id: int) -> list[tuple[str, str]]:
+        """Return the base64 encoded envelopes and result metas of the
+        successful transactions of `ledger_id`, in application order. Only
+        supported by sources which have `has_meta`."""
+        raise NotImplementedError(f"{type(self).__name__} has no transaction meta")
+
+
+class HorizonLedgerSource(LedgerSource):
+    has_meta = True
+
+    async def get_latest_ledger(self) -> int:
+        return await get_latest_ledger()
+
+    async def get_transactions(self, ledger_id: int) -> list[str]:
+        return [record["envelope_xdr"] for record in await self._get_records(ledger_id)]
+
+    async def get_transaction_metas(self, ledger_id: int) -> list[tuple[str, str]]:
+        return [
+            (record["envelope_xdr"], record["result_meta_xdr"])
+            for record in await self._get_records(ledger_id)
+        ]
+
+    async def _get_records(self, ledger_id: int) -> list[dict]:
+        builder = (
+            get_server()
+            .transactions()
+            .for_ledger(ledger_id)
+            .include_failed(False)
+            .limit(200)
+        )
+        records = (await call_with_retry(builder.call))["_embedded"]["records"]
+        while page := (await call_with_retry(builder.next))["_embedded"]["records"]:
+            records += page
+        return records
+
+
+class HistoryArchiveLedgerSource(LedgerSource):
+    """Read ledgers from a local copy of a history archive.
+
+    Transaction sets come from the checkpoint `transactions-*.xdr.gz` files,
+    and are filtered and ordered by the matching `results-*.xdr.gz` files.
+    A whole checkpoint (64 ledgers) is decoded at once and the most recently
+    used checkpoints are kept in memory. Archives hold results, not meta, so
+    there is no `get_transaction_metas`.
+    """
+
+    CHECKPOINT_FREQUENCY = 64
+    SUCCESS_CODES = (
+        stellar_xdr.TransactionResultCode.txSUCCESS,
+        stellar_xdr.TransactionResultCode.txFEE_BUMP_INNER_SUCCESS,
+    )
+
+    def __init__(
+        self, root: str, network_passphrase: str, cached_checkpoints: int = 4
+    ) -> None:
+        self.root = root
+        self.network_id = hashlib.sha256(network_passphrase.encode()).digest()
+        self.cached_checkpoints = cached_checkpoints
+        # Reads of the most recently used checkpoints, done or in progress.
+        self._checkpoints: OrderedDict[
+            int, asyncio.Future[dict[int, list[str]]]
+        ] = OrderedDict()
+
+    async def get_latest_ledger(self) -> int:
+        path = os.path.join(self.root, ".well-known", "stellar-history.json")
+        with open(path) as f:
+            return json.load(f)["currentLedger"]
+
+    async def get_transactions(self, ledger_id: int) -> list[str]:
+        checkpoint = self.checkpoint_of(ledger_id)
+        read = self._checkpoints.get(checkpoint)
+        if read is None:
+            # Cached before it is done, so that the ledgers of the checkpoint
+            # fetched meanwhile, e.g. by the catch up window, wait for it
+            # instead of reading the checkpoint again.
+            loop = asyncio.get_running_loop()
+            read = loop.run_in_executor(None, self.read_checkpoint, checkpoint)
+            self._checkpoints[checkpoint] = read
+            while len(self._checkpoints) > self.cached_checkpoints:
+                self._checkpoints.popitem(last=False)
+        else:
+            self._checkpoints.move_to_end(checkpoint)
+        try:
+            # Shielded, a cancelled caller must not cancel the read of others.
+            ledgers = await asyncio.shield(read)
+        except Exception:
+            # Read again by the next caller.
+            if self._checkpoints.get(checkpoint) is read:
+                del self._checkpoints[checkpoint]
+            raise
+        return ledgers.get(ledger_id, [])
+
+    @classmethod
+    def checkpoint_of(cls, ledger_id: int) -> int:
+        return (
+            ledger_id // cls.CHECKPOINT_FREQUENCY + 1
+        ) * cls.CHECKPOINT_FREQUENCY - 1
+
+    def checkpoint_path(self, category: str, checkpoint: int) -> str:
+        name = f"{checkpoint:08x}"
+        return os.path.join(
+            self.root,
+            category,
+            name[0:2],
+            name[2:4],
+            name[4:6],
+            f"{category}-{name}.xdr.gz",
+        )
+
+    def read_checkpoint(self, checkpoint: int) -> dict[int, list[str]]:
+        envelopes: dict[str, stellar_xdr.TransactionEnvelope] = {}
+        for data in self._read_records(
+            self.checkpoint_path("transactions", checkpoint)
+        ):
+            entry = stellar_xdr.TransactionHistoryEntry.from_xdr_bytes(data)
+            for te in self._transaction_set(entry):
+                envelopes[transaction_hash(self.network_id, te)] = te
+
+        ledgers: dict[int, list[str]] = {}
+        for data in self._read_records(self.checkpoint_path("results", checkpoint)):
+            result_entry = stellar_xdr.TransactionHistoryResultEntry.from_xdr_bytes(
+                data
+            )
+            ledgers[result_entry.ledger_seq.uint32] = [
+                envelopes[pair.transaction_hash.hash.hex()].to_xdr()
+                for pair in result_entry.tx_result_set.results
+                if pair.result.result.code in self.SUCCESS_CODES
+            ]
+        return ledgers
+
+    @staticmethod
+    def _transaction_set(
+        entry: stellar_xdr.TransactionHistoryEntry,
+    ) -> list[stellar_xdr.TransactionEnvelope]:
+        # Ledgers closed with generalized transaction sets store them in the
+        # extension, which only newer SDK releases can decode.
+        generalized = getattr(entry.ext, "generalized_tx_set", None)
+        if entry.ext.v == 1 and generalized is not None:
+            return [
+                te
+                for phase in generalized.v1_tx_set.phases
+                for component in phase.v0_components
+                for te in component.txs_maybe_discounted_fee.txs
+            ]
+        return entry.tx_set.txs
+
+    @staticmethod
+    def _read_records(path: str) -> Iterator[bytes]:
+        """Iterate over the records of an XDR file using RFC 5531 record
+        marking, as written by stellar-core."""
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset < len(data):
+            (header,) = struct.unpack_from(">I", data, offset)
+            size = header & 0x7FFFFFFF
+            offset += 4
+            yield data[offset : offset + size]
+            offset += size
+
+
+_ledger_source: Optional[LedgerSource] = None
+
+
+def get_ledger_source() -> LedgerSource:
+    global _ledger_source
+    if _ledger_source is None:
+        if get_config().ledger_source == "archive":
+            history_archive_path = get_config().history_archive_path
+            assert history_archive_path is not None
+            _ledger_source = HistoryArchiveLedgerSource(
+                history_archive_path, get_config().network_passphrase
+            )
+        else:
+            _ledger_source = HorizonLedgerSource()
+    return _ledger_source
@@ -0,0 +1,82 @@
+"""Run the bot, the ledger monitor and the notification sender in one process.
+
+The three share the event loop and their Telegram, Horizon and Mongo
+clients. New messages are handed from the monitor to the sender through an
+in-memory queue, Mongo only keeps them durable, so nothing waits for the
+sender to poll for them.
+
+On SIGINT or SIGTERM the bot stops taking updates, the monitor stops at the
+next ledger boundary and the sender sends what it has at hand before
+exiting.
+"""
+
+import asyncio
+import signal
+
+from loguru import logger
+
+import src.monitor_ledger as monitor
+from src.bot import add_handlers, start_updates, stop_updates
+from src.config import get_tg_app
+from src.db import Message
+from src.horizon import close_server
+from src.metrics import start_metrics_server
+from src.send_notification import create_dispatcher
+
+# Batches of new messages waiting for the sender; beyond this the monitor
+# leaves them in Mongo for the sender to claim.
+HANDOFF_QUEUE_SIZE = 100
+# Seconds given to the monitor to finish the ledger at hand when stopping.
+MONITOR_STOP_TIMEOUT = 10.0
+
+
+async def main() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await Message.create_indexes()
+    handoff: asyncio.Queue[list[Message]] = asyncio.Queue(HANDOFF_QUEUE_SIZE)
+    dispatcher = create_dispatcher(handoff)
+
+    tg_app = get_tg_app()
+    add_handlers(tg_app)
+    await tg_app.initialize()
+    updates = await start_updates(tg_app)
+    await tg_app.start()
+    sender = asyncio.create_task(dispatcher.run())
+    ingester = asyncio.create_task(monitor.monitor_ledger(handoff))
+    logger.info("Bot, ledger monitor and sender started.")
+
+    # Stop as well if the monitor or the sender dies.
+    stop_waiter = asyncio.create_task(stop.wait())
+    await asyncio.wait(
+        [stop_waiter, sender, ingester], return_when=asyncio.FIRST_COMPLETED
+    )
+    stop_waiter.cancel()
+    logger.info("Stopping...")
+
+    await stop_updates(tg_app, updates)
+    monitor.stopping.set()
+    try:
+        await asyncio.wait_for(ingester, MONITOR_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Ledger monitor did not stop in time, cancelled it.")
+    except Exception as e:
+        logger.exception(f"Ledger monitor stopped: {e}")
+    dispatcher.stopping.set()
+    try:
+        await sender
+    except Exception as e:
+        logger.exception(f"Sender stopped: {e}")
+    await tg_app.stop()
+    await tg_app.shutdown()
+    await close_server()
+    logger.info("Stopped.")
+
+
+if __name__ == "__main__":
+    logger.info("Starting bot, ledger monitor and sender...")
+    start_metrics_server()
+    asyncio.run(main())
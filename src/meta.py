@@ -0,0 +1,243 @@
+"""Balance changes of watched accounts, read from transaction meta.
+
+An envelope only tells what a transaction asked for, such as the send max
+of a path payment. Its meta holds the ledger entries every operation
+changed, so the balances of accounts and trust lines before and after each
+operation tell what actually happened. DEX trades, claimable balances and
+any other operation moving funds all show up the same way.
+
+Meta is several times larger than the envelope and mostly about accounts
+nobody watches, so it is read in two passes:
+- `find_accounts` lists the accounts whose entries a meta may change with a
+  regex over the raw XDR, without decoding it;
+- `decode_balance_changes` decodes only the metas touching a watched
+  account, and only turns the entries of watched accounts into records.
+
+Like `src.decoder`, this module is pure and can run in the decode workers.
+"""
+
+import base64
+import hashlib
+import re
+from collections import defaultdict
+from functools import lru_cache
+from typing import Optional, Union
+
+from loguru import logger
+from stellar_sdk import Operation, StrKey
+from stellar_sdk import xdr as stellar_xdr
+
+from src.decoder import (
+    AssetAmount,
+    OperationRecord,
+    transaction_hash,
+    unwrap_transaction,
+)
+from src.filters import AssetKey, Thresholds, is_below_thresholds
+
+# The type of the records built from meta.
+BALANCE_CHANGE = "balance_change"
+
+# A created, updated or state `LedgerEntryChange` of an account or trust line
+# entry: the change type, a non zero `lastModifiedLedgerSeq`, the entry type,
+# then the ed25519 `AccountID` both entries start with. Removed entries are
+# preceded by their state, so they need no pattern of their own. The whole
+# pattern is a lookahead, so that candidates may overlap: a candidate
+# consuming bytes would hide an entry starting within them, e.g. one a byte
+# further. Those not aligned to 4 bytes are dropped, the others cost a lookup
+# at most.
+_ENTRY_PATTERN = re.compile(
+    rb"(?=\x00\x00\x00[\x00\x01\x03](?!\x00\x00\x00\x00)[\x00-\xff]{4}"
+    rb"\x00\x00\x00[\x00\x01]\x00\x00\x00\x00([\x00-\xff]{32}))"
+)
+
+_LedgerEntryChangeType = stellar_xdr.LedgerEntryChangeType
+_LedgerEntryType = stellar_xdr.LedgerEntryType
+_AssetType = stellar_xdr.AssetType
+
+
+@lru_cache(maxsize=65536)
+def _encode_account_id(key: bytes) -> str:
+    return StrKey.encode_ed25519_public_key(key)
+
+
+def find_accounts(metas: list[str]) -> dict[str, list[int]]:
+    """Map the accounts whose balances the base64 encoded `metas` may change
+    to the indexes of those metas.
+
+    The result holds every account actually changed, and possibly a few
+    which are not.
+    """
+    indexes_by_account: dict[str, list[int]] = defaultdict(list)
+    for index, meta in enumerate(metas):
+        try:
+            data = base64.b64decode(meta)
+        except Exception as e:
+            logger.error(f"parse transaction meta error: {e}")
+            continue
+        keys = {
+            match.group(1)
+            for match in _ENTRY_PATTERN.finditer(data)
+            if match.start() % 4 == 0
+        }
+        for key in keys:
+            indexes_by_account[_encode_account_id(key)].append(index)
+    return indexes_by_account
+
+
+def _asset_key(asset: stellar_xdr.TrustLineAsset) -> Optional[AssetKey]:
+    if asset.type == _AssetType.ASSET_TYPE_CREDIT_ALPHANUM4:
+        assert asset.alpha_num4 is not None
+        code = asset.alpha_num4.asset_code.asset_code4
+        issuer = asset.alpha_num4.issuer
+    elif asset.type == _AssetType.ASSET_TYPE_CREDIT_ALPHANUM12:
+        assert asset.alpha_num12 is not None
+        code = asset.alpha_num12.asset_code.asset_code12
+        issuer = asset.alpha_num12.issuer
+    else:
+        # Liquidity pool shares are not funds of the account.
+        return None
+    assert issuer.account_id.ed25519 is not None
+    return (
+        code.rstrip(b"\x00").decode(),
+        _encode_account_id(issuer.account_id.ed25519.uint256),
+    )
+
+
+def _entry_balance(
+    data: stellar_xdr.LedgerEntryData, keys: set[bytes]
+) -> Optional[tuple[bytes, AssetKey, int]]:
+    """Return the account, asset and balance of an account or trust line
+    entry of one of `keys`."""
+    if data.type == _LedgerEntryType.ACCOUNT:
+        assert data.account is not None
+        key = data.account.account_id.account_id.ed25519
+        if key is None or key.uint256 not in keys:
+            return None
+        return key.uint256, ("XLM", None), data.account.balance.int64
+    if data.type == _LedgerEntryType.TRUSTLINE:
+        assert data.trust_line is not None
+        key = data.trust_line.account_id.account_id.ed25519
+        if key is None or key.uint256 not in keys:
+            return None
+        asset = _asset_key(data.trust_line.asset)
+        if asset is None:
+            return None
+        return key.uint256, asset, data.trust_line.balance.int64
+    return None
+
+
+def _removed_balance(
+    ledger_key: stellar_xdr.LedgerKey, keys: set[bytes]
+) -> Optional[tuple[bytes, AssetKey, int]]:
+    if ledger_key.type == _LedgerEntryType.ACCOUNT:
+        assert ledger_key.account is not None
+        key = ledger_key.account.account_id.account_id.ed25519
+        asset: Optional[AssetKey] = ("XLM", None)
+    elif ledger_key.type == _LedgerEntryType.TRUSTLINE:
+        assert ledger_key.trust_line is not None
+        key = ledger_key.trust_line.account_id.account_id.ed25519
+        asset = _asset_key(ledger_key.trust_line.asset)
+    else:
+        return None
+    # A trust line is removed without balance, an account once merged.
+    if key is None or key.uint256 not in keys or asset is None:
+        return None
+    return key.uint256, asset, 0
+
+
+def balance_deltas(
+    changes: list[stellar_xdr.LedgerEntryChange], keys: set[bytes]
+) -> dict[bytes, dict[AssetKey, int]]:
+    """Return the balance changes in stroops of the accounts in `keys`, by
+    raw ed25519 key, made by the ledger entry `changes` of an operation.
+
+    An updated or removed entry follows its state before the operation, a
+    created one starts from zero.
+    """
+    before: dict[tuple[bytes, AssetKey], int] = {}
+    deltas: dict[bytes, dict[AssetKey, int]] = {}
+    for change in changes:
+        if change.type == _LedgerEntryChangeType.LEDGER_ENTRY_STATE:
+            assert change.state is not None
+            balance = _entry_balance(change.state.data, keys)
+            if balance is not None:
+                before[balance[0], balance[1]] = balance[2]
+            continue
+        if change.type == _LedgerEntryChangeType.LEDGER_ENTRY_REMOVED:
+            assert change.removed is not None
+            balance = _removed_balance(change.removed, keys)
+        else:
+            entry = change.created or change.updated
+            assert entry is not None
+            balance = _entry_balance(entry.data, keys)
+        if balance is None:
+            continue
+        key, asset, amount = balance
+        delta = amount - before.pop((key, asset), 0)
+        if delta:
+            account_deltas = deltas.setdefault(key, {})
+            account_deltas[asset] = account_deltas.get(asset, 0) + delta
+    return deltas
+
+
+def decode_balance_changes(
+    transactions: list[tuple[int, str, str]],
+    account_ids: set[str],
+    network_passphrase: str,
+    thresholds: Thresholds,
+) -> list[OperationRecord]:
+    """Decode `(transaction id, envelope, meta)` triples into a
+    `balance_change` record per operation and account of `account_ids`
+    whose balances it changed.
+
+    The amounts of a record are signed. Records whose amounts are all below
+    `thresholds` are left out. Envelopes are only read for the type of the
+    operations and the hash of the transactions with records.
+    """
+    network_id = hashlib.sha256(network_passphrase.encode()).digest()
+    keys = {StrKey.decode_ed25519_public_key(account_id) for account_id in account_ids}
+    records = []
+    for tx_id, envelope, meta in transactions:
+        try:
+            tx_meta = stellar_xdr.TransactionMeta.from_xdr_bytes(base64.b64decode(meta))
+            if tx_meta.v == 0:
+                operations = tx_meta.operations
+            else:
+                # Raises on versions we do not know.
+                operations = getattr(tx_meta, f"v{tx_meta.v}").operations
+        except Exception as e:
+            logger.error(f"parse transaction meta error: {e}")
+            continue
+        assert operations is not None
+
+        tx: Union[stellar_xdr.Transaction, stellar_xdr.TransactionV0, None] = None
+        tx_hash: Optional[str] = None
+        for index, op_meta in enumerate(operations):
+            deltas = balance_deltas(op_meta.changes.ledger_entry_changes, keys)
+            for key, account_deltas in deltas.items():
+                amounts = tuple(
+                    AssetAmount(code, issuer, Operation.from_xdr_amount(delta))
+                    for (code, issuer), delta in account_deltas.items()
+                )
+                if thresholds and is_below_thresholds(amounts, thresholds):
+                    continue
+                if tx_hash is None:
+                    data = base64.b64decode(envelope)
+                    te = stellar_xdr.TransactionEnvelope.from_xdr_bytes(data)
+                    tx = unwrap_transaction(te)
+                    tx_hash = transaction_hash(network_id, te, data)
+                assert tx is not None
+                account_id = _encode_account_id(key)
+                records.append(
+                    OperationRecord(
+                        BALANCE_CHANGE,
+                        tx_id | (index + 1),
+                        tx_hash,
+                        account_id,
+                        account_id,
+                        amounts,
+                        cause=tx.operations[index].body.type.name.lower(),
+                    )
+                )
+    return records
@@ -0,0 +1,90 @@
+"""Prometheus metrics, served over HTTP on `METRICS_PORT` when it is set.
+
+Metrics are always recorded, observing a histogram only costs a lock and a
+few additions, so they stay on in production.
+"""
+
+from loguru import logger
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from src.config import get_config
+
+# Fine enough around a Horizon round trip, up to a slow catch up.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# From one ledger to a long digest interval.
+DELAY_BUCKETS = (1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+LATEST_LEDGER = Gauge("stellar_bot_latest_ledger", "Latest ledger seen.")
+PROCESSED_LEDGER = Gauge(
+    "stellar_bot_processed_ledger", "Last ledger whose messages are queued."
+)
+LEDGER_LAG = Gauge(
+    "stellar_bot_ledger_lag", "Ledgers between the latest and the processed one."
+)
+STAGE_SECONDS = Histogram(
+    "stellar_bot_stage_seconds",
+    "Time spent in each stage of ledger processing.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+# Children bound once, `labels` is a dict lookup under a lock.
+FETCH_SECONDS = STAGE_SECONDS.labels("fetch")
+DECODE_SECONDS = STAGE_SECONDS.labels("decode")
+RESOLVE_SECONDS = STAGE_SECONDS.labels("resolve")
+INSERT_SECONDS = STAGE_SECONDS.labels("insert")
+LEASES_LOST = Counter(
+    "stellar_bot_ingest_leases_lost",
+    "Ledger ranges or streams taken over by another monitor.",
+)
+MESSAGE_QUEUE_DEPTH = Gauge(
+    "stellar_bot_message_queue_depth", "Messages in db.message.", ["state"]
+)
+SEND_SECONDS = Histogram(
+    "stellar_bot_send_seconds",
+    "Time of a sendMessage request to Telegram.",
+    buckets=STAGE_BUCKETS,
+)
+TELEGRAM_MESSAGES_SENT = Counter(
+    "stellar_bot_telegram_messages_sent", "Telegram messages sent."
+)
+NOTIFICATIONS_SENT = Counter(
+    "stellar_bot_notifications_sent",
+    "Notifications sent, a Telegram message may hold several.",
+)
+NOTIFICATION_DELAY_SECONDS = Histogram(
+    "stellar_bot_notification_delay_seconds",
+    "Time from queueing a notification to sending it.",
+    buckets=DELAY_BUCKETS,
+)
+SEND_ERRORS = Counter(
+    "stellar_bot_send_errors", "Failed sendMessage requests.", ["error"]
+)
+RETRY_AFTER = Counter(
+    "stellar_bot_retry_after", "Flood control errors returned by Telegram."
+)
+
+_latest_ledger = 0
+_processed_ledger = 0
+
+
+def observe_latest_ledger(ledger_id: int) -> None:
+    global _latest_ledger
+    _latest_ledger = max(_latest_ledger, ledger_id)
+    LATEST_LEDGER.set(_latest_ledger)
+    LEDGER_LAG.set(max(0, _latest_ledger - _processed_ledger))
+
+
+def observe_processed_ledger(ledger_id: int) -> None:
+    global _processed_ledger
+    _processed_ledger = ledger_id
+    PROCESSED_LEDGER.set(ledger_id)
+    # The stream only tells us about ledgers once we processed them.
+    observe_latest_ledger(ledger_id)
+
+
+def start_metrics_server() -> None:
+    port = get_config().metrics_port
+    if port is None:
+        return
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
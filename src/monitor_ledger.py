@@ -1,221 +1,663 @@
 import asyncio
-from decimal import Decimal
+import multiprocessing
+import os
+import socket
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
 from loguru import logger
-from stellar_sdk import (
-    parse_transaction_envelope_from_xdr,
-    FeeBumpTransactionEnvelope,
-    AccountMerge,
-    Payment,
-    PathPaymentStrictSend,
-    PathPaymentStrictReceive,
-    MuxedAccount,
-    Asset,
-    CreateAccount,
-    ServerAsync,
+
+from src.account_index import account_index
+from src.config import get_config
+from src.db import (
+    AssetThreshold,
+    Chat,
+    Event,
+    IngestLeader,
+    LedgerRange,
+    Message,
+    SystemInfo,
+)
+from src.decoder import (
+    OperationRecord,
+    decode_transactions,
+    transaction_id,
+)
+from src.filters import (
+    DEFAULT_THRESHOLDS,
+    ChatFilter,
+    Thresholds,
+    compile_thresholds,
+    to_stroops,
 )
+from src.horizon import get_latest_ledger, get_server
+from src.ledger_source import get_ledger_source
+from src.meta import BALANCE_CHANGE, decode_balance_changes, find_accounts
+from src.metrics import (
+    DECODE_SECONDS,
+    FETCH_SECONDS,
+    INSERT_SECONDS,
+    LEASES_LOST,
+    RESOLVE_SECONDS,
+    observe_latest_ledger,
+    observe_processed_ledger,
+    start_metrics_server,
+)
+from src.render import get_renderer
 
-from src.config import config
-from src.db import SystemInfo, Message, Chat
+# Crawl instead of streaming when we are more ledgers behind than this.
+STREAM_MAX_GAP = 10
+# Seconds without streamed transactions after which buffered ones are saved.
+STREAM_IDLE_FLUSH = 1.0
+# Seconds between two reloads of the asset thresholds.
+THRESHOLDS_REFRESH_INTERVAL = 60.0
+# Claims messages handed straight to an in-process sender.
+HANDOFF_WORKER_ID = f"handoff-{socket.gethostname()}-{os.getpid()}"
+# Holds the leases of ledger ranges and of the stream, see `src.db.LedgerRange`.
+WORKER_ID = f"monitor-{socket.gethostname()}-{os.getpid()}"
 
+# Set by `monitor_ledger` when the sender runs in this process, see `src.main`.
+_handoff: Optional[asyncio.Queue[list[Message]]] = None
+# Set to stop ingesting at the next ledger boundary.
+stopping = asyncio.Event()
+# Compiled from the `asset_threshold` collection, see `load_thresholds`.
+_thresholds: Thresholds = {}
 
-def format_asset(asset: Asset) -> str:
-    if asset.is_native():
-        return "XLM"
-    else:
-        assert asset.issuer is not None
-        return f"{asset.code}({asset.issuer[:4]}...{asset.issuer[-4:]})"
-
-
-def format_number(num_str: str) -> str:
-    int_part = num_str.split(".", 1)[0]
-    if len(int_part) > 3:
-        segments: list[str] = []
-        while len(int_part) > 0:
-            segment = int_part[-3:]
-            segments.insert(0, segment)
-            int_part = int_part[:-3]
-        int_part = ",".join(segments)
-    dec_part = ""
-    if "." in num_str:
-        dec_part = num_str.split(".", 1)[1]
-        dec_part = "." + dec_part
-    return int_part + dec_part
+
+class LeaseLost(Exception):
+    """Another monitor took over the ledgers we were processing."""
+
+
+class Notifications(NamedTuple):
+    # Stored once, however many messages reference them.
+    events: list[Event]
+    messages: list[Message]
 
 
 async def get_transactions(ledger_id: int) -> list[str]:
-    transactions = []
-    async with ServerAsync(config.horizon_url) as server:
-        builder = (
-            server.transactions().for_ledger(ledger_id).include_failed(False).limit(200)
-        )
-        transactions += [
-            record["envelope_xdr"]
-            for record in (await builder.call())["_embedded"]["records"]
-        ]
-        while records := (await builder.next())["_embedded"]["records"]:
-            transactions += [record["envelope_xdr"] for record in records]
-        return transactions
-
-
-async def build_create_account_messages(
-    op: CreateAccount, tx_hash: str, tx_source: MuxedAccount
-) -> list[Message]:
-    from_ = op.source.account_id if op.source else tx_source.account_id
-    to = op.destination
-    text = (
-        "*Create Account*\n"
-        f"From: `{from_}`\n"
-        f"To: `{to}`\n"
-        f"Amount: `{format_number(op.starting_balance)} XLM`\n"
-    )
-    chat_ids = await Chat.get_chat_ids_by_enable([from_, to])
-    messages = [
-        Message(chat_id=chat_id, content=text, tx_hash=tx_hash) for chat_id in chat_ids
-    ]
-    return messages
+    with FETCH_SECONDS.time():
+        return await get_ledger_source().get_transactions(ledger_id)
 
 
-async def build_account_merge_messages(
-    op: AccountMerge, tx_hash: str, tx_source: MuxedAccount
-) -> list[Message]:
-    from_ = op.source.account_id if op.source else tx_source.account_id
-    to = op.destination.account_id
-    text = "*Account Merge*\n" f"Account: `{from_}`\n" f"Merge to: `{to}`\n"
-    chat_ids = await Chat.get_chat_ids_by_enable([from_, to])
-    messages = [
-        Message(chat_id=chat_id, content=text, tx_hash=tx_hash) for chat_id in chat_ids
-    ]
-    return messages
+async def get_transaction_metas(ledger_id: int) -> list[tuple[str, str]]:
+    with FETCH_SECONDS.time():
+        return await get_ledger_source().get_transaction_metas(ledger_id)
 
 
-def hit_payment_filter(op: Payment):
-    if op.asset.is_native() and Decimal(op.amount) < Decimal("0.01"):
-        return True
+def new_event(record: OperationRecord) -> Event:
+    # Operations are identified by their network and TOID, balance changes
+    # also by their account.
+    network = get_config().network
+    event_id = f"{network}:{record.operation_id}"
+    if record.type == BALANCE_CHANGE:
+        event_id += f":{record.from_}"
+    return Event(
+        id=event_id,
+        network=network,
+        type=record.type,
+        tx_hash=record.tx_hash,
+        from_=record.from_,
+        to=record.to,
+        amounts=[
+            (amount.code, amount.issuer, to_stroops(amount.amount))
+            for amount in record.amounts
+        ],
+        from_muxed_id=record.from_muxed_id,
+        to_muxed_id=record.to_muxed_id,
+        balance_id=record.balance_id,
+        cause=record.cause,
+    )
 
-    if op.asset == Asset(
-        "AQUA", "GBNZILSTVQZ4R7IKQDGHYGY2QXL5QOFJYQMXPKWRRM5PAV7Y4M67AQUA"
-    ) and Decimal(op.amount) < Decimal("100"):
-        return True
 
-    if op.asset == Asset(
-        "USDC", "GA5ZSEJYB37JRC5AVCIA5MOP4RHTM335X2KGX3IHOJAPP5RE34K4KZVN"
-    ) and Decimal(op.amount) < Decimal("0.01"):
-        return True
-    return False
+async def resolve_chat_ids(
+    records: list[OperationRecord], accounts: Optional[set[str]] = None
+) -> dict[str, list[int]]:
+    """Map every account involved in `records`, among `accounts` if given, to
+    the chats watching it."""
+    account_ids = {record.from_ for record in records} | {
+        record.to for record in records
+    }
+    if accounts is not None:
+        account_ids &= accounts
+    return await resolve_account_chat_ids(list(account_ids))
 
 
-async def build_payment_messages(
-    op: Payment, tx_hash: str, tx_source: MuxedAccount
-) -> list[Message]:
-    if config.ignore_tiny_payment and hit_payment_filter(op):
-        return []
-    from_ = op.source.account_id if op.source else tx_source.account_id
-    to = op.destination.account_id
-    text = (
-        "*Payment*\n"
-        f"From: `{from_}`\n"
-        f"To: `{to}`\n"
-        f"Amount: `{format_number(op.amount)} {format_asset(op.asset)}`\n"
+async def resolve_account_chat_ids(account_ids: list[str]) -> dict[str, list[int]]:
+    if not account_ids:
+        return {}
+    with RESOLVE_SECONDS.time():
+        if get_config().account_index:
+            return account_index.get_chat_ids_by_accounts(account_ids)
+        return await Chat.get_chat_ids_by_accounts(account_ids)
+
+
+async def resolve_chat_filters(
+    chat_ids_by_account: dict[str, list[int]],
+) -> dict[int, ChatFilter]:
+    chat_ids = list(
+        {chat_id for chat_ids in chat_ids_by_account.values() for chat_id in chat_ids}
     )
-    chat_ids = await Chat.get_chat_ids_by_enable([from_, to])
-    messages = [
-        Message(chat_id=chat_id, content=text, tx_hash=tx_hash) for chat_id in chat_ids
-    ]
-    return messages
+    if not chat_ids:
+        return {}
+    if get_config().account_index:
+        return account_index.get_chat_filters(chat_ids)
+    chat_filters = {}
+    for chat_id, document in (await Chat.get_chat_filters(chat_ids)).items():
+        try:
+            chat_filters[chat_id] = ChatFilter.compile(document)
+        except ValueError as e:
+            logger.error(f"invalid filter of chat {chat_id}: {e}")
+    return chat_filters
 
 
-async def build_path_payment_strict_send_messages(
-    op: PathPaymentStrictSend, tx_hash: str, tx_source: MuxedAccount
-) -> list[Message]:
-    from_ = op.source.account_id if op.source else tx_source.account_id
-    to = op.destination.account_id
-    text = (
-        "*Path Payment Strict Send*\n"
-        f"From: `{from_}`\n"
-        f"Destination: `{to}`\n"
-        f"Send Amount: `{format_number(op.send_amount)} {format_asset(op.send_asset)}`\n"
-        f"Destination Min Receive Amount: `{format_number(op.dest_min)} {format_asset(op.dest_asset)}`\n"
+def build_messages(
+    records: list[OperationRecord],
+    chat_ids_by_account: dict[str, list[int]],
+    chat_filters: Optional[dict[int, ChatFilter]] = None,
+) -> Notifications:
+    network = get_config().network
+    events = []
+    messages: dict[tuple[int, int], Message] = {}
+    for record in records:
+        if record.type == BALANCE_CHANGE:
+            # Incoming if the account gained anything, outgoing if it lost.
+            watching = set(chat_ids_by_account.get(record.from_, ()))
+            signs = {amount.amount.startswith("-") for amount in record.amounts}
+            outgoing = watching if True in signs else set()
+            incoming = watching if False in signs else set()
+        else:
+            outgoing = set(chat_ids_by_account.get(record.from_, ()))
+            incoming = set(chat_ids_by_account.get(record.to, ()))
+        chat_ids = outgoing | incoming
+        if chat_filters:
+            chat_ids = {
+                chat_id
+                for chat_id in chat_ids
+                if chat_id not in chat_filters
+                or chat_filters[chat_id].allows(
+                    record, chat_id in incoming, chat_id in outgoing
+                )
+            }
+        if not chat_ids:
+            continue
+        event = new_event(record)
+        events.append(event)
+        for chat_id in chat_ids:
+            message = messages.get((record.operation_id, chat_id))
+            if message is not None:
+                # Balance changes of several accounts of the chat.
+                message.event_ids.append(event.id)
+                continue
+            messages[record.operation_id, chat_id] = Message(
+                chat_id=chat_id,
+                network=network,
+                event_ids=[event.id],
+                order_key=record.operation_id,
+                # The TOID stands for the transaction hash and the index of
+                # the operation in it.
+                dedup_key=f"{network}:{record.operation_id}:{chat_id}",
+            )
+    return Notifications(events, list(messages.values()))
+
+
+async def build_ledger_messages(
+    transactions: list[tuple[int, str]], accounts: Optional[set[str]] = None
+) -> Notifications:
+    """Build the messages of `(transaction id, envelope)` pairs, only for
+    the chats watching `accounts` if given."""
+    records = await decode(transactions)
+    chat_ids_by_account = await resolve_chat_ids(records, accounts)
+    return build_messages(
+        records, chat_ids_by_account, await resolve_chat_filters(chat_ids_by_account)
     )
-    chat_ids = await Chat.get_chat_ids_by_enable([from_, to])
-    messages = [
-        Message(chat_id=chat_id, content=text, tx_hash=tx_hash) for chat_id in chat_ids
-    ]
-    return messages
 
 
-async def build_path_payment_strict_receive_messages(
-    op: PathPaymentStrictReceive, tx_hash: str, tx_source: MuxedAccount
-) -> list[Message]:
-    from_ = op.source.account_id if op.source else tx_source.account_id
-    to = op.destination.account_id
-    text = (
-        "*Path Payment Strict Receive*\n"
-        f"From: `{from_}`\n"
-        f"Destination: `{to}`\n"
-        f"Send Max Amount: `{format_number(op.send_max)} {format_asset(op.send_asset)}`\n"
-        f"Destination Receive: `{format_number(op.dest_amount)} {format_asset(op.dest_asset)}`\n"
+async def build_meta_messages(
+    transactions: list[tuple[int, str, str]], accounts: Optional[set[str]] = None
+) -> Notifications:
+    """Build the messages of `(transaction id, envelope, meta)` triples from
+    the balance changes of watched accounts, among `accounts` if given, see
+    `src.meta`.
+
+    Only the metas which may change a watched account are decoded.
+    """
+    with DECODE_SECONDS.time():
+        indexes_by_account = find_accounts([meta for _, _, meta in transactions])
+    chat_ids_by_account = await resolve_account_chat_ids(
+        [
+            account_id
+            for account_id in indexes_by_account
+            if accounts is None or account_id in accounts
+        ]
     )
-    chat_ids = await Chat.get_chat_ids_by_enable([from_, to])
-    messages = [
-        Message(chat_id=chat_id, content=text, tx_hash=tx_hash) for chat_id in chat_ids
-    ]
-    return messages
+    indexes = sorted(
+        {
+            index
+            for account_id in chat_ids_by_account
+            for index in indexes_by_account[account_id]
+        }
+    )
+    records = []
+    if indexes:
+        with DECODE_SECONDS.time():
+            records = await run_decoder(
+                decode_balance_changes,
+                [transactions[index] for index in indexes],
+                set(chat_ids_by_account),
+                get_config().network_passphrase,
+                _thresholds,
+            )
+    return build_messages(
+        records, chat_ids_by_account, await resolve_chat_filters(chat_ids_by_account)
+    )
+
+
+async def load_thresholds() -> None:
+    """Compile the asset thresholds, `DEFAULT_THRESHOLDS` if none is
+    stored. Nothing is filtered unless `config.ignore_tiny_payment`."""
+    global _thresholds
+    if not get_config().ignore_tiny_payment:
+        _thresholds = {}
+        return
+    min_amounts = await AssetThreshold.get_min_amounts() or DEFAULT_THRESHOLDS
+    _thresholds = compile_thresholds(min_amounts)
 
 
-async def save_messages(transactions: list[str]) -> None:
-    messages = []
-    for transaction in transactions:
+async def keep_thresholds_fresh() -> None:
+    while True:
+        await asyncio.sleep(THRESHOLDS_REFRESH_INTERVAL)
         try:
-            te = parse_transaction_envelope_from_xdr(
-                transaction, config.network_passphrase
-            )
+            await load_thresholds()
         except Exception as e:
-            logger.error(f"parse transaction error: {e}")
-            continue
+            logger.error(f"load asset thresholds error: {e}")
 
-        if isinstance(te, FeeBumpTransactionEnvelope):
-            continue
 
-        tx = te.transaction
-        for op in tx.operations:
-            if isinstance(op, AccountMerge):
-                messages += await build_account_merge_messages(
-                    op, te.hash_hex(), tx.source
-                )
-            elif isinstance(op, CreateAccount):
-                messages += await build_create_account_messages(
-                    op, te.hash_hex(), tx.source
-                )
-            elif isinstance(op, Payment):
-                messages += await build_payment_messages(op, te.hash_hex(), tx.source)
-            elif isinstance(op, PathPaymentStrictSend):
-                messages += await build_path_payment_strict_send_messages(
-                    op, te.hash_hex(), tx.source
-                )
-            elif isinstance(op, PathPaymentStrictReceive):
-                messages += await build_path_payment_strict_receive_messages(
-                    op, te.hash_hex(), tx.source
+_decode_pool: Optional[ProcessPoolExecutor] = None
+
+
+async def run_decoder(func: Callable[..., list[OperationRecord]], *args: Any):
+    """Run `func`, in the process pool when `config.decode_workers` is set,
+    so busy ledgers do not block the event loop."""
+    global _decode_pool
+    config = get_config()
+    if config.decode_workers == 0:
+        return func(*args)
+    if _decode_pool is None:
+        # Workers only need the decoder, spawn them instead of forking a
+        # process that holds Mongo and Horizon connections.
+        _decode_pool = ProcessPoolExecutor(
+            config.decode_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return await asyncio.get_running_loop().run_in_executor(_decode_pool, func, *args)
+
+
+async def decode(transactions: list[tuple[int, str]]) -> list[OperationRecord]:
+    if not transactions:
+        return []
+    with DECODE_SECONDS.time():
+        return await run_decoder(
+            decode_transactions,
+            transactions,
+            get_config().network_passphrase,
+            _thresholds,
+        )
+
+
+async def save_notifications(notifications: Notifications) -> list[Message]:
+    """Queue the messages of `notifications` for sending, and return those
+    which were not queued or sent already.
+
+    When an in-process sender has room for them, they are inserted already
+    claimed and handed to it directly, along with their rendered events;
+    Mongo then only keeps them in case we stop before they are sent.
+    """
+    events, messages = notifications
+    handoff = _handoff is not None and bool(messages) and not _handoff.full()
+    if handoff:
+        Message.preclaim(messages, HANDOFF_WORKER_ID, get_config().message_lease)
+    with INSERT_SECONDS.time():
+        # Events first, a sender may claim the messages right away.
+        await Event.new_events(events)
+        messages = await Message.new_messages(messages)
+    if handoff and messages:
+        assert _handoff is not None
+        get_renderer().add(events)
+        _handoff.put_nowait(messages)
+    return messages
+
+
+async def prepare_ledger(
+    ledger_id: int, accounts: Optional[set[str]] = None
+) -> Notifications:
+    """Build the messages of `ledger_id`, only for the chats watching
+    `accounts` if given."""
+    if get_config().notify_from_meta:
+        return await build_meta_messages(
+            [
+                (transaction_id(ledger_id, order), envelope, meta)
+                for order, (envelope, meta) in enumerate(
+                    await get_transaction_metas(ledger_id), 1
                 )
-    await Message.new_messages(messages)
+            ],
+            accounts,
+        )
+    transactions = await get_transactions(ledger_id)
+    return await build_ledger_messages(
+        [
+            (transaction_id(ledger_id, order), transaction)
+            for order, transaction in enumerate(transactions, 1)
+        ],
+        accounts,
+    )
+
+
+async def save_processed_ledger(ledger_id: int) -> None:
+    await SystemInfo.update_processed_ledger(ledger_id)
+    observe_processed_ledger(ledger_id)
+
+
+async def process_ledgers(
+    start: int,
+    end: int,
+    checkpoint: Callable[[int], Awaitable[None]] = save_processed_ledger,
+) -> None:
+    """Process ledgers in [start, end].
+
+    Up to `config.catchup_window` ledgers are fetched and parsed concurrently,
+    but their messages are saved and `checkpoint` is awaited strictly in
+    ledger order, so a crash never skips a ledger.
+    """
+    pending: deque[asyncio.Task[Notifications]] = deque()
+    next_ledger = start
+    started_at = time.monotonic()
+    try:
+        while (pending or next_ledger <= end) and not stopping.is_set():
+            while next_ledger <= end and len(pending) < get_config().catchup_window:
+                pending.append(asyncio.create_task(prepare_ledger(next_ledger)))
+                next_ledger += 1
+            ledger_id = next_ledger - len(pending)
+            messages = await save_notifications(await pending.popleft())
+            await checkpoint(ledger_id)
+            rate = (ledger_id - start + 1) / (time.monotonic() - started_at)
+            logger.info(
+                f"processed ledger: {ledger_id}, {len(messages)} messages, "
+                f"{rate:.2f} ledgers/sec"
+            )
+    finally:
+        for task in pending:
+            task.cancel()
 
 
-async def monitor_ledger():
+async def keep_lease(renew: Callable[[], Awaitable[bool]]) -> None:
+    """Renew a lease three times per `config.ingest_lease`, and return once
+    it is lost."""
     while True:
-        async with ServerAsync(config.horizon_url) as server:
-            latest_ledger = (await server.root().call())["history_latest_ledger"]
-            logger.info(f"latest_ledger: {latest_ledger}")
-        processed_ledger = await SystemInfo.get_processed_ledger()
-        logger.info(f"processed_ledger: {processed_ledger}")
-        if processed_ledger >= latest_ledger:
-            await asyncio.sleep(3)
-            continue
-        for ledger_id in range(processed_ledger + 1, latest_ledger + 1):
-            logger.info(f"process ledger: {ledger_id}")
-            transactions = await get_transactions(ledger_id)
-            await save_messages(transactions)
-            await SystemInfo.update_processed_ledger(ledger_id)
+        await asyncio.sleep(get_config().ingest_lease / 3)
+        if not await renew():
+            return
+
+
+async def run_leased(
+    work: Awaitable[None], renew: Callable[[], Awaitable[bool]], what: str
+) -> None:
+    """Run `work` while renewing its lease, and cancel it and raise
+    `LeaseLost` if the lease is lost."""
+    task = asyncio.ensure_future(work)
+    keeper = asyncio.create_task(keep_lease(renew))
+    try:
+        done, _ = await asyncio.wait(
+            [task, keeper], return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        keeper.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+    if task in done:
+        task.result()
+        return
+    # Raise the error that stopped renewing it.
+    keeper.result()
+    raise LeaseLost(what)
+
+
+async def advance_processed_ledger() -> None:
+    """Advance `processed_ledger` past the ranges processed by every
+    monitor, and delete those ranges."""
+    processed_ledger = await LedgerRange.get_processed_ledger()
+    if processed_ledger is None:
+        return
+    await SystemInfo.advance_processed_ledger(processed_ledger)
+    # Only once it is advanced, see `poll_ledgers`.
+    await LedgerRange.delete_processed(processed_ledger)
+    observe_processed_ledger(processed_ledger)
+
+
+async def process_range(
+    ledger_range: LedgerRange, latest_ledger: int, worker_id: str
+) -> None:
+    """Process the ledgers of the range we claimed up to `latest_ledger`,
+    then release it."""
+    lease = get_config().ingest_lease
+    start, end = ledger_range.processed_ledger + 1, min(ledger_range.end, latest_ledger)
+    what = f"ledgers {ledger_range.start}-{ledger_range.end}"
+
+    async def checkpoint(ledger_id: int) -> None:
+        if not await LedgerRange.checkpoint(
+            ledger_range.start, worker_id, ledger_id, lease
+        ):
+            raise LeaseLost(what)
+
+    logger.info(f"claimed {what}, processing {start}-{end}")
+    try:
+        await run_leased(
+            process_ledgers(start, end, checkpoint),
+            lambda: LedgerRange.renew(ledger_range.start, worker_id, lease),
+            what,
+        )
+    except LeaseLost:
+        LEASES_LOST.inc()
+        logger.warning(f"lost the lease of {what} to another monitor")
+        return
+    await LedgerRange.release(ledger_range.start, worker_id)
+    await advance_processed_ledger()
+
+
+async def poll_ledgers(worker_id: str = WORKER_ID) -> None:
+    """Process the ledgers of a range not processed yet, see `LedgerRange`.
+
+    Ranges are claimed in ledger order by whichever monitor polls first, so
+    several monitors catch up on separate ranges at once, and resume the
+    ranges of monitors which stopped renewing their leases.
+    """
+    config = get_config()
+    latest_ledger = await get_ledger_source().get_latest_ledger()
+    observe_latest_ledger(latest_ledger)
+    # Read before `processed_ledger`, which is advanced before ranges are
+    # deleted, so that ranges are never created again once processed.
+    last_end = await LedgerRange.get_last_end()
+    processed_ledger = await SystemInfo.get_processed_ledger()
+    observe_processed_ledger(processed_ledger)
+    await LedgerRange.create_ranges(
+        max(last_end or 0, processed_ledger) + 1,
+        latest_ledger,
+        config.ingest_range_size,
+    )
+    ledger_range = await LedgerRange.claim(
+        worker_id, latest_ledger, config.ingest_lease
+    )
+    if ledger_range is None:
+        try:
+            await asyncio.wait_for(stopping.wait(), 3)
+        except asyncio.TimeoutError:
+            pass
+        return
+    await process_range(ledger_range, latest_ledger, worker_id)
+
+
+def ledger_paging_token(ledger_id: int) -> str:
+    # Paging tokens of transactions are their TOIDs, so every transaction of
+    # `ledger_id` sorts after this one.
+    return str(transaction_id(ledger_id, 0))
+
+
+async def read_transaction_stream(cursor: str, queue: asyncio.Queue) -> None:
+    builder = (
+        get_server().transactions().cursor(cursor).include_failed(False).limit(200)
+    )
+    async for record in builder.stream():
+        await queue.put(record)
+
+
+async def save_streamed_transactions(records: list[dict], ledger_closed: bool) -> None:
+    ledger_id = records[-1]["ledger"]
+    if get_config().notify_from_meta:
+        notifications = await build_meta_messages(
+            [
+                (
+                    int(record["paging_token"]),
+                    record["envelope_xdr"],
+                    record["result_meta_xdr"],
+                )
+                for record in records
+            ]
+        )
+    else:
+        notifications = await build_ledger_messages(
+            [
+                (int(record["paging_token"]), record["envelope_xdr"])
+                for record in records
+            ]
+        )
+    messages = await save_notifications(notifications)
+    # The rest of an unclosed ledger may still be on its way, it is resumed
+    # from the paging token, not from the ledger.
+    processed_ledger = ledger_id if ledger_closed else ledger_id - 1
+    await SystemInfo.update_processed_ledger(
+        processed_ledger, records[-1]["paging_token"]
+    )
+    observe_latest_ledger(ledger_id)
+    observe_processed_ledger(processed_ledger)
+    logger.info(
+        f"processed {len(records)} streamed transactions of ledger {ledger_id}, "
+        f"{len(messages)} messages"
+    )
+
+
+async def lead_stream(worker_id: str = WORKER_ID) -> None:
+    """Stream the ledgers while we lead the network, see `IngestLeader`, or
+    stand by until the leader stops renewing its lease."""
+    lease = get_config().ingest_lease
+    if not await IngestLeader.acquire(worker_id, lease):
+        observe_processed_ledger(await SystemInfo.get_processed_ledger())
+        try:
+            await asyncio.wait_for(stopping.wait(), lease / 3)
+        except asyncio.TimeoutError:
+            pass
+        return
+    try:
+        await run_leased(
+            stream_ledgers(),
+            lambda: IngestLeader.acquire(worker_id, lease),
+            "the stream",
+        )
+    except LeaseLost:
+        LEASES_LOST.inc()
+        logger.warning("lost the stream to another monitor")
+
+
+async def stream_ledgers() -> None:
+    """Ingest transactions from the Horizon stream.
+
+    Transactions are saved when a transaction of the next ledger arrives, or
+    when the stream has been idle for `STREAM_IDLE_FLUSH` seconds. If we are
+    too far behind, the gap is crawled ledger by ledger first.
+    """
+    latest_ledger = await get_latest_ledger()
+    processed_ledger = await SystemInfo.get_processed_ledger()
+    observe_latest_ledger(latest_ledger)
+    observe_processed_ledger(processed_ledger)
+    if latest_ledger - processed_ledger > STREAM_MAX_GAP:
+        logger.info(
+            f"{latest_ledger - processed_ledger} ledgers behind, crawl them first."
+        )
+        await process_ledgers(processed_ledger + 1, latest_ledger)
+        return
+
+    cursor = await SystemInfo.get_paging_token() or ledger_paging_token(
+        processed_ledger + 1
+    )
+    logger.info(f"stream transactions from cursor: {cursor}")
+    queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=1000)
+    reader = asyncio.create_task(read_transaction_stream(cursor, queue))
+    records: list[dict] = []
+    try:
+        while not stopping.is_set():
+            try:
+                record = await asyncio.wait_for(queue.get(), STREAM_IDLE_FLUSH)
+            except asyncio.TimeoutError:
+                if reader.done():
+                    # Raise the error that stopped the stream.
+                    reader.result()
+                    return
+                if records:
+                    await save_streamed_transactions(records, ledger_closed=False)
+                    records = []
+                continue
+            if records and record["ledger"] != records[-1]["ledger"]:
+                await save_streamed_transactions(records, ledger_closed=True)
+                records = []
+            records.append(record)
+        if records:
+            await save_streamed_transactions(records, ledger_closed=False)
+    finally:
+        reader.cancel()
+
+
+async def monitor_ledger(handoff: Optional[asyncio.Queue[list[Message]]] = None):
+    """Ingest ledgers until `stopping` is set.
+
+    New messages are put on `handoff` too, as long as it is not full.
+    """
+    global _handoff
+    _handoff = handoff
+    if get_config().notify_from_meta and not get_ledger_source().has_meta:
+        raise ValueError(
+            f"NOTIFY_FROM_META requires a ledger source with transaction meta, "
+            f"not {get_config().ledger_source}"
+        )
+    await Chat.create_indexes()
+    await Event.create_indexes()
+    await SystemInfo.create_indexes()
+    await LedgerRange.create_indexes()
+    await load_thresholds()
+    # Keep references, otherwise the tasks may be garbage collected.
+    refresh_tasks = [asyncio.create_task(keep_thresholds_fresh())]
+    if get_config().account_index:
+        await account_index.load()
+        refresh_tasks.append(
+            asyncio.create_task(
+                account_index.keep_fresh(get_config().account_index_refresh_interval)
+            )
+        )
+    try:
+        while not stopping.is_set():
+            if get_config().ingest_mode == "stream":
+                await lead_stream()
+            else:
+                await poll_ledgers()
+        if get_config().ingest_mode == "stream":
+            # Hand the stream over to a standby monitor right away.
+            await IngestLeader.release(WORKER_ID)
+    finally:
+        for task in refresh_tasks:
+            task.cancel()
+    logger.info("Stopped monitoring ledgers.")
 
 
 if __name__ == "__main__":
     logger.info("Start monitor ledger.")
+    start_metrics_server()
     asyncio.run(monitor_ledger())
@@ -0,0 +1,234 @@
+"""Rendering of events into notification texts, done by the sender.
+
+Events are stored once however many chats watch them, see `src.db.Event`,
+and their texts are cached, so an event sent to many chats is read and
+rendered once.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from src.db import Event, Message
+from src.decoder import AssetAmount, OperationRecord
+from src.filters import from_stroops
+from src.meta import BALANCE_CHANGE
+
+# Events whose texts are kept by a `Renderer`.
+RENDER_CACHE_SIZE = 10000
+
+
+def format_asset(asset: AssetAmount) -> str:
+    if asset.issuer is None:
+        return "XLM"
+    else:
+        return f"{asset.code}({asset.issuer[:4]}...{asset.issuer[-4:]})"
+
+
+def format_account(account_id: str, muxed_id: Optional[int]) -> str:
+    if muxed_id is None:
+        return f"`{account_id}`"
+    return f"`{account_id}` \\(muxed id `{muxed_id}`\\)"
+
+
+def format_amount(asset: AssetAmount) -> str:
+    return f"{format_number(asset.amount)} {format_asset(asset)}"
+
+
+def format_signed_amount(asset: AssetAmount) -> str:
+    sign = "" if asset.amount.startswith("-") else "+"
+    return sign + format_amount(asset)
+
+
+def format_number(num_str: str) -> str:
+    sign = "-" if num_str.startswith("-") else ""
+    num_str = num_str.lstrip("-")
+    int_part = num_str.split(".", 1)[0]
+    if len(int_part) > 3:
+        segments: list[str] = []
+        while len(int_part) > 0:
+            segment = int_part[-3:]
+            segments.insert(0, segment)
+            int_part = int_part[:-3]
+        int_part = ",".join(segments)
+    dec_part = ""
+    if "." in num_str:
+        dec_part = num_str.split(".", 1)[1]
+        dec_part = "." + dec_part
+    return sign + int_part + dec_part
+
+
+def format_create_account(record: OperationRecord) -> str:
+    return (
+        "*Create Account*\n"
+        f"From: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"To: {format_account(record.to, record.to_muxed_id)}\n"
+        f"Amount: `{format_amount(record.amounts[0])}`\n"
+    )
+
+
+def format_account_merge(record: OperationRecord) -> str:
+    return (
+        "*Account Merge*\n"
+        f"Account: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Merge to: {format_account(record.to, record.to_muxed_id)}\n"
+    )
+
+
+def format_payment(record: OperationRecord) -> str:
+    return (
+        "*Payment*\n"
+        f"From: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"To: {format_account(record.to, record.to_muxed_id)}\n"
+        f"Amount: `{format_amount(record.amounts[0])}`\n"
+    )
+
+
+def format_path_payment_strict_send(record: OperationRecord) -> str:
+    send, dest_min = record.amounts
+    return (
+        "*Path Payment Strict Send*\n"
+        f"From: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Destination: {format_account(record.to, record.to_muxed_id)}\n"
+        f"Send Amount: `{format_amount(send)}`\n"
+        f"Destination Min Receive Amount: `{format_amount(dest_min)}`\n"
+    )
+
+
+def format_path_payment_strict_receive(record: OperationRecord) -> str:
+    send_max, dest_amount = record.amounts
+    return (
+        "*Path Payment Strict Receive*\n"
+        f"From: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Destination: {format_account(record.to, record.to_muxed_id)}\n"
+        f"Send Max Amount: `{format_amount(send_max)}`\n"
+        f"Destination Receive: `{format_amount(dest_amount)}`\n"
+    )
+
+
+def format_claim_claimable_balance(record: OperationRecord) -> str:
+    return (
+        "*Claim Claimable Balance*\n"
+        f"Claimant: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Balance ID: `{record.balance_id}`\n"
+    )
+
+
+def format_clawback(record: OperationRecord) -> str:
+    return (
+        "*Clawback*\n"
+        f"From: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Issuer: {format_account(record.to, record.to_muxed_id)}\n"
+        f"Amount: `{format_amount(record.amounts[0])}`\n"
+    )
+
+
+def format_balance_change(record: OperationRecord) -> str:
+    title = (record.cause or BALANCE_CHANGE).replace("_", " ").title()
+    changes = "".join(
+        f"`{format_signed_amount(amount)}`\n" for amount in record.amounts
+    )
+    return (
+        f"*{title}*\n"
+        f"Account: {format_account(record.from_, record.from_muxed_id)}\n"
+        f"Balance Changes:\n{changes}"
+    )
+
+
+FORMATTERS: dict[str, Callable[[OperationRecord], str]] = {
+    "create_account": format_create_account,
+    "account_merge": format_account_merge,
+    "payment": format_payment,
+    "path_payment_strict_send": format_path_payment_strict_send,
+    "path_payment_strict_receive": format_path_payment_strict_receive,
+    "claim_claimable_balance": format_claim_claimable_balance,
+    "clawback": format_clawback,
+    BALANCE_CHANGE: format_balance_change,
+}
+
+
+def event_record(event: Event) -> OperationRecord:
+    event_id = event.id
+    if event.network is not None:
+        event_id = event_id.removeprefix(f"{event.network}:")
+    return OperationRecord(
+        event.type,
+        int(event_id.partition(":")[0]),
+        event.tx_hash,
+        event.from_,
+        event.to,
+        tuple(
+            AssetAmount(code, issuer, from_stroops(amount))
+            for code, issuer, amount in event.amounts
+        ),
+        event.from_muxed_id,
+        event.to_muxed_id,
+        event.balance_id,
+        event.cause,
+    )
+
+
+def render_event(event: Event) -> str:
+    return FORMATTERS[event.type](event_record(event))
+
+
+class Renderer:
+    """Fill in the `content` and `tx_hash` of messages from their events,
+    keeping the texts of the `max_size` most recent events."""
+
+    def __init__(self, max_size: int = RENDER_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        # Event id -> text and transaction hash.
+        self._texts: OrderedDict[str, tuple[str, str]] = OrderedDict()
+
+    def add(self, events: list[Event]) -> None:
+        """Render `events`, e.g. as they are created by an ingester running
+        in the same process."""
+        for event in events:
+            self._put(event.id, (render_event(event), event.tx_hash))
+
+    async def render(self, messages: list[Message]) -> None:
+        """Render `messages`, reading the events not cached at once. The
+        `content` of messages whose events expired is left `None`."""
+        missing = list(
+            {
+                event_id
+                for message in messages
+                for event_id in message.event_ids
+                if event_id not in self._texts
+            }
+        )
+        if missing:
+            self.add(list((await Event.get_events(missing)).values()))
+        for message in messages:
+            if not message.event_ids:
+                # Queued before events were, rendered by the ingester.
+                continue
+            rendered = [self._get(event_id) for event_id in message.event_ids]
+            texts = [text for text in rendered if text is not None]
+            if len(texts) < len(rendered):
+                message.content = None
+            else:
+                message.content = "\n".join(text for text, _ in texts)
+                message.tx_hash = texts[0][1]
+
+    def _get(self, event_id: str) -> Optional[tuple[str, str]]:
+        text = self._texts.get(event_id)
+        if text is not None:
+            self._texts.move_to_end(event_id)
+        return text
+
+    def _put(self, event_id: str, text: tuple[str, str]) -> None:
+        self._texts[event_id] = text
+        self._texts.move_to_end(event_id)
+        while len(self._texts) > self.max_size:
+            self._texts.popitem(last=False)
+
+
+_renderer: Optional[Renderer] = None
+
+
+def get_renderer() -> Renderer:
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer()
+    return _renderer
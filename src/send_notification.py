@@ -1,52 +1,418 @@
 import asyncio
+import datetime
+import os
+import random
+import socket
+import time
+import uuid
+from collections import deque
+from functools import lru_cache
+from typing import Optional
 
 from loguru import logger
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ParseMode
-from telegram.error import Forbidden
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
 
-from src.config import tg_app
-from src.db import Message, Chat
+from src.config import NETWORK_NAMES, get_config, get_tg_app
+from src.db import Event, Message, Chat, get_write_batcher, utc_now
+from src.metrics import (
+    MESSAGE_QUEUE_DEPTH,
+    NOTIFICATION_DELAY_SECONDS,
+    NOTIFICATIONS_SENT,
+    RETRY_AFTER,
+    SEND_ERRORS,
+    SEND_SECONDS,
+    TELEGRAM_MESSAGES_SENT,
+    start_metrics_server,
+)
+from src.render import get_renderer
 
+# Attempts to send a message failing with network errors before releasing
+# it for a later retry.
+MAX_SEND_ATTEMPTS = 5
+# Seconds between two requeues of messages whose lease expired.
+REQUEUE_INTERVAL = 30.0
+# Seconds the digest intervals of chats are cached for.
+DIGEST_INTERVALS_TTL = 60.0
+# Per chat rate limiters unused for this many seconds are dropped.
+IDLE_BUCKET_TTL = 60.0
+# Seconds given to the messages at hand to be sent when stopping.
+DRAIN_TIMEOUT = 5.0
 
-async def send_telegram_message(message: Message):
-    try:
-        await tg_app.bot.send_message(
-            chat_id=message.chat_id,
-            text=message.content,
-            parse_mode=ParseMode.MARKDOWN_V2,
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton(
-                            text="View on stellar.expert",
-                            url=f"https://stellar.expert/explorer/public/tx/{message.tx_hash}",
-                        )
-                    ],
-                ]
-            ),
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second, with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def last_used_at(self) -> float:
+        return self._updated_at
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no token for `seconds`, e.g. when told to by a RetryAfter."""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated_at = self._resume_at
+
+
+def tx_url(tx_hash: str, network: Optional[str]) -> Optional[str]:
+    """Return the stellar.expert page of the transaction, `None` on networks
+    it does not know. Messages without a network are of the public one."""
+    network = network or "public"
+    if network not in NETWORK_NAMES.values():
+        return None
+    return f"https://stellar.expert/explorer/{network}/tx/{tx_hash}"
+
+
+@lru_cache(maxsize=1024)
+def tx_keyboard(tx_hash: str, network: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    url = tx_url(tx_hash, network)
+    if url is None:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text="View on stellar.expert", url=url)]]
+    )
+
+
+def render(messages: list[Message]) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Render `messages`, whose contents are filled in by `Renderer.render`."""
+    if len(messages) == 1:
+        assert messages[0].content is not None and messages[0].tx_hash is not None
+        return messages[0].content, tx_keyboard(
+            messages[0].tx_hash, messages[0].network
         )
-        await message.remove()
+    return "\n".join(render_entry(message) for message in messages), None
+
+
+def render_entry(message: Message) -> str:
+    assert message.tx_hash is not None
+    url = tx_url(message.tx_hash, message.network)
+    if url is None:
+        return f"{message.content}\n"
+    return f"{message.content}[View on stellar\\.expert]({url})\n"
+
+
+def split_into_chunks(messages: list[Message]) -> list[list[Message]]:
+    """Group messages into as few Telegram messages as fit the length limit."""
+    chunks: list[list[Message]] = []
+    length = 0
+    for message in messages:
+        entry_length = len(render_entry(message)) + 1
+        if chunks and length + entry_length <= MessageLimit.MAX_TEXT_LENGTH:
+            chunks[-1].append(message)
+            length += entry_length
+        else:
+            chunks.append([message])
+            length = entry_length
+    return chunks
+
+
+async def send_telegram_message(chat_id: int, messages: list[Message]):
+    """Send `messages` as one Telegram message and ack them once delivered.
+
+    RetryAfter and network errors are raised to the caller, which may retry,
+    as is Forbidden, after which the chat gets nothing anymore.
+    """
+    text, reply_markup = render(messages)
+    try:
+        with SEND_SECONDS.time():
+            await get_tg_app().bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode=ParseMode.MARKDOWN_V2,
+                reply_markup=reply_markup,
+            )
+        await get_write_batcher().ack(messages)
+        TELEGRAM_MESSAGES_SENT.inc()
+        NOTIFICATIONS_SENT.inc(len(messages))
+        now = utc_now()
+        for message in messages:
+            NOTIFICATION_DELAY_SECONDS.observe(
+                (now - message.created_time).total_seconds()
+            )
     except Forbidden as e:
-        logger.debug(f"Message {message.id} not sent: {e}")
-        await Chat.disable_notification(message.chat_id)
+        SEND_ERRORS.labels("Forbidden").inc()
+        logger.debug(f"Messages to chat {chat_id} not sent: {e}")
+        # Drops the messages of the chat along with the disabling.
+        await get_write_batcher().disable_chat(chat_id)
+        raise
+    except BadRequest as e:
+        SEND_ERRORS.labels("BadRequest").inc()
+        # Retrying will not help, e.g. the chat no longer exists.
+        logger.error(f"{len(messages)} messages to chat {chat_id} dropped: {e}")
+        await get_write_batcher().ack(messages)
+    except TelegramError as e:
+        SEND_ERRORS.labels(type(e).__name__).inc()
+        raise
+
+
+class Dispatcher:
+    """Send messages with concurrent workers, within Telegram's rate limits.
+
+    Messages are queued per chat and chats are served round-robin, so a busy
+    chat waiting for its own rate limit never holds back the others. All
+    pending messages of a chat are coalesced into as few Telegram messages
+    as possible, and held back for chats with a digest interval.
+    https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+
+    Besides claiming messages from Mongo, the dispatcher takes the messages
+    put on `handoff` by an ingester running in the same process.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        global_rate: float,
+        per_chat_rate: float,
+        handoff: Optional[asyncio.Queue[list[Message]]] = None,
+    ):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.chat_messages: dict[int, deque[Message]] = {}
+        self.ready_chats: asyncio.Queue[int] = asyncio.Queue()
+        self.digest_intervals: dict[int, int] = {}
+        self.digest_intervals_loaded_at = 0.0
+        self.handoff = handoff
+        # Set to stop claiming messages, `run` returns once those at hand are
+        # sent.
+        self.stopping = asyncio.Event()
+
+    async def run(self) -> None:
+        tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(get_write_batcher().run()))
+        if self.handoff is not None:
+            tasks.append(asyncio.create_task(self.receive(self.handoff)))
+        try:
+            await self.fetch()
+            await self.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Give back what could not be sent, after the acks.
+            await get_write_batcher().release(
+                [m for queued in self.chat_messages.values() for m in queued]
+            )
+            await get_write_batcher().close()
+
+    async def sleep(self, seconds: float) -> None:
+        """Sleep, but wake up when stopping."""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def drain(self) -> None:
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.handoff is not None and not self.handoff.empty():
+            for message in self.handoff.get_nowait():
+                self.add(message)
+        while self.chat_messages and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.chat_messages:
+            logger.warning(
+                f"Stopped with messages to {len(self.chat_messages)} chats unsent."
+            )
+
+    async def receive(self, handoff: asyncio.Queue[list[Message]]) -> None:
+        while True:
+            for message in await handoff.get():
+                self.add(message)
+
+    async def fetch(self) -> None:
+        # Counted in chats, since all messages of a chat are sent together.
+        high_watermark = self.workers * 10
+        requeued_at = 0.0
+        while not self.stopping.is_set():
+            if time.monotonic() - requeued_at > REQUEUE_INTERVAL:
+                requeued = await Message.requeue_expired_leases()
+                if requeued:
+                    logger.warning(f"Requeued {requeued} messages with expired lease.")
+                if get_config().metrics_port is not None:
+                    for state, count in (await Message.count_by_state()).items():
+                        MESSAGE_QUEUE_DEPTH.labels(state).set(count)
+                requeued_at = time.monotonic()
+            if len(self.chat_messages) >= high_watermark:
+                await self.sleep(0.5)
+                continue
+            messages = await Message.claim(
+                self.worker_id,
+                high_watermark - len(self.chat_messages),
+                get_config().message_lease,
+            )
+            if not messages:
+                logger.debug("No unsent message found.")
+                self.drop_idle_buckets()
+                await self.sleep(3)
+                continue
+            for message in messages:
+                self.add(message)
+
+    def add(self, message: Message) -> None:
+        queued = self.chat_messages.get(message.chat_id)
+        if queued is None:
+            self.chat_messages[message.chat_id] = deque([message])
+            self.ready_chats.put_nowait(message.chat_id)
+        else:
+            queued.append(message)
+
+    def drop_idle_buckets(self) -> None:
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if (
+                chat_id not in self.chat_messages
+                and now - bucket.last_used_at > IDLE_BUCKET_TTL
+            ):
+                del self.chat_buckets[chat_id]
+
+    async def get_digest_interval(self, chat_id: int) -> int:
+        now = time.monotonic()
+        if now - self.digest_intervals_loaded_at > DIGEST_INTERVALS_TTL:
+            self.digest_intervals = {}
+            self.digest_intervals_loaded_at = now
+        if chat_id not in self.digest_intervals:
+            # Load the intervals of every chat with queued messages at once.
+            chat_ids = [chat_id, *self.chat_messages.keys()]
+            self.digest_intervals.update(await Chat.get_digest_intervals(chat_ids))
+        return self.digest_intervals.get(chat_id, 0)
+
+    async def work(self) -> None:
+        while True:
+            chat_id = await self.ready_chats.get()
+            queued = self.chat_messages[chat_id]
+            messages = list(queued)
+            queued.clear()
+            try:
+                # Coalesce every message of the chat, even those claimed by
+                # no one yet.
+                messages += await Message.claim_chat(
+                    chat_id, self.worker_id, get_config().message_lease
+                )
+                messages.sort(key=lambda m: m.order_key)
+                await self.deliver(chat_id, messages)
+            except Forbidden:
+                # Its queued messages were dropped with the chat disabled.
+                queued.clear()
+            except asyncio.CancelledError:
+                await get_write_batcher().release(messages)
+                raise
+            except Exception as e:
+                logger.exception(f"Messages to chat {chat_id} not sent: {e}")
+                await get_write_batcher().release(messages)
+            if queued:
+                self.ready_chats.put_nowait(chat_id)
+            else:
+                del self.chat_messages[chat_id]
+
+    async def deliver(self, chat_id: int, messages: list[Message]) -> None:
+        digest_interval = await self.get_digest_interval(chat_id)
+        if digest_interval:
+            send_time = min(m.created_time for m in messages) + datetime.timedelta(
+                seconds=digest_interval
+            )
+            if send_time > utc_now():
+                await Message.defer(messages, send_time)
+                return
+
+        await get_renderer().render(messages)
+        expired = [message for message in messages if message.content is None]
+        if expired:
+            logger.error(
+                f"{len(expired)} messages to chat {chat_id} dropped, "
+                "their events expired."
+            )
+            await get_write_batcher().ack(expired)
+            messages = [message for message in messages if message.content is not None]
+            if not messages:
+                return
+        chunks = split_into_chunks(messages)
+        for index, chunk in enumerate(chunks):
+            if not await self.deliver_chunk(chat_id, chunk):
+                logger.error(
+                    f"Messages to chat {chat_id} not sent after "
+                    f"{MAX_SEND_ATTEMPTS} attempts, release them for later."
+                )
+                await get_write_batcher().release(
+                    [message for chunk in chunks[index:] for message in chunk]
+                )
+                return
+
+    async def deliver_chunk(self, chat_id: int, messages: list[Message]) -> bool:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await send_telegram_message(chat_id, messages)
+                return True
+            except RetryAfter as e:
+                RETRY_AFTER.inc()
+                # Flood limits are mostly bot wide, hold back every worker.
+                logger.warning(f"Flood control exceeded, retry in {e.retry_after}s")
+                self.global_bucket.pause(e.retry_after)
+            except NetworkError as e:
+                delay = random.uniform(0, min(30.0, 2**attempt))
+                logger.warning(
+                    f"Messages to chat {chat_id} not sent: {e}, "
+                    f"retry in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+        return False
+
+
+def create_dispatcher(
+    handoff: Optional[asyncio.Queue[list[Message]]] = None,
+) -> Dispatcher:
+    return Dispatcher(
+        get_config().send_workers,
+        get_config().send_global_rate,
+        get_config().send_per_chat_rate,
+        handoff,
+    )
 
 
 async def send_notification():
-    while True:
-        message = await Message.get_oldest_unsent_message()
-        if message is None:
-            logger.debug("No unsent message found.")
-            await asyncio.sleep(3)
-            continue
-        # If you're sending bulk notifications to multiple users,
-        # the API will not allow more than 30 messages per second or so
-        # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
-        # But we don't need to worry about this because low traffic.
-        await send_telegram_message(message)
-        await asyncio.sleep(0.5)
+    await Message.create_indexes()
+    await Event.create_indexes()
+    await create_dispatcher().run()
 
 
 if __name__ == "__main__":
     logger.info("Starting send notification...")
+    start_metrics_server()
     asyncio.run(send_notification())
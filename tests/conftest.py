@@ -0,0 +1,100 @@
+"""Fixtures shared by the tests.
+
+The tests run offline: MongoDB is replaced by mongomock, and Horizon and
+Telegram by local fakes, see `bench`.
+"""
+
+import os
+
+# As in the Dockerfile, checking the types of every XDR object built or
+# parsed makes stellar-sdk several times slower.
+os.environ.setdefault("STELLAR_SDK_RUNTIME_TYPE_CHECKING", "0")
+
+import asyncio
+import dataclasses
+from collections import Counter
+
+import pytest
+from aiohttp import web
+from mongomock.collection import Collection
+from mongomock_motor import AsyncMongoMockClient
+
+from bench.harness import start_server
+from src import config, db, horizon, monitor_ledger
+
+ENV = {
+    "MONGODB_URI": "mongodb://127.0.0.1:27017",
+    "BOT_TOKEN": "123456:test",
+    "HORIZON_URL": "http://127.0.0.1:8000",
+    "NETWORK_PASSPHRASE": "Public Global Stellar Network ; September 2015",
+}
+
+
+@pytest.fixture(autouse=True)
+def env(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Configure the bot from `ENV` only, each test reads it again."""
+    for field in dataclasses.fields(config.Config):
+        monkeypatch.delenv(field.name.upper(), raising=False)
+    for name, value in ENV.items():
+        monkeypatch.setenv(name, value)
+    # A developer's .env must not leak into the tests.
+    monkeypatch.setattr(config, "load_dotenv", lambda: None)
+    monkeypatch.setattr(config, "_config", None)
+    monkeypatch.setattr(config, "_tg_app", None)
+
+
+@pytest.fixture
+def mongo(monkeypatch: pytest.MonkeyPatch):
+    """An empty database, in memory."""
+    monkeypatch.setattr(db, "_client", AsyncMongoMockClient(tz_aware=True))
+    monkeypatch.setattr(db, "_write_batcher", None)
+    return db.get_db()
+
+
+@pytest.fixture
+def queries(monkeypatch: pytest.MonkeyPatch) -> Counter[str]:
+    """Count the `find` and `find_one` queries made to each collection."""
+    counts: Counter[str] = Counter()
+    find = Collection.find
+
+    def counting_find(self, *args, **kwargs):
+        counts[self.name] += 1
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, "find", counting_find)
+    return counts
+
+
+@pytest.fixture
+def stopping(monkeypatch: pytest.MonkeyPatch) -> asyncio.Event:
+    """The event stopping the ledger monitor, of the loop of the test."""
+    stopping = asyncio.Event()
+    monkeypatch.setattr(monitor_ledger, "stopping", stopping)
+    return stopping
+
+
+@pytest.fixture
+async def serve():
+    """Serve aiohttp apps on local ports, and return their URLs."""
+    runners = []
+
+    async def serve(app: web.Application) -> str:
+        runner, url = await start_server(app)
+        runners.append(runner)
+        return url
+
+    yield serve
+    for runner in runners:
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+async def horizon_server(serve, monkeypatch: pytest.MonkeyPatch):
+    """Close the Horizon server a test opened, its session is bound to the
+    event loop of the test. Closed before the servers of `serve`, which wait
+    for the streams still open."""
+    monkeypatch.setattr(horizon, "_server", None)
+    monkeypatch.setattr(horizon, "_latest_ledger", None)
+    monkeypatch.setattr(horizon, "_latest_ledger_lock", None)
+    yield
+    await horizon.close_server()
@@ -0,0 +1,91 @@
+from bench.fixtures import generate
+from src import monitor_ledger
+from src.account_index import AccountIndex
+from src.db import Chat
+from src.decoder import decode_transactions, transaction_id
+
+# Chats watching accounts nobody pays, on top of those of the ledger.
+IDLE_CHATS = 1000
+
+
+async def test_load_indexes_enabled_chats(mongo):
+    await Chat.add_stellar_account(1, "GA")
+    await Chat.add_stellar_account(1, "GB")
+    await Chat.add_stellar_account(2, "GB")
+    await Chat.add_stellar_account(3, "GB")
+    await Chat.disable_notification(3)
+
+    index = AccountIndex()
+    await index.load()
+
+    assert len(index) == 2
+    assert "GC" not in index
+    assert index.get_chat_ids_by_accounts(["GA", "GC"]) == {"GA": [1]}
+    assert sorted(index.get_chat_ids_by_accounts(["GB"])["GB"]) == [1, 2]
+
+
+async def test_refresh_applies_chat_updates(mongo):
+    await Chat.add_stellar_account(1, "GA")
+    await Chat.add_stellar_account(2, "GA")
+    index = AccountIndex()
+    await index.load()
+
+    await Chat.add_stellar_account(3, "GB")
+    await Chat.remove_stellar_account(1, "GA")
+    await Chat.disable_notification(2)
+    await index.refresh()
+
+    assert index.get_chat_ids_by_accounts(["GA", "GB"]) == {"GB": [3]}
+
+    await Chat.enable_notification(2)
+    await index.refresh()
+
+    assert index.get_chat_ids_by_accounts(["GA"]) == {"GA": [2]}
+
+
+async def test_index_resolves_ledger_without_queries(mongo, queries, monkeypatch):
+    """Resolving the chats of a ledger from the index matches a query per
+    operation, as monitor_ledger did before, without any query."""
+    ledger = generate(1, 50, 500).ledgers[0]
+    records = decode_transactions(
+        [
+            (transaction_id(ledger.sequence, order), record["envelope_xdr"])
+            for order, record in enumerate(ledger.records, 1)
+        ],
+        "Public Global Stellar Network ; September 2015",
+        {},
+    )
+    accounts = sorted({r.from_ for r in records} | {r.to for r in records})
+    await mongo.chat.insert_many(
+        [
+            *(
+                Chat(chat_id=chat_id, account_ids=[account_id]).dict()
+                for chat_id, account_id in enumerate(accounts[::2])
+            ),
+            *(
+                Chat(chat_id=-chat_id, account_ids=[f"G{chat_id}"]).dict()
+                for chat_id in range(1, IDLE_CHATS + 1)
+            ),
+        ]
+    )
+
+    queries.clear()
+    per_operation = [
+        set(await Chat.get_chat_ids_by_enable([record.from_, record.to]))
+        for record in records
+    ]
+    assert queries["chat"] == len(records)
+
+    index = AccountIndex()
+    await index.load()
+    monkeypatch.setattr(monitor_ledger, "account_index", index)
+    queries.clear()
+    chat_ids_by_account = await monitor_ledger.resolve_chat_ids(records)
+
+    assert queries["chat"] == 0
+    assert per_operation == [
+        set(chat_ids_by_account.get(record.from_, ()))
+        | set(chat_ids_by_account.get(record.to, ()))
+        for record in records
+    ]
+    assert any(per_operation)
@@ -0,0 +1,50 @@
+from src import backfill
+from src.account_index import AccountIndex
+from src.db import Message, MessagePriority
+from src.decoder import transaction_id
+from src.monitor_ledger import Notifications
+
+
+async def test_backfilled_messages_are_claimed_after_live_ones(mongo, monkeypatch):
+    async def prepare_ledger(ledger_id, accounts=None):
+        return Notifications(
+            [],
+            [
+                Message(
+                    chat_id=1,
+                    order_key=transaction_id(ledger_id, 1) | 1,
+                    dedup_key=f"{ledger_id}",
+                )
+            ],
+        )
+
+    monkeypatch.setattr(backfill, "prepare_ledger", prepare_ledger)
+    monkeypatch.setattr(backfill, "account_index", AccountIndex())
+    stats = await backfill.backfill(100, 109, chunk_size=5, workers=2)
+    assert stats.messages == 10
+    # Queued after the backfill, of newer ledgers.
+    live = await Message.new_messages(
+        [
+            Message(
+                chat_id=2,
+                order_key=transaction_id(ledger_id, 1) | 1,
+                dedup_key=f"{ledger_id}",
+            )
+            for ledger_id in range(200, 203)
+        ]
+    )
+
+    claimed = await Message.claim("worker", 5, 60.0)
+
+    assert [message.id for message in claimed[:3]] == [m.id for m in live]
+    assert [message.priority for message in claimed] == [
+        *[MessagePriority.LIVE] * 3,
+        *[MessagePriority.BACKFILL] * 2,
+    ]
+    assert [message.order_key for message in claimed[3:]] == [
+        transaction_id(ledger_id, 1) | 1 for ledger_id in (100, 101)
+    ]
+
+    # Replaying again queues nothing, the messages are kept.
+    stats = await backfill.backfill(100, 109, chunk_size=5, workers=2, job="again")
+    assert (stats.messages, stats.duplicates) == (0, 10)
@@ -0,0 +1,58 @@
+import pytest
+
+from src.account_index import AccountIndex
+from src.bot import update_filter
+from src.db import Chat
+from src.filters import ChatFilter, Direction
+
+USDC = "USDC:GA5ZSEJYB37JRC5AVCIA5MOP4RHTM335X2KGX3IHOJAPP5RE34K4KZVN"
+
+
+def test_update_filter():
+    filter = update_filter(None, ["direction", "incoming"])
+    filter = update_filter(filter, ["min", "XLM", "10"])
+    filter = update_filter(filter, ["min", USDC, "0.5"])
+    filter = update_filter(filter, ["deny", USDC])
+
+    assert filter == {
+        "direction": "incoming",
+        "min_amounts": {"XLM": "10", USDC: "0.5"},
+        "deny_assets": [USDC],
+    }
+    filter = update_filter(filter, ["min", "XLM", "0"])
+    filter = update_filter(filter, ["deny"])
+    assert filter == {"direction": "incoming", "min_amounts": {USDC: "0.5"}}
+    assert update_filter(filter, ["clear"]) is None
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        [],
+        ["direction", "up"],
+        ["min", "XLM", "ten"],
+        ["min", "XLM", "-1"],
+        ["min", "USDC", "1"],
+        ["allow", "USDC:GA5Z"],
+        ["clear", "all"],
+    ],
+)
+def test_update_filter_rejects_invalid_arguments(args):
+    with pytest.raises(ValueError):
+        update_filter({"direction": "both"}, args)
+
+
+async def test_account_index_picks_up_filter(mongo):
+    await Chat.add_stellar_account(1, "GA")
+    index = AccountIndex()
+    await index.load()
+
+    await Chat.set_filter(1, update_filter(None, ["direction", "outgoing"]))
+    await index.refresh()
+
+    assert index.get_chat_filters([1]) == {1: ChatFilter(direction=Direction.OUTGOING)}
+
+    await Chat.set_filter(1, None)
+    await index.refresh()
+
+    assert index.get_chat_filters([1]) == {}
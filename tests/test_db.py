@@ -0,0 +1,158 @@
+import asyncio
+import datetime
+
+import pytest
+from mongomock.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+from src import monitor_ledger
+from src.config import get_config
+from src.db import Chat, Message, MessageState, get_write_batcher
+from src.decoder import OperationRecord
+
+
+def record(from_: str, to: str) -> OperationRecord:
+    return OperationRecord(
+        type="payment", operation_id=0, tx_hash="", from_=from_, to=to
+    )
+
+
+async def test_chat_ids_by_accounts_with_a_single_query(mongo, queries, monkeypatch):
+    monkeypatch.setattr(get_config(), "account_index", False)
+    await Chat.create_indexes()
+    await Chat.add_stellar_account(1, "GA")
+    await Chat.add_stellar_account(1, "GB")
+    await Chat.add_stellar_account(2, "GB")
+    await Chat.add_stellar_account(3, "GA")
+    await Chat.add_stellar_account(3, "GC")
+    await Chat.disable_notification(3)
+    records = [record("GA", "GB"), record("GB", "GC"), record("GD", "GA")]
+
+    queries.clear()
+    chat_ids_by_account = await monitor_ledger.resolve_chat_ids(records)
+
+    assert queries["chat"] == 1
+    assert chat_ids_by_account == {"GA": [1], "GB": [1, 2]}
+    # The same chats as a query per operation.
+    for r in records:
+        assert sorted(await Chat.get_chat_ids_by_enable([r.from_, r.to])) == sorted(
+            {
+                chat_id
+                for account_id in (r.from_, r.to)
+                for chat_id in chat_ids_by_account.get(account_id, [])
+            }
+        )
+    assert [("account_ids", 1), ("enable", 1)] in [
+        index["key"] for index in (await mongo.chat.index_information()).values()
+    ]
+
+
+async def test_concurrent_claims_are_disjoint(mongo):
+    await Message.create_indexes()
+    queued = await Message.new_messages(
+        [Message(chat_id=chat_id % 7, order_key=chat_id) for chat_id in range(100)]
+    )
+
+    claims = await asyncio.gather(
+        *(Message.claim(f"worker-{worker}", 15, 60.0) for worker in range(10))
+    )
+
+    claimed = [message.id for messages in claims for message in messages]
+    assert len(claimed) == len(set(claimed)) == len(queued)
+    for worker, messages in enumerate(claims):
+        # Claimed under a token unique to the claim.
+        assert all(
+            message.worker_id.startswith(f"worker-{worker}/") for message in messages
+        )
+        # Each claimer gets the messages in ledger order.
+        keys = [message.order_key for message in messages]
+        assert keys == sorted(keys)
+    assert await Message.claim("late", 15, 60.0) == []
+
+
+async def test_claim_skips_messages_won_by_others(mongo, monkeypatch):
+    await Message.create_indexes()
+    await Message.new_messages([Message(chat_id=1, order_key=key) for key in range(10)])
+    update_many = Collection.update_many
+
+    def update_many_once_claimed(self, *args, **kwargs):
+        # Another sender claims the first messages between our read of the
+        # queue and our claim.
+        monkeypatch.setattr(Collection, "update_many", update_many)
+        update_many(
+            self,
+            {"order_key": {"$lt": 3}},
+            {"$set": {"state": MessageState.CLAIMED, "worker_id": "other"}},
+        )
+        return update_many(self, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, "update_many", update_many_once_claimed)
+
+    claimed = await Message.claim("worker", 5, 60.0)
+
+    assert [message.order_key for message in claimed] == [3, 4, 5, 6, 7]
+    assert len({message.worker_id for message in claimed}) == 1
+
+
+async def test_count_by_state(mongo):
+    await Message.create_indexes()
+    await Message.new_messages([Message(chat_id=1, order_key=key) for key in range(5)])
+    claimed = await Message.claim("worker", 3, 60.0)
+    await get_write_batcher().ack(claimed[:1])
+    await get_write_batcher().flush()
+
+    assert await Message.count_by_state() == {
+        MessageState.PENDING: 2,
+        MessageState.CLAIMED: 2,
+        MessageState.SENT: 1,
+    }
+
+
+async def test_chat_is_stored_once(mongo):
+    await Chat.create_indexes()
+    await Chat.new_chat(1)
+    await Chat.add_stellar_account(1, "GA")
+    await Chat.new_chat(1)
+
+    assert await mongo.chat.count_documents({"chat_id": 1}) == 1
+    with pytest.raises(DuplicateKeyError):
+        await mongo.chat.insert_one(Chat(chat_id=1, account_ids=[]).dict())
+
+
+async def test_duplicate_chats_are_merged_before_the_unique_index(mongo):
+    # As created before chat ids were unique.
+    await mongo.chat.create_index("chat_id")
+    created_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    await mongo.chat.insert_many(
+        [
+            Chat(
+                chat_id=1,
+                account_ids=["GA", "GB"],
+                digest_interval=60,
+                updated_time=created_time,
+            ).dict(),
+            Chat(
+                chat_id=1,
+                account_ids=["GB", "GC"],
+                enable=False,
+                created_time=created_time,
+                updated_time=created_time + datetime.timedelta(days=1),
+            ).dict(),
+            Chat(chat_id=1, account_ids=["GD"]).dict(),
+            Chat(chat_id=2, account_ids=["GA"]).dict(),
+        ]
+    )
+
+    await Chat.create_indexes()
+
+    assert await Chat.get_chat(1) == Chat(
+        chat_id=1,
+        account_ids=["GD", "GA", "GB", "GC"],
+        enable=False,
+        created_time=created_time,
+        updated_time=created_time + datetime.timedelta(days=1),
+        digest_interval=0,
+    )
+    assert await mongo.chat.count_documents({}) == 2
+    with pytest.raises(DuplicateKeyError):
+        await mongo.chat.insert_one(Chat(chat_id=2, account_ids=[]).dict())
@@ -0,0 +1,247 @@
+import base64
+import hashlib
+from typing import Callable, Union
+
+import pytest
+from stellar_sdk import (
+    Account,
+    Asset,
+    CreateAccount,
+    FeeBumpTransactionEnvelope,
+    Keypair,
+    MuxedAccount,
+    PathPaymentStrictSend,
+    Payment,
+    TransactionBuilder,
+    TransactionEnvelope,
+    parse_transaction_envelope_from_xdr,
+)
+from stellar_sdk import xdr as stellar_xdr
+
+from bench.fixtures import FIRST_LEDGER, generate
+from src import monitor_ledger
+from src.config import get_config
+from src.decoder import (
+    AssetAmount,
+    OperationRecord,
+    decode_transactions,
+    transaction_hash,
+    transaction_id,
+)
+from src.filters import DEFAULT_THRESHOLDS, compile_thresholds, is_below_thresholds
+
+PASSPHRASE = "Public Global Stellar Network ; September 2015"
+TYPES = {
+    Payment: "payment",
+    PathPaymentStrictSend: "path_payment_strict_send",
+    CreateAccount: "create_account",
+}
+SOURCE = Keypair.from_raw_ed25519_seed(bytes([1] * 32))
+DESTINATION = Keypair.from_raw_ed25519_seed(bytes([2] * 32))
+ISSUER = Keypair.from_raw_ed25519_seed(bytes([3] * 32))
+USDC = Asset("USDC", ISSUER.public_key)
+TX_ID = transaction_id(FIRST_LEDGER, 1)
+
+
+@pytest.fixture(scope="module")
+def transactions() -> list[tuple[int, str]]:
+    fixture = generate(3, 50, 200)
+    return [
+        (transaction_id(ledger.sequence, order), record["envelope_xdr"])
+        for ledger in fixture.ledgers
+        for order, record in enumerate(ledger.records, 1)
+    ]
+
+
+def build(
+    append: Callable[[TransactionBuilder], object],
+    source: Union[str, MuxedAccount] = SOURCE.public_key,
+    v1: bool = True,
+) -> TransactionEnvelope:
+    """Sign a transaction of `source` with the operations `append` adds."""
+    builder = TransactionBuilder(
+        Account(source, 1), PASSPHRASE, base_fee=100, v1=v1
+    ).add_time_bounds(0, 0)
+    append(builder)
+    te = builder.build()
+    te.sign(SOURCE)
+    return te
+
+
+def fee_bump(inner: TransactionEnvelope) -> FeeBumpTransactionEnvelope:
+    te = TransactionBuilder.build_fee_bump_transaction(
+        DESTINATION.public_key, 200, inner, PASSPHRASE
+    )
+    te.sign(DESTINATION)
+    return te
+
+
+def pay(builder: TransactionBuilder) -> None:
+    builder.append_payment_op(DESTINATION.public_key, Asset.native(), "10")
+
+
+def decode(
+    te: Union[TransactionEnvelope, FeeBumpTransactionEnvelope]
+) -> list[OperationRecord]:
+    return decode_transactions([(TX_ID, te.to_xdr())], PASSPHRASE, {})
+
+
+def test_decodes_operations_like_the_sdk(transactions):
+    expected = []
+    for tx_id, envelope in transactions:
+        te = parse_transaction_envelope_from_xdr(envelope, PASSPHRASE)
+        for index, op in enumerate(te.transaction.operations):
+            if type(op) in TYPES:
+                expected.append(
+                    (
+                        tx_id | (index + 1),
+                        TYPES[type(op)],
+                        te.hash_hex(),
+                        te.transaction.source.account_id,
+                        op.destination.account_id
+                        if type(op) != CreateAccount
+                        else op.destination,
+                    )
+                )
+
+    records = decode_transactions(transactions, PASSPHRASE, {})
+
+    assert [
+        (r.operation_id, r.type, r.tx_hash, r.from_, r.to) for r in records
+    ] == expected
+
+
+def test_leaves_out_operations_below_thresholds(transactions):
+    thresholds = compile_thresholds(DEFAULT_THRESHOLDS)
+
+    records = decode_transactions(transactions, PASSPHRASE, {})
+    kept = decode_transactions(transactions, PASSPHRASE, thresholds)
+
+    assert 0 < len(kept) < len(records)
+    assert kept == [
+        r for r in records if not is_below_thresholds(r.amounts, thresholds)
+    ]
+
+
+async def test_process_pool_decodes_like_the_event_loop(transactions, monkeypatch):
+    monkeypatch.setattr(monitor_ledger, "_decode_pool", None)
+    monkeypatch.setattr(
+        monitor_ledger, "_thresholds", compile_thresholds(DEFAULT_THRESHOLDS)
+    )
+    inline = await monitor_ledger.decode(transactions)
+
+    monkeypatch.setattr(get_config(), "decode_workers", 2)
+    try:
+        pooled = await monitor_ledger.decode(transactions)
+        assert monitor_ledger._decode_pool is not None
+    finally:
+        if monitor_ledger._decode_pool is not None:
+            monitor_ledger._decode_pool.shutdown()
+
+    assert pooled == inline
+
+
+@pytest.mark.parametrize(
+    "te",
+    [build(pay), build(pay, v1=False), fee_bump(build(pay))],
+    ids=["v1", "v0", "fee_bump"],
+)
+def test_hashes_transactions_from_envelope_bytes(te):
+    network_id = hashlib.sha256(PASSPHRASE.encode()).digest()
+    data = base64.b64decode(te.to_xdr())
+    xdr_te = stellar_xdr.TransactionEnvelope.from_xdr_bytes(data)
+
+    assert transaction_hash(network_id, xdr_te, data) == te.hash_hex()
+    assert transaction_hash(network_id, xdr_te) == te.hash_hex()
+
+
+def test_decodes_v0_envelopes():
+    te = build(pay, v1=False)
+
+    assert te.to_xdr_object().type == stellar_xdr.EnvelopeType.ENVELOPE_TYPE_TX_V0
+    assert decode(te) == [
+        OperationRecord(
+            "payment",
+            TX_ID | 1,
+            te.hash_hex(),
+            SOURCE.public_key,
+            DESTINATION.public_key,
+            (AssetAmount("XLM", None, "10"),),
+        )
+    ]
+
+
+def test_unwraps_fee_bumps_under_their_hash():
+    inner = build(pay)
+    te = fee_bump(inner)
+
+    # Of the inner transaction, but hashed as the fee bump, as Horizon does.
+    assert decode(te) == [
+        OperationRecord(
+            "payment",
+            TX_ID | 1,
+            te.hash_hex(),
+            SOURCE.public_key,
+            DESTINATION.public_key,
+            (AssetAmount("XLM", None, "10"),),
+        )
+    ]
+    assert te.hash_hex() != inner.hash_hex()
+
+
+def test_decodes_claim_claimable_balance():
+    balance_id = "00000000" + "ab" * 32
+    te = build(lambda builder: builder.append_claim_claimable_balance_op(balance_id))
+
+    assert decode(te) == [
+        OperationRecord(
+            "claim_claimable_balance",
+            TX_ID | 1,
+            te.hash_hex(),
+            SOURCE.public_key,
+            SOURCE.public_key,
+            balance_id=balance_id,
+        )
+    ]
+
+
+def test_decodes_clawback_from_holder_to_issuer():
+    te = build(
+        lambda builder: builder.append_clawback_op(
+            USDC, DESTINATION.public_key, "5", source=ISSUER.public_key
+        )
+    )
+
+    assert decode(te) == [
+        OperationRecord(
+            "clawback",
+            TX_ID | 1,
+            te.hash_hex(),
+            DESTINATION.public_key,
+            ISSUER.public_key,
+            (AssetAmount("USDC", ISSUER.public_key, "5"),),
+        )
+    ]
+
+
+def test_decodes_muxed_ids():
+    def append(builder: TransactionBuilder) -> None:
+        destination = MuxedAccount(DESTINATION.public_key, 2)
+        builder.append_payment_op(destination, Asset.native(), "10")
+        # From the muxed source of the operation, not of the transaction.
+        builder.append_payment_op(
+            destination,
+            Asset.native(),
+            "20",
+            source=MuxedAccount(ISSUER.public_key, 3),
+        )
+
+    te = build(append, source=MuxedAccount(SOURCE.public_key, 1))
+
+    assert [
+        (r.operation_id, r.tx_hash, r.from_, r.from_muxed_id, r.to, r.to_muxed_id)
+        for r in decode(te)
+    ] == [
+        (TX_ID | 1, te.hash_hex(), SOURCE.public_key, 1, DESTINATION.public_key, 2),
+        (TX_ID | 2, te.hash_hex(), ISSUER.public_key, 3, DESTINATION.public_key, 2),
+    ]
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from stellar_sdk import AiohttpClient, ServerAsync
+from stellar_sdk.exceptions import BadResponseError, NotFoundError
+
+from src import horizon
+from src.config import get_config
+
+LATEST_LEDGER = 48000000
+
+
+class StubHorizon:
+    """Answer the root with the queued statuses first, then with 200, and
+    record the client port of each request."""
+
+    def __init__(self, statuses: tuple[int, ...] = ()) -> None:
+        self.statuses = list(statuses)
+        self.ports: list[int] = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.root)
+        return app
+
+    async def root(self, request: web.Request) -> web.Response:
+        assert request.transport is not None
+        self.ports.append(request.transport.get_extra_info("peername")[1])
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return web.json_response({"status": status}, status=status)
+        return web.json_response({"history_latest_ledger": LATEST_LEDGER})
+
+
+@pytest.fixture
+async def stub(serve, monkeypatch):
+    stub = StubHorizon()
+    monkeypatch.setenv("HORIZON_URL", await serve(stub.app()))
+    # Retry right away.
+    monkeypatch.setattr(horizon.random, "uniform", lambda a, b: 0.0)
+    return stub
+
+
+async def test_retries_rate_limits_and_server_errors(stub):
+    stub.statuses = [429, 503, 500]
+
+    assert await horizon.get_latest_ledger() == LATEST_LEDGER
+    assert len(stub.ports) == 4
+
+
+async def test_does_not_retry_client_errors(stub):
+    stub.statuses = [404]
+
+    with pytest.raises(NotFoundError):
+        await horizon.get_latest_ledger()
+    assert len(stub.ports) == 1
+
+
+async def test_gives_up_after_max_retries(stub, monkeypatch):
+    monkeypatch.setenv("HORIZON_MAX_RETRIES", "2")
+    stub.statuses = [503] * 10
+
+    with pytest.raises(BadResponseError):
+        await horizon.get_latest_ledger()
+    assert len(stub.ports) == 3
+
+
+async def test_shared_server_keeps_connections_alive(stub, monkeypatch):
+    monkeypatch.setenv("HORIZON_POOL_SIZE", "4")
+    for _ in range(20):
+        await horizon.get_latest_ledger()
+    await asyncio.gather(*(horizon.get_latest_ledger() for _ in range(40)))
+
+    assert len(stub.ports) == 60
+    assert len(set(stub.ports)) <= 4
+
+    # As each call site did before, with a server per request.
+    stub.ports.clear()
+    for _ in range(20):
+        async with ServerAsync(get_config().horizon_url, AiohttpClient()) as s:
+            await s.root().call()
+
+    assert len(set(stub.ports)) == 20
+
+
+async def test_cached_latest_ledger_shares_requests(stub):
+    results = await asyncio.gather(
+        *(horizon.get_cached_latest_ledger() for _ in range(10))
+    )
+
+    assert results == [LATEST_LEDGER] * 10
+    assert len(stub.ports) == 1
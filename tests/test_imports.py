@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECK = """
+import sys
+
+import src.{module}
+from src import config, db, horizon
+
+assert config._config is None, "config loaded"
+assert config._tg_app is None, "Telegram application built"
+assert db._client is None, "Mongo client created"
+assert horizon._server is None, "Horizon server created"
+if {ingester}:
+    assert "telegram" not in sys.modules, "python-telegram-bot imported"
+"""
+
+
+@pytest.mark.parametrize(
+    "module, ingester",
+    [
+        ("monitor_ledger", True),
+        ("backfill", True),
+        ("send_notification", False),
+        ("bot", False),
+        ("main", False),
+    ],
+)
+def test_entry_point_imports_build_nothing(module, ingester):
+    """Entry points build what they use when they start, not on import, so
+    they can be imported without any configuration."""
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK.format(module=module, ingester=ingester)],
+        cwd=ROOT,
+        env={"STELLAR_SDK_RUNTIME_TYPE_CHECKING": "0"},
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,194 @@
+import asyncio
+import gzip
+import json
+import os
+import struct
+
+import pytest
+from stellar_sdk import (
+    Keypair,
+    TransactionBuilder,
+    TransactionEnvelope,
+    parse_transaction_envelope_from_xdr,
+)
+from stellar_sdk import xdr as stellar_xdr
+
+from bench.fixtures import generate
+from src import ledger_source, monitor_ledger
+from src.config import get_config
+from src.ledger_source import HistoryArchiveLedgerSource
+
+SUCCESS = stellar_xdr.TransactionResultCode.txSUCCESS
+FAILED = stellar_xdr.TransactionResultCode.txFAILED
+
+
+def fee_bump(envelope: str, network_passphrase: str) -> str:
+    inner = TransactionEnvelope.from_xdr(envelope, network_passphrase)
+    return TransactionBuilder.build_fee_bump_transaction(
+        Keypair.random().public_key, 200, inner, network_passphrase
+    ).to_xdr()
+
+
+def result(tx_hash: bytes, code: stellar_xdr.TransactionResultCode, inner: bool):
+    if inner:
+        # A fee bump, whose inner transaction has the code.
+        inner_result = stellar_xdr.InnerTransactionResult(
+            stellar_xdr.Int64(100),
+            stellar_xdr.InnerTransactionResultResult(code, results=[]),
+            stellar_xdr.InnerTransactionResultExt(0),
+        )
+        code = (
+            stellar_xdr.TransactionResultCode.txFEE_BUMP_INNER_SUCCESS
+            if code == SUCCESS
+            else stellar_xdr.TransactionResultCode.txFEE_BUMP_INNER_FAILED
+        )
+        transaction_result = stellar_xdr.TransactionResultResult(
+            code,
+            inner_result_pair=stellar_xdr.InnerTransactionResultPair(
+                stellar_xdr.Hash(bytes(32)), inner_result
+            ),
+        )
+    else:
+        transaction_result = stellar_xdr.TransactionResultResult(code, results=[])
+    return stellar_xdr.TransactionResultPair(
+        stellar_xdr.Hash(tx_hash),
+        stellar_xdr.TransactionResult(
+            stellar_xdr.Int64(100),
+            transaction_result,
+            stellar_xdr.TransactionResultExt(0),
+        ),
+    )
+
+
+def write_records(path: str, records: list[bytes]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wb") as f:
+        for data in records:
+            # RFC 5531 record marking, a single fragment per record.
+            f.write(struct.pack(">I", 0x80000000 | len(data)) + data)
+
+
+def write_checkpoint(
+    source: HistoryArchiveLedgerSource,
+    checkpoint: int,
+    ledgers: dict[int, list[tuple[str, stellar_xdr.TransactionResultCode]]],
+    network_passphrase: str,
+) -> None:
+    """Write the transactions and results of `ledgers`, `(envelope, code)`
+    pairs in application order. Transaction sets are written in another
+    order, like stellar-core does."""
+    transactions, results = [], []
+    for sequence, pairs in ledgers.items():
+        envelopes = [
+            parse_transaction_envelope_from_xdr(envelope, network_passphrase)
+            for envelope, _ in pairs
+        ]
+        transactions.append(
+            stellar_xdr.TransactionHistoryEntry(
+                stellar_xdr.Uint32(sequence),
+                stellar_xdr.TransactionSet(
+                    stellar_xdr.Hash(bytes(32)),
+                    [te.to_xdr_object() for te in reversed(envelopes)],
+                ),
+                stellar_xdr.TransactionHistoryEntryExt(0),
+            ).to_xdr_bytes()
+        )
+        results.append(
+            stellar_xdr.TransactionHistoryResultEntry(
+                stellar_xdr.Uint32(sequence),
+                stellar_xdr.TransactionResultSet(
+                    [
+                        result(te.hash(), code, te.to_xdr_object().fee_bump is not None)
+                        for te, (_, code) in zip(envelopes, pairs)
+                    ]
+                ),
+                stellar_xdr.TransactionHistoryResultEntryExt(0),
+            ).to_xdr_bytes()
+        )
+    write_records(source.checkpoint_path("transactions", checkpoint), transactions)
+    write_records(source.checkpoint_path("results", checkpoint), results)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """An archive of ledgers 62 to 65, across two checkpoints, and the
+    envelopes of the transactions which succeeded in each."""
+    fixture = generate(4, 4, 50)
+    passphrase = fixture.network_passphrase
+    envelopes = [
+        [record["envelope_xdr"] for record in ledger.records]
+        for ledger in fixture.ledgers
+    ]
+    a, b, c, d = envelopes[0]
+    bumped = fee_bump(envelopes[1][0], passphrase)
+    failed_bump = fee_bump(envelopes[1][1], passphrase)
+    e, f, g, h = envelopes[2]
+    source = HistoryArchiveLedgerSource(str(tmp_path), passphrase)
+    write_checkpoint(
+        source,
+        63,
+        {
+            62: [(a, SUCCESS), (b, FAILED), (c, SUCCESS), (bumped, SUCCESS)],
+            63: [(failed_bump, FAILED), (d, FAILED)],
+        },
+        passphrase,
+    )
+    write_checkpoint(
+        source,
+        127,
+        {64: [(e, SUCCESS), (f, SUCCESS), (g, SUCCESS), (h, FAILED)]},
+        passphrase,
+    )
+    os.makedirs(tmp_path / ".well-known")
+    with open(tmp_path / ".well-known" / "stellar-history.json", "w") as file:
+        json.dump({"version": 1, "currentLedger": 127}, file)
+    return source, {62: [a, c, bumped], 63: [], 64: [e, f, g], 65: []}
+
+
+async def test_reads_successful_transactions_in_application_order(archive):
+    source, expected = archive
+
+    assert await source.get_latest_ledger() == 127
+    for ledger_id, envelopes in expected.items():
+        assert await source.get_transactions(ledger_id) == envelopes
+
+
+async def test_concurrent_reads_of_a_checkpoint_share_one_read(archive, monkeypatch):
+    source, expected = archive
+    reads = []
+    read_checkpoint = source.read_checkpoint
+
+    def count_reads(checkpoint):
+        reads.append(checkpoint)
+        return read_checkpoint(checkpoint)
+
+    monkeypatch.setattr(source, "read_checkpoint", count_reads)
+
+    transactions = await asyncio.gather(
+        *(source.get_transactions(ledger_id) for ledger_id in (62, 63, 62, 64, 65))
+    )
+
+    assert transactions == [expected[62], [], expected[62], expected[64], []]
+    assert sorted(reads) == [63, 127]
+
+
+async def test_failed_read_is_retried(archive, tmp_path):
+    source, expected = archive
+    path = source.checkpoint_path("results", 63)
+    os.rename(path, f"{path}.tmp")
+
+    with pytest.raises(FileNotFoundError):
+        await source.get_transactions(62)
+
+    os.rename(f"{path}.tmp", path)
+    assert await source.get_transactions(62) == expected[62]
+
+
+async def test_meta_requires_a_source_with_meta(archive, monkeypatch):
+    source, _ = archive
+    monkeypatch.setattr(ledger_source, "_ledger_source", source)
+    monkeypatch.setattr(get_config(), "notify_from_meta", True)
+
+    assert not source.has_meta
+    with pytest.raises(ValueError, match="NOTIFY_FROM_META"):
+        await monitor_ledger.monitor_ledger()
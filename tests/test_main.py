@@ -0,0 +1,64 @@
+import asyncio
+import os
+import signal
+
+from bench.fake_horizon import FakeHorizon
+from bench.fake_telegram import FakeTelegram
+from bench.fixtures import generate
+from bench.harness import seed_chats
+from src import ledger_source, main, monitor_ledger, render, send_notification
+from src.account_index import AccountIndex
+from src.config import get_config
+from src.db import Message, MessageState
+
+
+async def test_sigterm_sends_or_releases_handed_off_messages(
+    mongo, serve, stopping, monkeypatch
+):
+    fixture = generate(3, 20, 40)
+    fake_horizon = FakeHorizon(fixture, backlog=3, close_interval=0.0)
+    telegram = FakeTelegram(chat_rate=100.0, latency=0.0)
+    config = get_config()
+    monkeypatch.setattr(config, "horizon_url", await serve(fake_horizon.app()))
+    monkeypatch.setattr(config, "telegram_api_url", await serve(telegram.app()))
+    # Slower than the monitor queues messages, some are at hand when stopping.
+    monkeypatch.setattr(config, "send_global_rate", 5.0)
+    monkeypatch.setattr(send_notification, "DRAIN_TIMEOUT", 0.5)
+    monkeypatch.setattr(ledger_source, "_ledger_source", None)
+    monkeypatch.setattr(monitor_ledger, "_handoff", None)
+    monkeypatch.setattr(monitor_ledger, "account_index", AccountIndex())
+    monkeypatch.setattr(render, "_renderer", None)
+    await seed_chats(fixture, 40, 1, 0)
+
+    handed_off: list[Message] = []
+    preclaim = Message.preclaim
+
+    def record_preclaim(messages, worker_id, lease):
+        handed_off.extend(messages)
+        preclaim(messages, worker_id, lease)
+
+    monkeypatch.setattr(Message, "preclaim", record_preclaim)
+
+    task = asyncio.create_task(main.main())
+    async with asyncio.timeout(20):
+        while not telegram.deliveries:
+            await asyncio.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await task
+
+    assert handed_off
+    states = {
+        message["_id"]: message
+        async for message in mongo.message.find(
+            {"_id": {"$in": [message.id for message in handed_off]}}
+        )
+    }
+    assert len(states) == len(handed_off)
+    sent = [m for m in states.values() if m["state"] == MessageState.SENT]
+    released = [m for m in states.values() if m["state"] == MessageState.PENDING]
+    assert len(sent) + len(released) == len(handed_off)
+    assert sent and released
+    assert all("worker_id" not in message for message in released)
+    assert await mongo.message.count_documents({"state": MessageState.CLAIMED}) == 0
+    # A notification per message sent.
+    assert len(sent) == sum(len(delivery.tx_hashes) for delivery in telegram.deliveries)
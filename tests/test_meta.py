@@ -0,0 +1,291 @@
+import base64
+from typing import Optional
+
+import pytest
+from stellar_sdk import Account, Asset, Keypair, TransactionBuilder
+from stellar_sdk import xdr as stellar_xdr
+
+from bench.fixtures import FIRST_LEDGER, USDC, generate
+from src.decoder import AssetAmount, OperationRecord, transaction_id
+from src.filters import DEFAULT_THRESHOLDS, compile_thresholds
+from src.meta import (
+    BALANCE_CHANGE,
+    balance_deltas,
+    decode_balance_changes,
+    find_accounts,
+)
+
+PASSPHRASE = "Public Global Stellar Network ; September 2015"
+ALICE = Keypair.from_raw_ed25519_seed(bytes([1] * 32))
+BOB = Keypair.from_raw_ed25519_seed(bytes([2] * 32))
+CAROL = Keypair.from_raw_ed25519_seed(bytes([3] * 32))
+USDC_KEY = (USDC.code, USDC.issuer)
+TX_ID = transaction_id(FIRST_LEDGER, 1)
+ChangeType = stellar_xdr.LedgerEntryChangeType
+
+
+def account(
+    keypair: Keypair, balance: int, last_modified: int = FIRST_LEDGER - 1
+) -> stellar_xdr.LedgerEntry:
+    return stellar_xdr.LedgerEntry(
+        stellar_xdr.Uint32(last_modified),
+        stellar_xdr.LedgerEntryData(
+            stellar_xdr.LedgerEntryType.ACCOUNT,
+            account=stellar_xdr.AccountEntry(
+                keypair.xdr_account_id(),
+                stellar_xdr.Int64(balance),
+                stellar_xdr.SequenceNumber(stellar_xdr.Int64(1)),
+                stellar_xdr.Uint32(0),
+                None,
+                stellar_xdr.Uint32(0),
+                stellar_xdr.String32(b""),
+                stellar_xdr.Thresholds(b"\x01\x00\x00\x00"),
+                [],
+                stellar_xdr.AccountEntryExt(0),
+            ),
+        ),
+        stellar_xdr.LedgerEntryExt(0),
+    )
+
+
+def trust_line_asset(
+    pool_id: Optional[bytes] = None,
+) -> stellar_xdr.TrustLineAsset:
+    if pool_id is not None:
+        return stellar_xdr.TrustLineAsset(
+            stellar_xdr.AssetType.ASSET_TYPE_POOL_SHARE,
+            liquidity_pool_id=stellar_xdr.PoolID(stellar_xdr.Hash(pool_id)),
+        )
+    assert USDC.issuer is not None
+    return stellar_xdr.TrustLineAsset(
+        stellar_xdr.AssetType.ASSET_TYPE_CREDIT_ALPHANUM4,
+        alpha_num4=stellar_xdr.AlphaNum4(
+            stellar_xdr.AssetCode4(USDC.code.encode()),
+            Keypair.from_public_key(USDC.issuer).xdr_account_id(),
+        ),
+    )
+
+
+def trust_line(
+    keypair: Keypair, balance: int, pool_id: Optional[bytes] = None
+) -> stellar_xdr.LedgerEntry:
+    return stellar_xdr.LedgerEntry(
+        stellar_xdr.Uint32(FIRST_LEDGER - 1),
+        stellar_xdr.LedgerEntryData(
+            stellar_xdr.LedgerEntryType.TRUSTLINE,
+            trust_line=stellar_xdr.TrustLineEntry(
+                keypair.xdr_account_id(),
+                trust_line_asset(pool_id),
+                stellar_xdr.Int64(balance),
+                stellar_xdr.Int64(2**62),
+                stellar_xdr.Uint32(1),
+                stellar_xdr.TrustLineEntryExt(0),
+            ),
+        ),
+        stellar_xdr.LedgerEntryExt(0),
+    )
+
+
+def updated(
+    before: stellar_xdr.LedgerEntry, after: stellar_xdr.LedgerEntry
+) -> list[stellar_xdr.LedgerEntryChange]:
+    return [
+        stellar_xdr.LedgerEntryChange(ChangeType.LEDGER_ENTRY_STATE, state=before),
+        stellar_xdr.LedgerEntryChange(ChangeType.LEDGER_ENTRY_UPDATED, updated=after),
+    ]
+
+
+def created(entry: stellar_xdr.LedgerEntry) -> list[stellar_xdr.LedgerEntryChange]:
+    return [
+        stellar_xdr.LedgerEntryChange(ChangeType.LEDGER_ENTRY_CREATED, created=entry)
+    ]
+
+
+def removed(entry: stellar_xdr.LedgerEntry) -> list[stellar_xdr.LedgerEntryChange]:
+    data = entry.data
+    if data.type == stellar_xdr.LedgerEntryType.ACCOUNT:
+        assert data.account is not None
+        key = stellar_xdr.LedgerKey(
+            data.type,
+            account=stellar_xdr.LedgerKeyAccount(data.account.account_id),
+        )
+    else:
+        assert data.trust_line is not None
+        key = stellar_xdr.LedgerKey(
+            data.type,
+            trust_line=stellar_xdr.LedgerKeyTrustLine(
+                data.trust_line.account_id, data.trust_line.asset
+            ),
+        )
+    return [
+        stellar_xdr.LedgerEntryChange(ChangeType.LEDGER_ENTRY_STATE, state=entry),
+        stellar_xdr.LedgerEntryChange(ChangeType.LEDGER_ENTRY_REMOVED, removed=key),
+    ]
+
+
+def meta(*operations: list[stellar_xdr.LedgerEntryChange]) -> str:
+    return stellar_xdr.TransactionMeta(
+        2,
+        v2=stellar_xdr.TransactionMetaV2(
+            stellar_xdr.LedgerEntryChanges([]),
+            [
+                stellar_xdr.OperationMeta(stellar_xdr.LedgerEntryChanges(changes))
+                for changes in operations
+            ],
+            stellar_xdr.LedgerEntryChanges([]),
+        ),
+    ).to_xdr()
+
+
+def envelope(operations: int) -> tuple[str, str]:
+    """Return an envelope of `operations` payments and its hash."""
+    builder = TransactionBuilder(
+        Account(ALICE.public_key, 1), PASSPHRASE, base_fee=100
+    ).add_time_bounds(0, 0)
+    for _ in range(operations):
+        builder.append_payment_op(BOB.public_key, Asset.native(), "1")
+    te = builder.build()
+    te.sign(ALICE)
+    return te.to_xdr(), te.hash_hex()
+
+
+def changed_accounts(tx_meta: str) -> set[str]:
+    """Decode the accounts of the account and trust line entries `tx_meta`
+    changes."""
+    decoded = stellar_xdr.TransactionMeta.from_xdr(tx_meta)
+    operations = getattr(decoded, f"v{decoded.v}").operations
+    accounts = set()
+    for op_meta in operations:
+        for change in op_meta.changes.ledger_entry_changes:
+            entry = change.state or change.created or change.updated
+            if entry is None:
+                continue
+            data = entry.data
+            if data.account is not None:
+                account_id = data.account.account_id
+            elif data.trust_line is not None:
+                account_id = data.trust_line.account_id
+            else:
+                continue
+            accounts.add(
+                Keypair.from_raw_ed25519_public_key(
+                    account_id.account_id.ed25519.uint256
+                ).public_key
+            )
+    return accounts
+
+
+def test_finds_every_changed_account():
+    metas = [
+        record["result_meta_xdr"]
+        for ledger in generate(3, 30, 100).ledgers
+        for record in ledger.records
+    ]
+
+    indexes_by_account = find_accounts(metas)
+
+    for index, tx_meta in enumerate(metas):
+        found = {a for a, indexes in indexes_by_account.items() if index in indexes}
+        assert changed_accounts(tx_meta) <= found
+
+
+def test_finds_entries_after_a_last_modified_multiple_of_256():
+    # The entries of Bob follow the extension of those of Alice, so their
+    # change type is preceded by a zero byte, and a low byte of zero in
+    # their last modified ledger makes a candidate one byte earlier.
+    last_modified = 48000256
+    tx_meta = meta(
+        updated(account(ALICE, 100, last_modified), account(ALICE, 90, last_modified))
+        + updated(account(BOB, 100, last_modified), account(BOB, 110, last_modified))
+    )
+
+    # With a few accounts that are not, which cost a lookup.
+    assert {ALICE.public_key, BOB.public_key} <= find_accounts([tx_meta]).keys()
+
+
+def test_balance_deltas_are_signed():
+    changes = (
+        created(account(ALICE, 50))
+        + updated(account(BOB, 100), account(BOB, 70))
+        + removed(account(CAROL, 20))
+        + created(trust_line(ALICE, 7))
+        + updated(trust_line(BOB, 10), trust_line(BOB, 15))
+    )
+    keys = {keypair.raw_public_key() for keypair in (ALICE, BOB, CAROL)}
+
+    assert balance_deltas(changes, keys) == {
+        ALICE.raw_public_key(): {("XLM", None): 50, USDC_KEY: 7},
+        BOB.raw_public_key(): {("XLM", None): -30, USDC_KEY: 5},
+        # Merged.
+        CAROL.raw_public_key(): {("XLM", None): -20},
+    }
+
+
+def test_removed_trust_line_has_no_delta():
+    # A trust line can only be removed once empty.
+    changes = removed(trust_line(ALICE, 0))
+
+    assert balance_deltas(changes, {ALICE.raw_public_key()}) == {}
+
+
+def test_liquidity_pool_shares_are_left_out():
+    pool_id = bytes(range(32))
+    changes = updated(trust_line(ALICE, 10, pool_id), trust_line(ALICE, 30, pool_id))
+
+    assert balance_deltas(changes, {ALICE.raw_public_key()}) == {}
+
+
+def test_thresholds_apply_to_absolute_deltas():
+    tx_meta = meta(
+        # 0.00001 XLM out, below the 0.01 XLM threshold.
+        updated(account(ALICE, 10**9), account(ALICE, 10**9 - 100)),
+        # 1 XLM out.
+        updated(account(ALICE, 10**9), account(ALICE, 10**9 - 10**7)),
+    )
+    tx_envelope, tx_hash = envelope(2)
+
+    records = decode_balance_changes(
+        [(TX_ID, tx_envelope, tx_meta)],
+        {ALICE.public_key},
+        PASSPHRASE,
+        compile_thresholds(DEFAULT_THRESHOLDS),
+    )
+
+    assert records == [
+        OperationRecord(
+            BALANCE_CHANGE,
+            TX_ID | 2,
+            tx_hash,
+            ALICE.public_key,
+            ALICE.public_key,
+            (AssetAmount("XLM", None, "-1"),),
+            cause="payment",
+        )
+    ]
+
+
+@pytest.mark.parametrize("thresholds", [{}, compile_thresholds(DEFAULT_THRESHOLDS)])
+def test_decodes_only_watched_accounts(thresholds):
+    tx_meta = meta(
+        updated(account(ALICE, 10**9), account(ALICE, 0))
+        + updated(account(BOB, 0), account(BOB, 10**9))
+    )
+    tx_envelope, _ = envelope(1)
+
+    records = decode_balance_changes(
+        [(TX_ID, tx_envelope, tx_meta)], {BOB.public_key}, PASSPHRASE, thresholds
+    )
+
+    assert [(r.from_, r.amounts) for r in records] == [
+        (BOB.public_key, (AssetAmount("XLM", None, "100"),))
+    ]
+    # Not a valid meta.
+    assert (
+        decode_balance_changes(
+            [(TX_ID, tx_envelope, base64.b64encode(b"meta").decode())],
+            {BOB.public_key},
+            PASSPHRASE,
+            thresholds,
+        )
+        == []
+    )
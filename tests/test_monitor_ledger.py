@@ -0,0 +1,198 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+from bench.fixtures import generate
+from src import ledger_source, monitor_ledger
+from src.account_index import AccountIndex
+from src.config import get_config
+from src.db import Chat, LedgerRange, Message, SystemInfo
+from src.ledger_source import LedgerSource
+
+
+class FakeStream:
+    """Horizon's root and transaction stream.
+
+    Like Horizon, a stream resumes after the `Last-Event-ID` header when the
+    client reconnects, or after the `cursor` parameter. The first stream is
+    dropped after `drop_after` transactions.
+    """
+
+    def __init__(self, records: list[dict], latest_ledger: int, drop_after: int):
+        self.records = records
+        self.latest_ledger = latest_ledger
+        self.drop_after = drop_after
+        # Of each stream opened.
+        self.cursors: list[int] = []
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.root)
+        app.router.add_get("/transactions", self.stream)
+        return app
+
+    async def root(self, request: web.Request) -> web.Response:
+        return web.json_response({"history_latest_ledger": self.latest_ledger})
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        cursor = int(
+            request.headers.get("Last-Event-ID") or request.query.get("cursor") or 0
+        )
+        self.cursors.append(cursor)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # Reconnect after 10 ms.
+        await response.write(b'retry: 10\nevent: open\ndata: "hello"\n\n')
+        records = [r for r in self.records if int(r["paging_token"]) > cursor]
+        for sent, record in enumerate(records):
+            if len(self.cursors) == 1 and sent == self.drop_after:
+                return response
+            event = f"id: {record['paging_token']}\ndata: {json.dumps(record)}\n\n"
+            await response.write(event.encode())
+        while True:
+            await asyncio.sleep(60)
+
+
+async def test_stream_resumes_after_reconnect(mongo, serve, stopping, monkeypatch):
+    fixture = generate(5, 4, 20)
+    records = [record for ledger in fixture.ledgers for record in ledger.records]
+    stream = FakeStream(records, fixture.first_ledger, drop_after=6)
+    monkeypatch.setattr(get_config(), "horizon_url", await serve(stream.app()))
+    monkeypatch.setattr(monitor_ledger, "STREAM_IDLE_FLUSH", 0.1)
+    await Message.create_indexes()
+    await SystemInfo.update_processed_ledger(fixture.first_ledger - 1)
+    for chat_id, record in enumerate(records):
+        await Chat.add_stellar_account(chat_id, record["source_account"])
+    index = AccountIndex()
+    await index.load()
+    monkeypatch.setattr(monitor_ledger, "account_index", index)
+
+    processed: list[int] = []
+    build_ledger_messages = monitor_ledger.build_ledger_messages
+
+    async def record_transactions(transactions, accounts=None):
+        processed.extend(tx_id for tx_id, _ in transactions)
+        return await build_ledger_messages(transactions, accounts)
+
+    monkeypatch.setattr(monitor_ledger, "build_ledger_messages", record_transactions)
+
+    task = asyncio.create_task(monitor_ledger.stream_ledgers())
+    async with asyncio.timeout(10):
+        while len(processed) < len(records):
+            await asyncio.sleep(0.05)
+        stopping.set()
+        await task
+
+    # Resumed after the last transaction received before the drop.
+    assert stream.cursors == [
+        int(monitor_ledger.ledger_paging_token(fixture.first_ledger)),
+        int(records[5]["paging_token"]),
+    ]
+    assert processed == [int(record["paging_token"]) for record in records]
+    assert await SystemInfo.get_processed_ledger() == fixture.last_ledger - 1
+    assert await SystemInfo.get_paging_token() == records[-1]["paging_token"]
+    notifications = await build_ledger_messages(
+        [(int(record["paging_token"]), record["envelope_xdr"]) for record in records]
+    )
+    assert sorted(
+        [message["dedup_key"] async for message in mongo.message.find()]
+    ) == sorted(message.dedup_key for message in notifications.messages)
+
+
+class StubLedgerSource(LedgerSource):
+    def __init__(self, latest_ledger: int) -> None:
+        self.latest_ledger = latest_ledger
+
+    async def get_latest_ledger(self) -> int:
+        return self.latest_ledger
+
+    async def get_transactions(self, ledger_id: int) -> list[str]:
+        return []
+
+
+async def test_expired_lease_is_taken_over(mongo, stopping, monkeypatch):
+    config = get_config()
+    monkeypatch.setattr(config, "ingest_lease", 0.3)
+    monkeypatch.setattr(config, "catchup_window", 1)
+    monkeypatch.setattr(ledger_source, "_ledger_source", StubLedgerSource(110))
+    await LedgerRange.create_indexes()
+    await SystemInfo.update_processed_ledger(100)
+
+    # The first monitor dies while processing ledger 104.
+    dies = asyncio.Event()
+    prepared: list[int] = []
+
+    async def prepare_ledger(ledger_id, accounts=None):
+        if ledger_id == 104 and not dies.is_set():
+            dies.set()
+            await asyncio.sleep(60)
+        prepared.append(ledger_id)
+        return monitor_ledger.Notifications([], [])
+
+    checkpoints: list[tuple[str, int]] = []
+    checkpoint = LedgerRange.checkpoint
+
+    async def record_checkpoint(start, worker_id, ledger, lease):
+        checkpoints.append((worker_id, ledger))
+        return await checkpoint(start, worker_id, ledger, lease)
+
+    monkeypatch.setattr(monitor_ledger, "prepare_ledger", prepare_ledger)
+    monkeypatch.setattr(LedgerRange, "checkpoint", record_checkpoint)
+
+    dead = asyncio.create_task(monitor_ledger.poll_ledgers("dead"))
+    async with asyncio.timeout(5):
+        await dies.wait()
+    dead.cancel()
+    await asyncio.wait([dead])
+    # Held until the lease expires.
+    assert await LedgerRange.claim("other", 110, config.ingest_lease) is None
+
+    await asyncio.sleep(config.ingest_lease)
+    async with asyncio.timeout(5):
+        await monitor_ledger.poll_ledgers("other")
+
+    assert checkpoints == [
+        *(("dead", ledger) for ledger in range(101, 104)),
+        *(("other", ledger) for ledger in range(104, 111)),
+    ]
+    assert prepared == list(range(101, 111))
+    assert await SystemInfo.get_processed_ledger() == 110
+
+
+async def test_ledgers_are_saved_in_order(stopping, monkeypatch):
+    monkeypatch.setattr(get_config(), "catchup_window", 4)
+    # Ledger 106 fails once ledgers prepared after it are done.
+    prepared: list[int] = []
+
+    async def prepare_ledger(ledger_id, accounts=None):
+        await asyncio.sleep((110 - ledger_id) * 0.01)
+        if ledger_id == 106:
+            raise RuntimeError("Horizon is down")
+        prepared.append(ledger_id)
+        return monitor_ledger.Notifications(
+            [], [Message(chat_id=1, order_key=ledger_id)]
+        )
+
+    saved: list[int] = []
+
+    async def save_notifications(notifications):
+        saved.extend(message.order_key for message in notifications.messages)
+        return notifications.messages
+
+    checkpoints: list[int] = []
+
+    async def checkpoint(ledger_id):
+        checkpoints.append(ledger_id)
+
+    monkeypatch.setattr(monitor_ledger, "prepare_ledger", prepare_ledger)
+    monkeypatch.setattr(monitor_ledger, "save_notifications", save_notifications)
+
+    with pytest.raises(RuntimeError):
+        await monitor_ledger.process_ledgers(101, 110, checkpoint)
+
+    # Later ledgers of the window are prepared first...
+    assert prepared[:4] == [104, 103, 102, 101]
+    # ...but saved and checkpointed in order, up to the failed one.
+    assert saved == checkpoints == list(range(101, 106))
@@ -0,0 +1,181 @@
+import re
+
+import pytest
+
+from bench.fixtures import USDC
+from src.db import Event, Message
+from src.decoder import AssetAmount, OperationRecord
+from src.meta import BALANCE_CHANGE
+from src.monitor_ledger import new_event
+from src.render import FORMATTERS, Renderer, render_event
+from src.send_notification import render_entry
+
+FROM = "GA" + "A" * 54
+TO = "GB" + "B" * 54
+TX_HASH = "ab" * 32
+XLM_10 = AssetAmount("XLM", None, "10")
+USDC_1234 = AssetAmount(USDC.code, USDC.issuer, "1234.5")
+USDC_TEXT = "USDC(GA5Z...KZVN)"
+
+# Text outside of entities must escape these.
+_RESERVED = r"_*\[\]()~`>#+\-=|{}.!"
+_MARKDOWN_V2 = re.compile(
+    rf"""(?:
+        \\[{_RESERVED}\\]
+        | `[^`\\]*`
+        | \*
+        | \[(?:\\.|[^\[\]\\])*\]\([^()\\\s]*\)
+        | [^{_RESERVED}\\]
+    )*""",
+    re.VERBOSE,
+)
+
+RECORDS = {
+    "create_account": (
+        OperationRecord("create_account", 1, TX_HASH, FROM, TO, (XLM_10,)),
+        f"*Create Account*\nFrom: `{FROM}`\nTo: `{TO}`\nAmount: `10 XLM`\n",
+    ),
+    "account_merge": (
+        OperationRecord("account_merge", 1, TX_HASH, FROM, TO),
+        f"*Account Merge*\nAccount: `{FROM}`\nMerge to: `{TO}`\n",
+    ),
+    "payment": (
+        OperationRecord("payment", 1, TX_HASH, FROM, TO, (USDC_1234,), from_muxed_id=7),
+        f"*Payment*\nFrom: `{FROM}` \\(muxed id `7`\\)\nTo: `{TO}`\n"
+        f"Amount: `1,234.5 {USDC_TEXT}`\n",
+    ),
+    "path_payment_strict_send": (
+        OperationRecord(
+            "path_payment_strict_send", 1, TX_HASH, FROM, TO, (USDC_1234, XLM_10)
+        ),
+        f"*Path Payment Strict Send*\nFrom: `{FROM}`\nDestination: `{TO}`\n"
+        f"Send Amount: `1,234.5 {USDC_TEXT}`\n"
+        f"Destination Min Receive Amount: `10 XLM`\n",
+    ),
+    "path_payment_strict_receive": (
+        OperationRecord(
+            "path_payment_strict_receive",
+            1,
+            TX_HASH,
+            FROM,
+            TO,
+            (XLM_10, USDC_1234),
+            to_muxed_id=8,
+        ),
+        f"*Path Payment Strict Receive*\nFrom: `{FROM}`\n"
+        f"Destination: `{TO}` \\(muxed id `8`\\)\n"
+        f"Send Max Amount: `10 XLM`\nDestination Receive: `1,234.5 {USDC_TEXT}`\n",
+    ),
+    "claim_claimable_balance": (
+        OperationRecord(
+            "claim_claimable_balance",
+            1,
+            TX_HASH,
+            FROM,
+            FROM,
+            balance_id="00000000" + "cd" * 32,
+        ),
+        f"*Claim Claimable Balance*\nClaimant: `{FROM}`\n"
+        f"Balance ID: `{'00000000' + 'cd' * 32}`\n",
+    ),
+    "clawback": (
+        OperationRecord("clawback", 1, TX_HASH, FROM, TO, (USDC_1234,)),
+        f"*Clawback*\nFrom: `{FROM}`\nIssuer: `{TO}`\n"
+        f"Amount: `1,234.5 {USDC_TEXT}`\n",
+    ),
+    BALANCE_CHANGE: (
+        OperationRecord(
+            BALANCE_CHANGE,
+            1,
+            TX_HASH,
+            FROM,
+            FROM,
+            (AssetAmount("XLM", None, "-10"), USDC_1234),
+            cause="path_payment_strict_send",
+        ),
+        f"*Path Payment Strict Send*\nAccount: `{FROM}`\nBalance Changes:\n"
+        f"`-10 XLM`\n`+1,234.5 {USDC_TEXT}`\n",
+    ),
+}
+
+
+def event(operation_id: int) -> Event:
+    record, _ = RECORDS["payment"]
+    return new_event(record._replace(operation_id=operation_id))
+
+
+def message(*events: Event) -> Message:
+    return Message(chat_id=1, event_ids=[e.id for e in events])
+
+
+def test_every_event_type_is_tested():
+    assert RECORDS.keys() == FORMATTERS.keys()
+
+
+@pytest.mark.parametrize("type_", list(RECORDS))
+def test_renders_event(type_):
+    record, expected = RECORDS[type_]
+
+    text = render_event(new_event(record))
+
+    assert text == expected
+    assert _MARKDOWN_V2.fullmatch(text)
+
+
+def test_entry_links_the_transaction():
+    record, content = RECORDS["payment"]
+    entry = render_entry(Message(chat_id=1, content=content, tx_hash=TX_HASH))
+
+    assert entry == (
+        f"{content}[View on stellar\\.expert]"
+        f"(https://stellar.expert/explorer/public/tx/{TX_HASH})\n"
+    )
+    assert _MARKDOWN_V2.fullmatch(entry)
+    # No link on a network stellar.expert does not know.
+    assert render_entry(
+        Message(chat_id=1, content=content, tx_hash=TX_HASH, network="custom")
+    ) == (content + "\n")
+
+
+async def test_cached_events_are_not_read(mongo, queries):
+    events = [event(1), event(2)]
+    renderer = Renderer()
+    renderer.add(events)
+    messages = [message(events[0]), message(*events)]
+
+    queries.clear()
+    await renderer.render(messages)
+
+    assert queries["event"] == 0
+    assert messages[0].content == render_event(events[0])
+    assert messages[1].content == "\n".join(map(render_event, events))
+    assert messages[1].tx_hash == TX_HASH
+
+
+async def test_least_recently_used_events_are_evicted(mongo, queries):
+    events = [event(operation_id) for operation_id in (1, 2, 3)]
+    await Event.new_events(events)
+    renderer = Renderer(max_size=2)
+    renderer.add(events[:2])
+    # Used, so the other one is evicted first.
+    await renderer.render([message(events[0])])
+    renderer.add(events[2:])
+
+    queries.clear()
+    await renderer.render([message(events[0]), message(events[2])])
+    assert queries["event"] == 0
+
+    evicted = message(events[1])
+    await renderer.render([evicted])
+    assert queries["event"] == 1
+    assert evicted.content == render_event(events[1])
+
+
+async def test_messages_of_expired_events_are_not_rendered(mongo):
+    stored, expired = event(1), event(2)
+    await Event.new_events([stored])
+    messages = [message(stored, expired), message(expired), message(stored)]
+
+    await Renderer().render(messages)
+
+    assert [m.content for m in messages] == [None, None, render_event(stored)]
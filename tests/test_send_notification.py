@@ -0,0 +1,182 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+from bench.fake_telegram import FakeTelegram
+from src.config import get_config
+from src.db import Chat, Message, MessageState
+from src.decoder import transaction_id
+from src.send_notification import Dispatcher
+
+
+class BlockingTelegram(FakeTelegram):
+    """Answer the messages to the chats of `blocked` with a 403, as Telegram
+    does once a user blocked the bot."""
+
+    def __init__(self, blocked: set[int] = set(), **kwargs) -> None:
+        super().__init__(latency=0.0, **kwargs)
+        self.blocked = blocked
+        # Of each sendMessage request, answered or not.
+        self.chat_ids: list[int] = []
+
+    def send_message(self, params: dict) -> web.Response:
+        chat_id = int(params["chat_id"])
+        self.chat_ids.append(chat_id)
+        if chat_id in self.blocked:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 403,
+                    "description": "Forbidden: bot was blocked by the user",
+                },
+                status=403,
+            )
+        return super().send_message(params)
+
+
+@pytest.fixture
+def telegram(serve, monkeypatch):
+    async def telegram(**kwargs) -> BlockingTelegram:
+        telegram = BlockingTelegram(**kwargs)
+        url = await serve(telegram.app())
+        monkeypatch.setattr(get_config(), "telegram_api_url", url)
+        return telegram
+
+    return telegram
+
+
+async def queue(chat_ids: list[int]) -> list[Message]:
+    """Queue a message to each of `chat_ids`, in this order."""
+    await Message.create_indexes()
+    return await Message.new_messages(
+        [
+            Message(
+                chat_id=chat_id,
+                content=f"Notification {order_key}",
+                tx_hash=f"{order_key:064x}",
+                order_key=order_key,
+            )
+            for order_key, chat_id in enumerate(chat_ids, 1)
+        ]
+    )
+
+
+async def dispatch(dispatcher: Dispatcher, done) -> None:
+    """Run `dispatcher` until `done()` is true."""
+    task = asyncio.create_task(dispatcher.run())
+    async with asyncio.timeout(10):
+        while not done():
+            await asyncio.sleep(0.05)
+        dispatcher.stopping.set()
+        await task
+
+
+async def test_retry_after_pauses_every_worker(mongo, telegram):
+    # Telegram accepts fewer messages than the dispatcher sends.
+    fake = await telegram(global_rate=1.0)
+    await queue([1, 2, 3])
+    dispatcher = Dispatcher(workers=3, global_rate=100.0, per_chat_rate=100.0)
+
+    await dispatch(dispatcher, lambda: len(fake.deliveries) == 3)
+
+    assert sorted(delivery.chat_id for delivery in fake.deliveries) == [1, 2, 3]
+    # Without the pause, the workers would retry right away and give up.
+    assert 0 < fake.rejected <= 3
+    assert await mongo.message.count_documents({"state": MessageState.SENT}) == 3
+
+
+async def test_forbidden_disables_the_chat(mongo, telegram):
+    fake = await telegram(blocked={1})
+    for chat_id in (1, 2):
+        await Chat.add_stellar_account(chat_id, "GA")
+    await queue([1, 2, 1])
+    dispatcher = Dispatcher(workers=2, global_rate=100.0, per_chat_rate=100.0)
+
+    await dispatch(dispatcher, lambda: len(fake.chat_ids) == 2)
+
+    # Both messages of the blocked chat in a single attempt.
+    assert sorted(fake.chat_ids) == [1, 2]
+    assert [delivery.chat_id for delivery in fake.deliveries] == [2]
+    chat = await Chat.get_chat(1)
+    assert chat is not None and not chat.enable
+    assert await mongo.message.count_documents({"chat_id": 1}) == 0
+    assert await mongo.message.count_documents({"state": MessageState.SENT}) == 1
+
+
+async def test_two_dispatchers_deliver_in_ledger_order(mongo, telegram, monkeypatch):
+    fake = await telegram(chat_rate=100.0)
+    sleep = Dispatcher.sleep
+    # Claim the messages of the next ledger without waiting.
+    monkeypatch.setattr(
+        Dispatcher, "sleep", lambda self, seconds: sleep(self, min(seconds, 0.05))
+    )
+    await Message.create_indexes()
+    dispatchers = [
+        Dispatcher(workers=2, global_rate=100.0, per_chat_rate=100.0) for _ in range(2)
+    ]
+    tasks = [asyncio.create_task(dispatcher.run()) for dispatcher in dispatchers]
+    expected = []
+    async with asyncio.timeout(10):
+        for ledger in range(10, 13):
+            # Two of them fit a Telegram message, in the order of the ledger
+            # whatever the order they were queued in.
+            messages = [
+                Message(
+                    chat_id=1,
+                    content="x" * 1500,
+                    tx_hash=f"{transaction_id(ledger, order):064x}",
+                    order_key=transaction_id(ledger, order) | 1,
+                )
+                for order in (3, 1, 4, 2)
+            ]
+            expected += sorted(message.tx_hash for message in messages)
+            await Message.new_messages(messages)
+            while sum(len(d.tx_hashes) for d in fake.deliveries) < len(expected):
+                await asyncio.sleep(0.05)
+        for dispatcher in dispatchers:
+            dispatcher.stopping.set()
+        await asyncio.gather(*tasks)
+
+    assert len(fake.deliveries) == 6
+    assert [tx_hash for d in fake.deliveries for tx_hash in d.tx_hashes] == expected
+
+
+async def test_digest_is_sent_once_after_its_interval(mongo, telegram, monkeypatch):
+    fake = await telegram(chat_rate=100.0)
+    sleep = Dispatcher.sleep
+    # Claim the deferred messages as soon as they are available.
+    monkeypatch.setattr(
+        Dispatcher, "sleep", lambda self, seconds: sleep(self, min(seconds, 0.05))
+    )
+    await Chat.add_stellar_account(1, "GA")
+    await Chat.set_digest_interval(1, 1)
+    started_at = time.monotonic()
+    first = await queue([1, 1, 1])
+    dispatcher = Dispatcher(workers=2, global_rate=100.0, per_chat_rate=100.0)
+    task = asyncio.create_task(dispatcher.run())
+    async with asyncio.timeout(10):
+        await asyncio.sleep(0.5)
+        # Claimed with the deferred ones, and deferred again until the end
+        # of the interval.
+        late = await Message.new_messages(
+            [Message(chat_id=1, content="Late", tx_hash=f"{4:064x}", order_key=4)]
+        )
+        await asyncio.sleep(0.3)
+        assert fake.deliveries == []
+        assert await mongo.message.count_documents({"available_time": None}) == 0
+
+        while not fake.deliveries:
+            await asyncio.sleep(0.05)
+        sent_at = time.monotonic()
+        # Nothing left to send after the digest.
+        await asyncio.sleep(0.5)
+        dispatcher.stopping.set()
+        await task
+
+    assert sent_at - started_at >= 1.0
+    assert len(fake.deliveries) == 1
+    assert fake.deliveries[0].chat_id == 1
+    assert fake.deliveries[0].tx_hashes == [m.tx_hash for m in first + late]
+    assert await mongo.message.count_documents({"state": MessageState.SENT}) == 4